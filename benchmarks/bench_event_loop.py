@@ -0,0 +1,164 @@
+"""
+Пропускная способность event loop: стандартный asyncio, asyncio с
+nest_asyncio (как бот запускался раньше) и uvloop.
+
+Запуск (MongoDB и Telegram не нужны):
+    python -m benchmarks.bench_event_loop --variants asyncio nest_asyncio uvloop
+
+Каждый вариант выполняется в отдельном процессе (nest_asyncio патчит asyncio
+глобально). Нагрузки:
+  * switches — задачи перекидываются сообщениями через asyncio.Queue
+    (переключения задач в секунду: так хендлеры общаются с очередью отправки);
+  * requests — локальная заглушка Bot API: TCP сервер в том же цикле отвечает
+    на запросы по постоянным соединениям, клиенты шлют их конкурентно
+    (запросов в секунду);
+  * offload — run_in_executor с пустой функцией (накладные расходы выноса
+    блокирующей работы в пул потоков, размер пула — --executor-workers).
+Недоступные варианты (пакет не установлен) пропускаются.
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+VARIANTS = ("asyncio", "nest_asyncio", "uvloop")
+
+
+async def bench_switches(tasks, messages):
+    queues = [asyncio.Queue() for _ in range(tasks)]
+
+    async def relay(inbox, outbox):
+        while True:
+            item = await inbox.get()
+            if item is None:
+                await outbox.put(None)
+                return
+            await outbox.put(item)
+
+    # Кольцо задач: сообщение обходит их все
+    workers = [asyncio.create_task(relay(queues[i], queues[(i + 1) % tasks])) for i in range(1, tasks)]
+    t0 = time.perf_counter()
+    for i in range(messages):
+        await queues[1 % tasks].put(i)
+        await queues[0].get()
+    elapsed = time.perf_counter() - t0
+    await queues[1 % tasks].put(None)
+    await asyncio.gather(*workers)
+    return messages * tasks / elapsed
+
+
+async def bench_requests(clients, requests_total, payload=256):
+    async def handle(reader, writer):
+        # Заглушка API: на каждую строку запроса — строка ответа
+        while line := await reader.readline():
+            writer.write(line)
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    body = b"x" * payload + b"\n"
+    per_client = requests_total // clients
+
+    async def client():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for _ in range(per_client):
+            writer.write(body)
+            await writer.drain()
+            await reader.readline()
+        writer.close()
+        await writer.wait_closed()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - t0
+    server.close()
+    await server.wait_closed()
+    return per_client * clients / elapsed
+
+
+async def bench_offload(calls, concurrency):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call():
+        async with semaphore:
+            await loop.run_in_executor(None, int)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(call() for _ in range(calls)))
+    return calls / (time.perf_counter() - t0)
+
+
+async def run_all(args):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=args.executor_workers))
+    return {
+        "switches": await bench_switches(args.tasks, args.messages),
+        "requests": await bench_requests(args.clients, args.requests),
+        "offload": await bench_offload(args.offload_calls, args.executor_workers),
+    }
+
+
+def run_variant(variant, args):
+    """Один вариант в этом процессе; None — пакет не установлен"""
+    loop_factory = None
+    try:
+        if variant == "nest_asyncio":
+            import nest_asyncio
+        elif variant == "uvloop":
+            import uvloop
+            loop_factory = uvloop.new_event_loop
+    except ImportError:
+        return None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        if variant == "nest_asyncio":
+            nest_asyncio.apply(runner.get_loop())
+        return runner.run(run_all(args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument("--tasks", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=2_000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=50_000)
+    parser.add_argument("--offload-calls", type=int, default=50_000)
+    parser.add_argument("--executor-workers", type=int, default=32)
+    parser.add_argument("--worker", choices=VARIANTS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_variant(args.worker, args)))
+        return
+
+    passthrough = sys.argv[1:]
+    results = {}
+    for variant in args.variants:
+        out = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_event_loop", *passthrough, "--worker", variant],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        results[variant] = json.loads(out.strip().splitlines()[-1])
+
+    base = results.get("asyncio")
+    print(f"{'variant':>14} {'switches/s':>14} {'requests/s':>12} {'offload/s':>12}")
+    for variant, result in results.items():
+        if result is None:
+            print(f"{variant:>14}   not installed")
+            continue
+        row = f"{variant:>14} {result['switches']:>14,.0f} {result['requests']:>12,.0f} {result['offload']:>12,.0f}"
+        if base and variant != "asyncio":
+            row += "   (" + ", ".join(
+                f"{key} x{result[key] / base[key]:.2f}" for key in ("switches", "requests", "offload")
+            ) + ")"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
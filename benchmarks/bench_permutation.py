@@ -0,0 +1,72 @@
+"""
+Сравнение хранимого порядка (MEME_ORDER) и seeded-перестановки Фейстеля.
+
+Запуск (MongoDB не нужна):
+    python -m benchmarks.bench_permutation --sizes 10000 100000 1000000
+
+Для каждого размера библиотеки меряется:
+  * новый цикл: array — np.random.permutation + упаковка в int32 (то, что
+    пишется в bot_state при каждом обороте); seeded — только новый seed;
+  * выдача следующего ID по позиции (мемов в секунду);
+  * объём хранимого состояния.
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from source.permutation import FeistelPermutation
+
+
+def bench_array(size, lookups):
+    ids = np.arange(size, dtype=np.int32)
+    t0 = time.perf_counter()
+    order = np.random.permutation(ids)
+    blob = order.astype("<i4").tobytes()
+    cycle = time.perf_counter() - t0
+
+    decoded = np.frombuffer(blob, dtype="<i4")
+    t0 = time.perf_counter()
+    for pos in range(lookups):
+        int(decoded[pos % size])
+    lookup = time.perf_counter() - t0
+    return cycle, lookups / lookup, len(blob)
+
+
+def bench_seeded(size, lookups):
+    t0 = time.perf_counter()
+    perm = FeistelPermutation(size, random.getrandbits(63))
+    cycle = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for pos in range(lookups):
+        perm[pos % size]
+    lookup = time.perf_counter() - t0
+    # seed + pos + domain
+    return cycle, lookups / lookup, 3 * 8
+
+
+def check_bijection(size, seed=42):
+    perm = FeistelPermutation(size, seed)
+    assert sorted(perm[i] for i in range(size)) == list(range(size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--lookups", type=int, default=200_000)
+    args = parser.parse_args()
+
+    check_bijection(min(args.sizes[0], 50_000))
+
+    print(f"{'size':>10} | {'mode':>6} | {'new cycle, ms':>13} | {'lookups/s':>12} | {'state, bytes':>12}")
+    for size in args.sizes:
+        for name, bench in (("array", bench_array), ("seeded", bench_seeded)):
+            cycle, rate, state = bench(size, args.lookups)
+            print(f"{size:>10} | {name:>6} | {cycle * 1000:>13.2f} | {rate:>12,.0f} | {state:>12,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,15 @@ import logging
 import os
 import yaml
 import datetime
-from telegram import Update, InputFile
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, ChatMemberHandler
+from telegram import Update, InputFile, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultCachedPhoto, InputMediaPhoto
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, ChatMemberHandler, CallbackQueryHandler, InlineQueryHandler
 
 import zipfile
 import tempfile
 import asyncio
-import nest_asyncio
+import functools
+import multiprocessing
+import signal
 import socket
 import requests
 import base64
@@ -16,40 +18,59 @@ from io import BytesIO
 
 # Импорт модулей для работы с мемами и MongoDB
 from source import meme_manager
-from source.mongo_manager import MongoManager
+from source import webhook
+from source import maintenance
+from source import profiling
+from source import log_setup
+from source import runtime
+from source.send_queue import outbox
+from source import broadcast
+from source import ocr
+from source import image_integrity
+from source import degraded
+from source.mongo_manager import normalize_tags
 
 BOT_VERSION = "v4.4: MongoDB integration. Hotfix/MEME_ORDER add new memes everytime"
 
 # --- Логирование ---
 LOG_FILE = os.getcwd() + "/log/log.log"
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Очередь + отдельный поток записи; параметры уточняются в load_config()
+log_setup.setup_logging(LOG_FILE)
 
 logger = logging.getLogger(__name__)
 
 # --- Глобальные переменные ---
 CONFIG_PATH = os.path.join(os.getcwd(), "config.yaml")
-EDITORS = set()
 CONTROL_PANEL_URL = None
 CONTROL_PANEL_PORT = 8501
 CONFIG = {}
 MEMES_FOLDER = ""
 ADMINS = set()
-ALLOW_USER_ADD = True
+# Режим получения обновлений: polling | webhook
+BOT_MODE = "polling"
+WEBHOOK_CONFIG = {}
+CONCURRENT_UPDATES = 8
+# Интервалы фоновых задач (см. source/maintenance.py)
+MAINTENANCE_CONFIG = {}
+# Лимиты очереди исходящих сообщений (см. source/send_queue.py)
+SEND_QUEUE_CONFIG = {}
+# Сколько секунд альбом должен не пополняться, чтобы считаться собранным
+ALBUM_QUIET_SECONDS = 1.5
+# Сколько тегов показывает /tags
+TAGS_LIST_LIMIT = 50
+# Сколько мемов присылает /search (альбом Telegram — не больше 10)
+SEARCH_RESULTS = 5
+# Event loop и пул потоков процесса (см. source/runtime.py)
+RUNTIME_CONFIG = {}
+# Ежедневная рассылка мема дня (см. source/broadcast.py)
+BROADCAST_CONFIG = {}
+# Инлайн-режим: сколько мемов на страницу и сколько секунд Telegram кеширует ответ
+INLINE_PAGE_SIZE = 50
+INLINE_CACHE_TIME = 300
 # Глобальные переменные MEMES_DAY, MEMES_LIST, MEME_INDEX, MEME_ORDER, LAST_MEMES_COUNT
 # теперь хранятся в MongoDB через meme_manager и mongo_manager
 
-async def ensure_memes_count_async():
-    """Асинхронная оболочка над ensure_memes_count_is_actual()."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, meme_manager.ensure_memes_count_is_actual)
 
 def get_server_ip():
     try:
@@ -72,29 +93,72 @@ def save_config(path=CONFIG_PATH):
         logger.error(f"Failed to save config: {e}")
 
 # --- Обновление конфига ---
-def load_config(path=CONFIG_PATH):
-    global CONFIG, MEMES_FOLDER, ADMINS, EDITORS, CONTROL_PANEL_URL, CONTROL_PANEL_PORT
+def load_config(path=CONFIG_PATH, worker_id=None):
+    global CONFIG, MEMES_FOLDER, ADMINS, CONTROL_PANEL_URL, CONTROL_PANEL_PORT
+    global BOT_MODE, WEBHOOK_CONFIG, CONCURRENT_UPDATES, MAINTENANCE_CONFIG, SEND_QUEUE_CONFIG
+    global INLINE_PAGE_SIZE, INLINE_CACHE_TIME, BROADCAST_CONFIG, SEARCH_RESULTS, RUNTIME_CONFIG
     with open(path, 'r', encoding='utf-8') as f:
         CONFIG = yaml.safe_load(f) or {}
     MEMES_FOLDER = os.getcwd() + CONFIG.get('memes_folder', '/memes')
     ADMINS.update(CONFIG.get('admins', []))
-    EDITORS.update(CONFIG.get('editors', []))
+    # Редакторы из конфига дополняют общий для процессов список в bot_state
+    meme_manager.mongo.add_editors(CONFIG.get('editors', []) or [])
     CONTROL_PANEL_URL = CONFIG.get('control_panel_url', "") or None
     CONTROL_PANEL_PORT = int(CONFIG.get('control_panel_port', 8501))
+    BOT_MODE = CONFIG.get('mode', 'polling')
+    WEBHOOK_CONFIG = CONFIG.get('webhook', {}) or {}
+    CONCURRENT_UPDATES = int(CONFIG.get('concurrent_updates', 8))
+    MAINTENANCE_CONFIG = CONFIG.get('maintenance', {}) or {}
+    SEND_QUEUE_CONFIG = CONFIG.get('send_queue', {}) or {}
+    BROADCAST_CONFIG = CONFIG.get('broadcast', {}) or {}
+    RUNTIME_CONFIG = CONFIG.get('runtime', {}) or {}
+    ocr.configure(CONFIG.get('ocr', {}) or {})
+    image_integrity.configure(CONFIG.get('image_verify', {}) or {})
+    SEARCH_RESULTS = max(1, min(int(CONFIG.get('search_results', 5)), 10))
+    inline_config = CONFIG.get('inline', {}) or {}
+    # Telegram отдаёт не больше 50 результатов на страницу
+    INLINE_PAGE_SIZE = min(int(inline_config.get('page_size', 50)), 50)
+    INLINE_CACHE_TIME = int(inline_config.get('cache_time', 300))
+    logging_config = CONFIG.get('logging', {}) or {}
+    log_setup.setup_logging(
+        os.getcwd() + "/" + logging_config['file'] if logging_config.get('file') else LOG_FILE,
+        level=logging_config.get('level', 'INFO'),
+        max_mb=logging_config.get('max_mb', 20),
+        backup_count=logging_config.get('backup_count', 5),
+        json_format=logging_config.get('json', False),
+        sampling=logging_config.get('sampling', {}),
+        # Несколько webhook процессов: у каждого свой файл лога
+        worker_id=worker_id if BOT_MODE == "webhook" and int(WEBHOOK_CONFIG.get('workers', 1)) > 1 else None,
+    )
+    profiling_config = CONFIG.get('profiling', {}) or {}
+    profiling.configure(
+        profiling_config.get('enabled', False),
+        profiling_config.get('slow_call_ms', profiling.SLOW_CALL_MS)
+    )
     if not os.path.exists(MEMES_FOLDER):
         os.makedirs(MEMES_FOLDER)
     # Устанавливаем папку с мемами в meme_manager
     meme_manager.set_memes_folder(MEMES_FOLDER)
+    meme_manager.set_order_mode(CONFIG.get('order_mode', 'array'))
+    meme_manager.set_per_chat_rotation(CONFIG.get('per_chat_rotation', False))
+    meme_manager.set_day_timezone(CONFIG.get('day_timezone', 'UTC'))
+    meme_manager.set_degraded_mode(CONFIG.get('degraded', {}) or {})
+    popularity_config = CONFIG.get('popularity', {}) or {}
+    meme_manager.set_selection_strategy(
+        CONFIG.get('selection_strategy', 'shuffle'),
+        popularity_config.get('like_weight', meme_manager.popularity.DEFAULT_LIKE_WEIGHT),
+    )
     # Синхронизируем файлы из папки с БД при загрузке конфига
     # meme_manager.sync_memes_with_db()
-    logger.info(f"Config loaded. Memes folder: {MEMES_FOLDER}. Admins: {ADMINS}. Editors: {EDITORS}")
+    logger.info(f"Config loaded. Memes folder: {MEMES_FOLDER}. Admins: {ADMINS}.")
 
 # --- Проверки прав ---
 def is_admin(username: str) -> bool:
     return username in ADMINS
 
 def is_editor(username: str) -> bool:
-    return username in EDITORS
+    # Список меняется командами в любом процессе бота — читается из bot_state
+    return username in meme_manager.mongo.get_editors()
 
 def is_admin_or_editor(username: str) -> bool:
     return is_admin(username) or is_editor(username)
@@ -103,6 +167,30 @@ def is_admin_or_editor(username: str) -> bool:
 # теперь находятся в source/meme_manager.py
 
 
+# --- Запросы к MongoDB из хендлеров ---
+async def data_call(func, *args, **kwargs):
+    """
+    Запрос к Mongo из хендлера: в пуле потоков (event loop не ждёт медленную
+    Mongo) и через breaker деградированного режима. Если Mongo недоступна —
+    DataLayerUnavailable, на неё отвечает on_error.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(meme_manager.call_data_layer, func, *args, **kwargs)
+    )
+
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Ошибки хендлеров: недоступность Mongo — вежливый ответ, остальное — в лог"""
+    if isinstance(context.error, degraded.DataLayerUnavailable):
+        logger.warning(f"Handler skipped, data layer unavailable: {context.error}")
+        if isinstance(update, Update) and update.message:
+            await outbox.send(update.effective_chat.id, update.message.reply_text,
+                              "⏳ База мемов сейчас недоступна, попробуйте чуть позже.",
+                              disable_notification=True)
+        return
+    logger.error(f"Update handler failed: {context.error}", exc_info=context.error)
+
+
 # --- Экспорт мемов в zip ---
 def create_memes_zip():
     temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix=".zip")
@@ -114,27 +202,44 @@ def create_memes_zip():
     return temp_zip.name
 
 # --- Команды ---
+@profiling.timed_handler
 async def export_memes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /export_memes — только новое с прошлого экспорта (+ manifest.json с удалёнными),
+    /export_memes full — полный архив.
+    """
     user = update.effective_user
     username = f"{user.username}" if user.username else user.name
 
     if username in list(ADMINS):
-        zip_path = meme_manager.create_memes_zip_from_db_stream()
+        full = bool(context.args) and context.args[0].lower() == "full"
+        loop = asyncio.get_running_loop()
+        watermark = None if full else await loop.run_in_executor(None, meme_manager.mongo.get_export_watermark)
+        zip_path, new_watermark, manifest = await loop.run_in_executor(
+            None, meme_manager.create_memes_zip_from_db_stream, watermark
+        )
         try:
+            if watermark and not manifest["memes"] and not manifest["deleted"]:
+                await update.message.reply_text("Нового с прошлого экспорта нет.", disable_notification=True)
+                return
             with open(zip_path, 'rb') as f:
                 await update.message.reply_document(
                     document=f,
-                    filename="memes.zip",
+                    filename=os.path.basename(zip_path),
+                    caption=f"{'Полный' if manifest['type'] == 'full' else 'Инкрементальный'} экспорт: "
+                            f"мемов {manifest['memes']}, удалено {len(manifest['deleted'])}",
                     disable_notification=True
                 )
+            # Отметку двигаем только после успешной отправки архива
+            await loop.run_in_executor(None, meme_manager.mongo.set_export_watermark, new_watermark)
         finally:
             os.remove(zip_path)
     else:
         await update.message.reply_text("⛔ Эта команда доступна только администраторам.", disable_notification=True)
 
+@profiling.timed_handler
 async def meme_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await ensure_memes_count_async()   # NEW
-    count = meme_manager.get_meme_count()
+    count = await data_call(meme_manager.get_meme_count)
     await update.message.reply_text(f"Сейчас доступно {count} мемов.", disable_notification=True)
 
 
@@ -143,8 +248,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Привет! Я бот для мемов.\n"
         "Команды:\n"
         "/random_meme - случайный мем\n"
+        "/random_meme <тег> - случайный мем с тегом\n"
+        "/tags - список тегов\n"
         "/meme_of_the_day - мем дня\n"
-        "В личке можно прислать мем, чтобы добавить в библиотеку.",
+        "В личке можно прислать мем, чтобы добавить в библиотеку (#хэштеги в подписи станут тегами).",
         disable_notification=True
     )
 
@@ -153,10 +260,16 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Команды:\n"
         "/random_meme - случайный мем\n"
+        "/random_meme <тег> - случайный мем с тегом\n"
+        "/tags - список тегов\n"
         "/meme_of_the_day - мем дня\n"
         "/meme_count - количество мемов\n"
+        "/search <слова> - мемы с этими словами в подписи\n"
+        "@имя_бота <тег> в любом чате - выбрать мем\n"
+        "/subscribe - присылать мем дня в этот чат\n"
+        "/unsubscribe - отписаться от мема дня\n"
         "/help_admins - "
-        "В личке можно прислать мем, чтобы добавить в библиотеку.",
+        "В личке можно прислать мем, чтобы добавить в библиотеку (#хэштеги в подписи станут тегами).",
         disable_notification=True
     )
 
@@ -165,90 +278,160 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def help_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Админские и редакторские команды:\n"
-        "/export_memes - экспортировать все мемы\n"
+        "/export_memes - экспортировать новые мемы с прошлого экспорта\n"
+        "/export_memes full - экспортировать все мемы\n"
+        "/import_memes - импортировать мемы из ZIP (в подписи к архиву или ответом на него)\n"
+        "/broadcast_now - разослать мем дня подписчикам сейчас\n"
+        "/broadcast_status - прогресс сегодняшней рассылки\n"
+        "/verify_images - проверить новые и непроверенные картинки (full - всю библиотеку)\n"
         "/add_editor <username> - добавить редактора\n"
         "/remove_editor <username> - удалить редактора\n"
         "/control_panel - ссылка на панель мемов\n"
         "/lock_mem_add - запретить добавление мемов пользователям\n"
         "/unlock_mem_add - разрешить добавление мемов пользователям\n"
         "/shuffle_memes - перемешать все мемы\n"
+        "/profile <секунды> - профиль бота (flamegraph)\n"
         "/version - версия бота",
         disable_notification=True
     )
 
+def like_keyboard(meme_id):
+    """Кнопка 👍 под мемом (реакций в этой версии Bot API нет)"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("👍", callback_data=f"like:{meme_id}")]])
+
+
+@profiling.timed_handler
 async def random_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # meme_manager.ensure_memes_count_is_actual()
-    await ensure_memes_count_async()   # NEW
-    image, meme_id = meme_manager.get_random_meme()
-    await update.message.reply_photo(
+    chat_id = update.effective_chat.id
+    # /random_meme <тег> — из пула тега
+    tags = normalize_tags([" ".join(context.args or [])])
+    tag = tags[0] if tags else None
+    # В пуле потоков: медленная Mongo не останавливает event loop
+    image, meme_id = await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(meme_manager.get_random_meme, chat_id=chat_id, tag=tag)
+    )
+    if image is None:
+        text = f"Мемов с тегом «{tag}» нет :(" if tag else "Мемы не найдены :("
+        await outbox.send(chat_id, update.message.reply_text, text, disable_notification=True)
+        return
+    # Через очередь: при 429 отправка повторится, и выданный мем не потеряется
+    message = await outbox.send(
+        chat_id, update.message.reply_photo,
         photo=image,
+        reply_markup=like_keyboard(meme_id),
         disable_notification=True
     )
+    if message and message.photo:
+        await asyncio.get_running_loop().run_in_executor(
+            None, meme_manager.remember_file_id, meme_id, message.photo[-1].file_id
+        )
 
 
-async def meme_of_the_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await ensure_memes_count_async()   # NEW
+async def like_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """👍 под мемом: счётчик копится в памяти и уходит в Mongo пачкой"""
+    query = update.callback_query
+    try:
+        meme_id = int(query.data.split(":", 1)[1])
+    except (IndexError, ValueError):
+        await query.answer()
+        return
+    # Сообщение с кнопкой: чат и номер, у инлайн-сообщений — свой ID
+    if query.message:
+        message_key = f"{query.message.chat.id}:{query.message.message_id}"
+    else:
+        message_key = query.inline_message_id
+    counted = await asyncio.get_running_loop().run_in_executor(
+        None, meme_manager.record_like, meme_id, message_key, query.from_user.id
+    )
+    await query.answer("👍 Спасибо!" if counted else "Уже учтено")
+
 
+@profiling.timed_handler
+async def meme_of_the_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    image = meme_manager.get_user_meme_of_the_day(user_id)
+    chat_id = update.effective_chat.id
+    image = await asyncio.get_running_loop().run_in_executor(None, meme_manager.get_user_meme_of_the_day, user_id)
     if not image:
-        await update.message.reply_text("Мемы не найдены :(", disable_notification=True)
+        await outbox.send(chat_id, update.message.reply_text, "Мемы не найдены :(", disable_notification=True)
         return
-    await update.message.reply_photo(photo=image, disable_notification=True)
+    await outbox.send(chat_id, update.message.reply_photo, photo=image, disable_notification=True)
+
 
+def caption_tags(message):
+    """Хэштеги из подписи к фото"""
+    caption = message.caption or ""
+    return normalize_tags(word for word in caption.split() if word.startswith("#"))
 
+
+@profiling.timed_handler
 async def add_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ALLOW_USER_ADD
     user = update.effective_user
     chat = update.effective_chat
 
     if chat.type != 'private':
         return
 
-    if not is_admin(user.username) and not ALLOW_USER_ADD:
-        await update.message.reply_text("Добавление мемов отключено для обычных пользователей.", 
-                                        disable_notification=True)
+    if not is_admin(user.username) and not await data_call(meme_manager.mongo.is_user_add_allowed):
+        await outbox.send(chat.id, update.message.reply_text, "Добавление мемов отключено для обычных пользователей.",
+                          disable_notification=True)
         return
 
     if not update.message.photo:
-        await update.message.reply_text("Пожалуйста, отправьте мем в виде картинки.", 
-                                        disable_notification=True)
+        await outbox.send(chat.id, update.message.reply_text, "Пожалуйста, отправьте мем в виде картинки.",
+                          disable_notification=True)
         return
 
     media_group_id = update.message.media_group_id
+    # Хэштеги из подписи становятся тегами мема
+    tags = caption_tags(update.message)
+    # Кто прислал мем — для фильтра в панели модерации
+    user = update.effective_user
+    uploader = (user.username or str(user.id)) if user else None
 
     # ---------------- Альбом ----------------
     if media_group_id:
-        if "pending_photos" not in context.chat_data:
-            context.chat_data["pending_photos"] = {}
-        if media_group_id not in context.chat_data["pending_photos"]:
-            context.chat_data["pending_photos"][media_group_id] = []
-
-        context.chat_data["pending_photos"][media_group_id].append(update.message)
-
-        await asyncio.sleep(1.5)
-
-        photo_msgs = context.chat_data["pending_photos"].pop(media_group_id, [])
-        saved_count = 0
-
-        for msg in photo_msgs:
-            try:
-                photo = msg.photo[-1]
-                file = await photo.get_file()   
+        # Сообщения альбома могут прийти в разные процессы бота (webhook workers),
+        # поэтому альбом собирается в Mongo: каждый сохраняет свою картинку,
+        # а сводку делает тот, кто застанет альбом собранным
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, meme_manager.mongo.start_album_photo, media_group_id, chat.id)
+        meme_id = None
+        try:
+            photo = update.message.photo[-1]
+            file = await photo.get_file()
 
-                # --- загрузка в память ---
-                data: bytearray = await file.download_as_bytearray()
-                image_base64 = base64.b64encode(data).decode("utf-8")
+            # --- загрузка в память ---
+            data: bytearray = await file.download_as_bytearray()
+            image_base64 = base64.b64encode(data).decode("utf-8")
 
-                # --- запись в БД ---
-                meme_manager.mongo.add_meme_base64(image_base64)
+            # --- запись в БД ---
+            meme_id = await loop.run_in_executor(None, functools.partial(
+                meme_manager.mongo.add_meme_base64, image_base64, uploader=uploader, file_id=photo.file_id,
+                tags=tags
+            ))
+            ocr.submit(meme_id, bytes(data))
+        except Exception as e:
+            logger.error(f"Failed to save meme from album: {e}")
+        finally:
+            await loop.run_in_executor(
+                None, meme_manager.mongo.finish_album_photo, media_group_id, meme_id, tags
+            )
 
-                saved_count += 1
-            except Exception as e:
-                logger.error(f"Failed to save meme from album: {e}")
+        await asyncio.sleep(ALBUM_QUIET_SECONDS)
+        album = await loop.run_in_executor(
+            None, meme_manager.mongo.claim_album, media_group_id, ALBUM_QUIET_SECONDS
+        )
+        if album is None:
+            # Альбом ещё пополняется (сводку сделает последний) или сводка уже отправлена
+            return
+        saved_ids = album.get("meme_ids", [])
+        # Подпись альбома Telegram прикрепляет к одному из сообщений — теги для всех
+        if saved_ids and album.get("tags"):
+            await loop.run_in_executor(None, meme_manager.mongo.add_tags, saved_ids, album["tags"])
 
-        await update.message.reply_text(f"✅ Добавлено {saved_count} мемов из альбома. Спасибо 😊",
-                                        disable_notification=True)
+        await outbox.send(chat.id, update.message.reply_text,
+                          f"✅ Добавлено {len(saved_ids)} мемов из альбома. Спасибо 😊",
+                          disable_notification=True)
 
     else:
         # ---------------- Одиночное изображение ----------------
@@ -261,39 +444,38 @@ async def add_meme(update: Update, context: ContextTypes.DEFAULT_TYPE):
             image_base64 = base64.b64encode(data).decode("utf-8")
 
             # --- запись в БД ---
-            meme_manager.mongo.add_meme_base64(image_base64)
+            meme_id = await data_call(
+                meme_manager.mongo.add_meme_base64, image_base64, uploader=uploader, file_id=photo.file_id,
+                tags=tags
+            )
+            ocr.submit(meme_id, bytes(data))
 
             logger.info("Saved meme to DB (base64)")
 
         except Exception as e:
             logger.error(f"Failed to save meme: {e}")
-            await update.message.reply_text("❌ Ошибка при сохранении мема.", 
-                                            disable_notification=True)
+            await outbox.send(chat.id, update.message.reply_text, "❌ Ошибка при сохранении мема.",
+                              disable_notification=True)
             return
 
-        await update.message.reply_text("✅ Мем успешно добавлен! Спасибо 😊", 
-                                        disable_notification=True)
-
-    # Проверяем количество мемов
-    await ensure_memes_count_async()
+        await outbox.send(chat.id, update.message.reply_text, "✅ Мем успешно добавлен! Спасибо 😊",
+                          disable_notification=True)
 
 
 async def lock_mem_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ALLOW_USER_ADD
     user = update.effective_user
     if not is_admin(user.username):
         await update.message.reply_text("Команда доступна только администраторам.", disable_notification=True)
         return
-    ALLOW_USER_ADD = False
+    await data_call(meme_manager.mongo.set_user_add_allowed, False)
     await update.message.reply_text("Добавление мемов отключено для обычных пользователей.", disable_notification=True)
 
 async def unlock_mem_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ALLOW_USER_ADD
     user = update.effective_user
     if not is_admin(user.username):
         await update.message.reply_text("Команда доступна только администраторам.", disable_notification=True)
         return
-    ALLOW_USER_ADD = True
+    await data_call(meme_manager.mongo.set_user_add_allowed, True)
     await update.message.reply_text("Добавление мемов разрешено для всех.", disable_notification=True)
 
 async def version(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -301,9 +483,9 @@ async def version(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --- Перемешивание мемов (для админов) ---
+@profiling.timed_handler
 async def shuffle_memes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для перемешивания всех мемов (доступна только админам)"""
-    await ensure_memes_count_async()
     user = update.effective_user
     username = user.username if user.username else user.name
     if not is_admin(username):
@@ -311,13 +493,262 @@ async def shuffle_memes(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        meme_manager.shuffle_meme_order(admin_shuffle=True)
+        # В пуле потоков, но без ограничения времени breaker: полный проход по библиотеке
+        await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(meme_manager.shuffle_meme_order, admin_shuffle=True)
+        )
         await update.message.reply_text("✅ Все мемы перемешаны!", disable_notification=True)
     except Exception as e:
         logger.error(f"Failed to shuffle memes: {e}")
         await update.message.reply_text("❌ Ошибка при перемешивании мемов.", disable_notification=True)
 
 
+async def tags_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Теги, по которым работает /random_meme <тег>"""
+    chat_id = update.effective_chat.id
+    pools = await asyncio.get_running_loop().run_in_executor(None, meme_manager.mongo.list_tag_pools)
+    if not pools:
+        text = "Тегов пока нет."
+    else:
+        text = "Теги:\n" + "\n".join(f"{tag} — {count}" for tag, count in pools[:TAGS_LIST_LIMIT])
+    await outbox.send(chat_id, update.message.reply_text, text, disable_notification=True)
+
+
+# --- Поиск по тексту на мемах ---
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Мемы, в подписи которых есть слова запроса (по распознанному OCR тексту)"""
+    chat_id = update.effective_chat.id
+    text = " ".join(context.args or []).strip()
+    if not text:
+        await outbox.send(chat_id, update.message.reply_text, "Использование: /search <слова из подписи>",
+                          disable_notification=True)
+        return
+    loop = asyncio.get_running_loop()
+    # Только метаданные по текстовому индексу — картинки не читаются
+    docs, _ = await loop.run_in_executor(None, meme_manager.mongo.search_memes, text, SEARCH_RESULTS)
+    found = []
+    for doc in docs:
+        photo = doc.get("file_id")
+        if photo is None:
+            data = await loop.run_in_executor(None, meme_manager.mongo.get_meme_image, doc["_id"])
+            if data is None:
+                continue
+            photo = meme_manager.to_photo(data)
+        found.append((doc["_id"], photo))
+    if not found:
+        await outbox.send(chat_id, update.message.reply_text, "Ничего не найдено 🤷", disable_notification=True)
+        return
+
+    if len(found) == 1:
+        meme_id, photo = found[0]
+        messages = [await outbox.send(chat_id, update.message.reply_photo, photo=photo,
+                                      reply_markup=like_keyboard(meme_id), disable_notification=True)]
+    else:
+        media = [InputMediaPhoto(photo) for _, photo in found]
+        messages = await outbox.send(chat_id, update.message.reply_media_group, media=media,
+                                     disable_notification=True)
+    loop = asyncio.get_running_loop()
+    for (meme_id, _), message in zip(found, messages or []):
+        if message and message.photo:
+            await loop.run_in_executor(None, meme_manager.remember_file_id, meme_id, message.photo[-1].file_id)
+
+
+# --- Подписка на ежедневную рассылку ---
+async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    await data_call(meme_manager.mongo.subscribe_chat, chat.id, chat.type)
+    await update.message.reply_text("🔔 Чат подписан на мем дня. Отписаться: /unsubscribe", disable_notification=True)
+
+
+async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await data_call(meme_manager.mongo.unsubscribe_chats, [update.effective_chat.id], reason="command"):
+        await update.message.reply_text("🔕 Подписка отключена.", disable_notification=True)
+    else:
+        await update.message.reply_text("Чат и так не подписан.", disable_notification=True)
+
+
+async def broadcast_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запустить (или продолжить) сегодняшнюю рассылку, не дожидаясь расписания"""
+    user = update.effective_user
+    username = user.username if user.username else user.name
+    if not is_admin(username):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.", disable_notification=True)
+        return
+    subscribers = await data_call(meme_manager.mongo.count_subscriptions)
+    await update.message.reply_text(f"📣 Рассылка для {subscribers} чатов запущена.", disable_notification=True)
+    # В фоне: рассылка длится минуты, хендлер не должен её ждать
+    context.application.create_task(broadcast.run_broadcast(context.bot, config=BROADCAST_CONFIG))
+
+
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    username = user.username if user.username else user.name
+    if not is_admin(username):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.", disable_notification=True)
+        return
+    day = meme_manager.today()
+    state = await data_call(meme_manager.mongo.get_broadcast, day)
+    subscribers = await data_call(meme_manager.mongo.count_subscriptions)
+    if not state:
+        await update.message.reply_text(f"Сегодня рассылки не было. Подписчиков: {subscribers}.",
+                                        disable_notification=True)
+        return
+    await update.message.reply_text(
+        f"Рассылка {day}: {state['status']}, отправлено {state['sent']} из {state['total']}, "
+        f"ошибок {state['failed']}. Подписчиков: {subscribers}.",
+        disable_notification=True
+    )
+
+
+async def verify_images(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /verify_images — продолжить проверку картинок с сохранённой позиции,
+    /verify_images full — проверить всю библиотеку заново.
+    """
+    user = update.effective_user
+    username = user.username if user.username else user.name
+    if not is_admin(username):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.", disable_notification=True)
+        return
+    full = bool(context.args) and context.args[0].lower() == "full"
+    await update.message.reply_text("Проверяю картинки...", disable_notification=True)
+    report = await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(image_integrity.verify_library, restart=full)
+    )
+    if report is None:
+        await update.message.reply_text("Проверка уже идёт.", disable_notification=True)
+        return
+    await update.message.reply_text(
+        f"Проверено {report['checked']} мемов за {report['seconds']} с "
+        f"({report['memes_per_s']} мемов/с, {report['mb_per_s']} МБ/с): "
+        f"в порядке {report['ok']}, починено {report['repaired']}, "
+        f"в карантине {report['quarantined']} (корзина панели).",
+        disable_notification=True
+    )
+
+
+# --- Инлайн-режим: @bot в любом чате ---
+async def inline_memes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Страница мемов по уже известным Telegram file_id: картинки не передаются,
+    на запрос — одно чтение метаданных. Текст запроса — тег (пусто — все мемы).
+    """
+    query = update.inline_query
+    try:
+        before_id = int(query.offset) if query.offset else None
+    except ValueError:
+        before_id = None
+    # Как у /random_meme <тег>: «#Cats», «  cats » и «cats» — один тег
+    tags = normalize_tags([" ".join(query.query.split())])
+    tag = tags[0] if tags else None
+    page = await data_call(meme_manager.mongo.get_file_id_page, before_id, INLINE_PAGE_SIZE, tag=tag)
+    results = [
+        InlineQueryResultCachedPhoto(id=str(meme_id), photo_file_id=file_id)
+        for meme_id, file_id in page
+    ]
+    next_offset = str(page[-1][0]) if len(page) == INLINE_PAGE_SIZE else ""
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=False, next_offset=next_offset)
+
+
+# --- Импорт мемов из ZIP (для админов) ---
+# Больше этого Bot API не отдаёт боту через getFile
+IMPORT_MAX_ZIP_BYTES = 20 * 1024 * 1024
+IMPORT_SPOOL_BYTES = 5 * 1024 * 1024
+# Не чаще раза в столько секунд обновляем сообщение с прогрессом
+IMPORT_PROGRESS_INTERVAL = 3
+
+
+def format_import_stats(stats, done=False):
+    head = "✅ Импорт завершён" if done else "⏳ Импорт"
+    return (f"{head}: {stats['processed']}/{stats['total']} файлов, "
+            f"добавлено {stats['added']}, дубликатов {stats['duplicates']}, пропущено {stats['skipped']}")
+
+
+@profiling.timed_handler
+async def import_memes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /import_memes в подписи к ZIP архиву или ответом на сообщение с архивом.
+    Архив читается потоково, мемы пишутся пачками с дедупликацией по содержимому.
+    """
+    user = update.effective_user
+    username = user.username if user.username else user.name
+    if not is_admin(username):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.", disable_notification=True)
+        return
+
+    message = update.message
+    document = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if document is None or not (document.file_name or "").lower().endswith(".zip"):
+        await message.reply_text("Пришлите ZIP архив с подписью /import_memes "
+                                 "или ответьте этой командой на сообщение с архивом.", disable_notification=True)
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_ZIP_BYTES:
+        await message.reply_text("❌ Архив больше 20 МБ — загрузите его через панель.", disable_notification=True)
+        return
+
+    progress = await message.reply_text("⏳ Скачиваю архив...", disable_notification=True)
+    loop = asyncio.get_running_loop()
+    # Небольшой архив остаётся в памяти, крупный уходит во временный файл целиком — без распаковки
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_BYTES) as archive:
+        file = await document.get_file()
+        await file.download_to_memory(out=archive)
+        archive.seek(0)
+
+        stats = None
+        last_edit = 0.0
+        try:
+            batches = meme_manager.import_memes_zip(archive, uploader=username)
+            while True:
+                stats = await loop.run_in_executor(None, next, batches, None)
+                if stats is None:
+                    break
+                if loop.time() - last_edit >= IMPORT_PROGRESS_INTERVAL:
+                    last_edit = loop.time()
+                    await progress.edit_text(format_import_stats(stats))
+        except zipfile.BadZipFile:
+            await progress.edit_text("❌ Это не ZIP архив.")
+            return
+        except Exception as e:
+            logger.error(f"ZIP import failed: {e}")
+            await progress.edit_text("❌ Ошибка импорта" + (f" ({format_import_stats(stats)})" if stats else ""))
+            return
+
+    await progress.edit_text(format_import_stats(stats, done=True))
+
+
+# --- Профилирование (для админов) ---
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile <секунды>: сэмплирует стеки бота и присылает collapsed stacks для flamegraph"""
+    user = update.effective_user
+    username = user.username if user.username else user.name
+    if not is_admin(username):
+        await update.message.reply_text("⛔ Команда доступна только администраторам.", disable_notification=True)
+        return
+
+    try:
+        seconds = int(context.args[0]) if context.args else 10
+    except ValueError:
+        await update.message.reply_text("Использование: /profile <секунды>", disable_notification=True)
+        return
+    seconds = max(1, min(seconds, profiling.MAX_PROFILE_SECONDS))
+
+    await update.message.reply_text(f"⏱ Профилирую {seconds} с...", disable_notification=True)
+    loop = asyncio.get_running_loop()
+    try:
+        folded = await loop.run_in_executor(None, profiling.sample_stacks, seconds)
+    except RuntimeError as e:
+        await update.message.reply_text(f"❌ {e}", disable_notification=True)
+        return
+
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    await update.message.reply_document(
+        document=BytesIO(folded.encode("utf-8")),
+        filename=f"profile_{timestamp}.folded",
+        caption="Collapsed stacks: flamegraph.pl / speedscope.app",
+        disable_notification=True
+    )
+
+
 # --- Панель управления мемами ---
 async def control_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -332,7 +763,8 @@ async def control_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if not is_admin_or_editor(username):
+    allowed = await asyncio.get_running_loop().run_in_executor(None, is_admin_or_editor, username)
+    if not allowed:
         await update.message.reply_text(
             "⛔ Эта команда доступна только администраторам и редакторам.",
             disable_notification=True
@@ -368,12 +800,12 @@ async def add_editor_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Использование: /add_editor <username> (без @).", disable_notification=True)
         return
     new_editor = args[0].lstrip("@")
-    if new_editor in EDITORS:
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, meme_manager.mongo.add_editors, [new_editor]):
         await update.message.reply_text(f"{new_editor} уже в списке editors.", disable_notification=True)
         return
 
-    EDITORS.add(new_editor)
-    CONFIG['editors'] = sorted(list(EDITORS))
+    CONFIG['editors'] = sorted(await loop.run_in_executor(None, meme_manager.mongo.get_editors))
     save_config()
     await update.message.reply_text(f"✅ Пользователь {new_editor} добавлен в editors.", disable_notification=True)
 
@@ -391,20 +823,30 @@ async def remove_editor_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Использование: /remove_editor <username> (без @).", disable_notification=True)
         return
     editor_to_remove = args[0].lstrip("@")
-    if editor_to_remove not in EDITORS:
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, meme_manager.mongo.remove_editor, editor_to_remove):
         await update.message.reply_text(f"{editor_to_remove} не найден в списке editors.", disable_notification=True)
         return
 
-    EDITORS.remove(editor_to_remove)
-    CONFIG['editors'] = sorted(list(EDITORS))
+    CONFIG['editors'] = sorted(await loop.run_in_executor(None, meme_manager.mongo.get_editors))
     save_config()
     await update.message.reply_text(f"✅ Пользователь {editor_to_remove} удалён из editors.", disable_notification=True)
 
 
-async def main():
-    load_config()
+async def main(worker_id=0):
+    load_config(worker_id=worker_id)
     # load_memes_list() больше не нужна, синхронизация происходит в load_config()   // уже не происходит
-    application = ApplicationBuilder().token(CONFIG['token']).build()
+    builder = (
+        ApplicationBuilder()
+        .token(CONFIG['token'])
+        .concurrent_updates(CONCURRENT_UPDATES)
+    )
+    # Другой Bot API сервер (например, loadtest/fake_bot_api.py для нагрузочных тестов)
+    if CONFIG.get('bot_api_url'):
+        builder = builder.base_url(CONFIG['bot_api_url'])
+    if CONFIG.get('bot_api_file_url'):
+        builder = builder.base_file_url(CONFIG['bot_api_file_url'])
+    application = builder.build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help))
     application.add_handler(CommandHandler("help_admins", help_admins))
@@ -414,25 +856,97 @@ async def main():
     application.add_handler(CommandHandler("lock_mem_add", lock_mem_add))
     application.add_handler(CommandHandler("unlock_mem_add", unlock_mem_add))
     application.add_handler(CommandHandler("export_memes", export_memes))
+    application.add_handler(CommandHandler("import_memes", import_memes))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("zip") & filters.CaptionRegex(r"^/import_memes\b"), import_memes
+    ))
     application.add_handler(CommandHandler("version", version))
     application.add_handler(CommandHandler("add_editor", add_editor_cmd))
     application.add_handler(CommandHandler("remove_editor", remove_editor_cmd))
     application.add_handler(CommandHandler("control_panel", control_panel))
     application.add_handler(CommandHandler("shuffle_memes", shuffle_memes))
+    application.add_handler(CommandHandler("profile", profile_cmd))
     application.add_handler(MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, add_meme))
+    application.add_handler(CallbackQueryHandler(like_meme, pattern=r"^like:"))
+    application.add_handler(InlineQueryHandler(inline_memes))
+    application.add_handler(CommandHandler("search", search))
+    application.add_handler(CommandHandler("tags", tags_list))
+    application.add_handler(CommandHandler("subscribe", subscribe))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe))
+    application.add_handler(CommandHandler("broadcast_now", broadcast_now))
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status))
+    application.add_handler(CommandHandler("verify_images", verify_images))
+    application.add_error_handler(on_error)
+    maintenance.register_maintenance_jobs(application, MAINTENANCE_CONFIG, worker_id)
+    broadcast.register_broadcast_jobs(application, BROADCAST_CONFIG, worker_id)
+    # Общий лимит Telegram на бота делится между процессами
+    workers = int(WEBHOOK_CONFIG.get('workers', 1)) if BOT_MODE == "webhook" else 1
+    queue_config = dict(SEND_QUEUE_CONFIG)
+    queue_config['global_rate'] = float(queue_config.get('global_rate', 30)) / workers
+    outbox.configure(**queue_config)
     await application.initialize()
-    await application.start()
-    await application.updater.start_polling()
-    print("Bot is running")
+    # Кеши (и веса режима popular) готовы до первого апдейта
     try:
-        while True:
-            await asyncio.sleep(3600)
-    except (KeyboardInterrupt, SystemExit):
-        print("Stopping bot...")
-    await application.updater.stop_polling()
+        await asyncio.get_running_loop().run_in_executor(None, meme_manager.warm_up_caches)
+    except Exception as e:
+        logger.error(f"Cache warmup failed: {e}")
+    await application.start()
+    await outbox.start()
+    webhook_server = None
+    if BOT_MODE == "webhook":
+        # Регистрирует URL в Telegram только первый процесс
+        webhook_server = await webhook.start_webhook_server(
+            application, WEBHOOK_CONFIG, set_webhook=(worker_id == 0)
+        )
+    else:
+        await application.updater.start_polling()
+    logger.info(f"Bot is running ({BOT_MODE}, worker {worker_id})")
+    # До SIGINT/SIGTERM; дальше — упорядоченная остановка
+    await runtime.wait_for_stop()
+    logger.info("Stopping bot...")
+    if webhook_server is not None:
+        await webhook.stop_webhook_server(webhook_server)
+    else:
+        await application.updater.stop_polling()
     await application.stop()
+    await outbox.stop()
+    # Несброшенные счётчики популярности
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, meme_manager.flush_popularity)
+    except Exception as e:
+        logger.error(f"Failed to flush popularity counters: {e}")
+    ocr.shutdown()
+    image_integrity.shutdown()
     await application.shutdown()
 
+
+def run_worker(worker_id=0):
+    runtime.run(main(worker_id), RUNTIME_CONFIG)
+
+
+def run_webhook_workers(workers):
+    """Несколько процессов бота за одним портом (SO_REUSEPORT)"""
+    ctx = multiprocessing.get_context("fork")
+    processes = [ctx.Process(target=run_worker, args=(i,), daemon=False) for i in range(workers)]
+    for p in processes:
+        p.start()
+
+    # SIGTERM (docker stop) и Ctrl+C передаются процессам бота — каждый останавливается сам
+    def stop_workers(signum, frame):
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for p in processes:
+        p.join()
+
+
 if __name__ == '__main__':
-    nest_asyncio.apply()
-    asyncio.get_event_loop().run_until_complete(main())
+    load_config()
+    workers = int(WEBHOOK_CONFIG.get('workers', 1))
+    if BOT_MODE == "webhook" and workers > 1:
+        run_webhook_workers(workers)
+    else:
+        run_worker()
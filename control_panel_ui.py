@@ -1,10 +1,19 @@
 import os
+import threading
 from pathlib import Path
 import yaml
-from flask import Flask, render_template_string, request, jsonify, send_from_directory, abort, Response
+import json
+import zipfile
+import datetime
+from flask import Flask, render_template_string, request, jsonify, abort, Response, g, stream_with_context
 from werkzeug.utils import secure_filename
 import base64
-from source.mongo_manager import MongoManager
+from source.mongo_manager import MongoManager, MEME_SORTS, normalize_tags
+from source.meme_manager import import_memes_zip
+from source.image_info import base64_decoded_size, detect_mimetype
+from source.image_cache import get_image_cache
+from source import profiling
+from source import log_setup
 
 # ------------------ НАСТРОЙКИ ------------------
 
@@ -20,21 +29,55 @@ FLASK_HOST = "0.0.0.0"
 FLASK_PORT = config.get("control_panel_port", 8501)   # <-- читаем YAML
 DEBUG = True
 
-MEMES_FOLDER = Path("memes")
-MEMES_FOLDER.mkdir(exist_ok=True)
+# Логи панели — в консоль (их собирает docker), без блокировки потоков запросов
+LOGGING_CONFIG = config.get("logging", {}) or {}
+log_setup.setup_logging(
+    level=LOGGING_CONFIG.get("level", "INFO"),
+    json_format=LOGGING_CONFIG.get("json", False),
+    sampling=LOGGING_CONFIG.get("sampling", {}),
+)
+
+# Профилирование: медленные запросы в лог, /api/profile только с токеном
+PROFILING_CONFIG = config.get("profiling", {}) or {}
+PROFILING_TOKEN = PROFILING_CONFIG.get("token", "")
+profiling.configure(
+    PROFILING_CONFIG.get("enabled", False),
+    PROFILING_CONFIG.get("slow_call_ms", profiling.SLOW_CALL_MS),
+)
 
 IMAGES_PER_ROW = 8
 ROWS_ON_SCREEN = 10
 THUMBNAILS_PER_PAGE = IMAGES_PER_ROW * ROWS_ON_SCREEN
 
 ALLOWED_EXT = {".png", ".jpg", ".jpeg", ".gif", ".webp"}
-SORT_BY_MTIME_DESC = True
+DEFAULT_SORT = "new"
+
+# Отдача картинок: размер куска ответа и сколько промахов кеша картинок
+# одновременно грузим из Mongo. Остальные запросы ждут слот,
+# а не раздувают память и не отнимают потоки у API.
+IMAGE_STREAM_CHUNK = 64 * 1024
+IMAGE_STREAM_SLOTS = int(os.getenv("PANEL_IMAGE_SLOTS", "8"))
+IMAGE_CACHE_MAX_AGE = 3600
+
+# Максимум мемов в одной пакетной операции панели
+BATCH_MAX_IDS = 1000
 
 mongo = MongoManager()
+image_slots = threading.BoundedSemaphore(IMAGE_STREAM_SLOTS)
 # ------------------------------------------------
 
 app = Flask(__name__)
-app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # до 50 МБ на загрузку
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("PANEL_MAX_UPLOAD_MB", "500")) * 1024 * 1024  # загрузки и ZIP импорт
+
+
+@app.before_request
+def _start_timing():
+    g.profiling = profiling.start_call()
+
+
+@app.teardown_request
+def _finish_timing(exc):
+    profiling.finish_call(f"{request.method} {request.path}", g.pop("profiling", None))
 
 
 # ------------------ Утилиты ------------------
@@ -42,14 +85,39 @@ def allowed_file(filename):
     return Path(filename).suffix.lower() in ALLOWED_EXT
 
 
-def list_images_sorted():
-    """Список файлов из папки, отсортированный по дате"""
-    files = []
-    for p in MEMES_FOLDER.iterdir():
-        if p.is_file() and allowed_file(p.name) and not p.name.startswith(".thumb_"):
-            files.append((p.name, p.stat().st_mtime))
-    files.sort(key=lambda x: x[1], reverse=SORT_BY_MTIME_DESC)
-    return [f for f, _ in files]
+def encode_cursor(after):
+    """(значение ключа сортировки, _id) -> строка курсора для клиента"""
+    value, last_id = after
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return f"{'' if value is None else value}|{last_id}"
+
+
+def decode_cursor(cursor, sort):
+    """Обратное encode_cursor; ValueError при мусоре"""
+    value, _, last_id = cursor.rpartition("|")
+    field = MEME_SORTS[sort][0]
+    if value == "" or field is None:
+        value = None
+    elif field == "created_at":
+        value = datetime.datetime.fromisoformat(value)
+    else:
+        value = int(value)
+    return value, int(last_id)
+
+
+def meme_info(doc):
+    created_at = doc.get("created_at")
+    return {
+        "id": doc["_id"],
+        "created_at": created_at.isoformat() if created_at else None,
+        "uploader": doc.get("uploader"),
+        "size": doc.get("size"),
+        "format": doc.get("format"),
+        "tags": doc.get("tags", []),
+        "text": doc.get("ocr_text"),
+        "quarantine": doc.get("quarantine_reason"),
+    }
 
 
 # ------------------ HTML шаблон ------------------
@@ -95,6 +163,11 @@ HTML = """
   @media (max-width: 480px) {
     .grid { grid-template-columns: repeat(1, 1fr); }
   }
+  .thumb.selected {
+    outline: 4px solid #0d6efd;
+    outline-offset: -4px;
+  }
+  .thumb.selected img { opacity: 0.7; }
   .full-img {
     width: 100%;
     height: auto;
@@ -111,7 +184,13 @@ HTML = """
         <div class="text-muted fs-5">Всего мемов: <span id="count">0</span></div>
       </div>
       <div>
+        <button id="trashToggle" class="btn btn-outline-secondary me-2">Корзина</button>
+        <button id="selectToggle" class="btn btn-outline-secondary me-2">Выбрать</button>
         <button id="refresh" class="btn btn-outline-primary me-2">Обновить</button>
+        <label class="btn btn-outline-success mb-0 me-2">
+        <span id="importText">Импорт ZIP</span>
+        <input id="importZip" type="file" accept=".zip,application/zip" hidden>
+      </label>
         <label class="btn btn-success mb-0">
         <span id="uploadText">Добавить фото</span>
         <input id="upload" type="file" accept="image/*" multiple hidden>
@@ -119,6 +198,40 @@ HTML = """
       </div>
     </div>
 
+    <form id="filters" class="row g-2 align-items-center mb-3">
+      <div class="col-auto">
+        <select id="sort" class="form-select">
+          <option value="new">Сначала новые</option>
+          <option value="old">Сначала старые</option>
+          <option value="size">Сначала большие</option>
+          <option value="id">По номеру</option>
+        </select>
+      </div>
+      <div class="col-auto">
+        <input id="searchFilter" type="search" class="form-control" placeholder="Текст на меме">
+      </div>
+      <div class="col-auto">
+        <input id="uploaderFilter" class="form-control" placeholder="Кто загрузил">
+      </div>
+      <div class="col-auto">
+        <input id="minSizeFilter" type="number" min="0" class="form-control" placeholder="От, КБ">
+      </div>
+      <div class="col-auto">
+        <button class="btn btn-outline-primary" type="submit">Применить</button>
+        <button id="resetFilters" class="btn btn-outline-secondary" type="button">Сбросить</button>
+      </div>
+    </form>
+
+    <div id="batchBar" class="alert alert-primary d-none d-flex align-items-center gap-2">
+      <span>Выбрано: <b id="selectedCount">0</b></span>
+      <button class="btn btn-sm btn-warning batch-action" data-action="soft_delete">В корзину</button>
+      <button class="btn btn-sm btn-success batch-action" data-action="restore">Восстановить</button>
+      <button class="btn btn-sm btn-info batch-action" data-action="tag">Добавить тег</button>
+      <button class="btn btn-sm btn-outline-info batch-action" data-action="untag">Убрать тег</button>
+      <button class="btn btn-sm btn-danger batch-action" data-action="delete">Удалить навсегда</button>
+      <button id="clearSelection" class="btn btn-sm btn-outline-secondary">Снять выделение</button>
+    </div>
+
     <div id="gallery" class="grid"></div>
 
     <div class="d-flex justify-content-center mt-3">
@@ -136,6 +249,7 @@ HTML = """
         </div>
         <div class="modal-body text-center">
           <img id="fullImage" class="full-img" src="" alt="">
+          <div id="memeMeta" class="text-muted small mt-2"></div>
         </div>
         <div class="modal-footer">
           <button id="deleteBtn" class="btn btn-danger">Удалить</button>
@@ -147,11 +261,14 @@ HTML = """
 
 <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/js/bootstrap.bundle.min.js"></script>
 <script>
-let page = 1;
+let nextCursor = null;
 let perPage = {{ per_page }};
 let gallery = document.getElementById('gallery');
 let loadMore = document.getElementById('loadMore');
 let currentFile = null;
+let selectMode = false;
+let trashMode = false;
+let selected = new Set();
 
 async function updateCount() {
   try {
@@ -164,30 +281,64 @@ async function updateCount() {
   }
 }
 
-async function loadPage(p) {
-  const r = await fetch(`/api/images?page=${p}`);
+function filterParams() {
+  const params = new URLSearchParams({
+    deleted: trashMode ? 1 : 0,
+    sort: document.getElementById('sort').value,
+  });
+  const q = document.getElementById('searchFilter').value.trim();
+  if (q) params.set('q', q);
+  const uploader = document.getElementById('uploaderFilter').value.trim();
+  if (uploader) params.set('uploader', uploader);
+  const minKb = parseInt(document.getElementById('minSizeFilter').value, 10);
+  if (minKb > 0) params.set('min_size', minKb * 1024);
+  return params;
+}
+
+function describeMeme(meme) {
+  const parts = [];
+  if (meme.created_at) parts.push(new Date(meme.created_at + 'Z').toLocaleString());
+  if (meme.uploader) parts.push(`загрузил: ${meme.uploader}`);
+  if (meme.size) parts.push(`${Math.round(meme.size / 1024)} КБ`);
+  if (meme.format) parts.push(meme.format);
+  if (meme.tags && meme.tags.length) parts.push(`теги: ${meme.tags.join(', ')}`);
+  if (meme.text) parts.push(`текст: ${meme.text}`);
+  if (meme.quarantine) parts.push(`повреждён: ${meme.quarantine}`);
+  return parts.join(' · ');
+}
+
+async function loadPage(first) {
+  const params = filterParams();
+  if (!first && nextCursor) params.set('after', nextCursor);
+  const r = await fetch(`/api/images?${params}`);
   if (!r.ok) return;
   const data = await r.json();
-  data.images.forEach(id => {
+  data.images.forEach(meme => {
+    const id = meme.id;
     const div = document.createElement('div');
     div.className = 'thumb';
     // store id on dataset for later removal
     div.dataset.memeId = id;
+    div.title = describeMeme(meme);
     div.innerHTML = `<img src="/memes/${id}" alt="Мем #${id}">`;
     div.onclick = (e) => {
       // prevent click when clicking inside delete or other controls in future
       if (e.target.tagName.toLowerCase() === 'button') return;
-      openModal(id);
+      if (selectMode) { toggleSelected(div, id); return; }
+      openModal(meme);
     };
     gallery.appendChild(div);
   });
+  nextCursor = data.next;
   if (!data.has_more) loadMore.style.display = 'none';
   await updateCount();
 }
 
-function openModal(name) {
+function openModal(meme) {
+  const name = meme.id;
   currentFile = name;
   document.getElementById('fileName').innerText = `Мем #${name}`;
+  document.getElementById('memeMeta').innerText = describeMeme(meme);
   document.getElementById('fullImage').src = '/memes/' + name;
   const modal = new bootstrap.Modal(document.getElementById('modalView'));
   modal.show();
@@ -238,24 +389,98 @@ document.getElementById('deleteBtn').onclick = async () => {
   } else if (r.status === 404) {
     alert('Мем не найден (уже удалён). Обновляю галерею.');
     // На случай рассинхронизации — перезагрузим ленту
-    gallery.innerHTML = ''; page = 1; loadMore.style.display = 'block'; loadPage(1);
-    updateCount();
+    reloadGallery();
   } else {
     alert('Ошибка удаления');
   }
 };
 
-loadMore.onclick = () => { page++; loadPage(page); };
-document.getElementById('refresh').onclick = () => {
-  gallery.innerHTML = ''; page = 1; loadMore.style.display = 'block'; loadPage(1); updateCount();
+// ---- Множественный выбор и пакетные операции ----
+function updateBatchBar() {
+  document.getElementById('selectedCount').innerText = selected.size;
+  document.getElementById('batchBar').classList.toggle('d-none', !selectMode);
+}
+
+function toggleSelected(div, id) {
+  if (selected.has(id)) { selected.delete(id); div.classList.remove('selected'); }
+  else { selected.add(id); div.classList.add('selected'); }
+  updateBatchBar();
+}
+
+function clearSelection() {
+  selected.clear();
+  gallery.querySelectorAll('.thumb.selected').forEach(d => d.classList.remove('selected'));
+  updateBatchBar();
+}
+
+function reloadGallery() {
+  clearSelection();
+  gallery.innerHTML = ''; nextCursor = null; loadMore.style.display = 'block'; loadPage(true);
+}
+
+document.getElementById('selectToggle').onclick = (e) => {
+  selectMode = !selectMode;
+  e.target.classList.toggle('active', selectMode);
+  if (!selectMode) clearSelection();
+  updateBatchBar();
+};
+
+document.getElementById('trashToggle').onclick = (e) => {
+  trashMode = !trashMode;
+  e.target.classList.toggle('active', trashMode);
+  reloadGallery();
 };
 
+document.getElementById('clearSelection').onclick = clearSelection;
+
+document.getElementById('filters').onsubmit = (e) => { e.preventDefault(); reloadGallery(); };
+document.getElementById('sort').onchange = reloadGallery;
+document.getElementById('resetFilters').onclick = () => {
+  document.getElementById('filters').reset();
+  reloadGallery();
+};
+
+document.querySelectorAll('.batch-action').forEach(btn => {
+  btn.onclick = async () => {
+    if (!selected.size) return;
+    const action = btn.dataset.action;
+    const body = {action: action, ids: Array.from(selected)};
+    if (action === 'tag' || action === 'untag') {
+      const tags = prompt('Теги через запятую:');
+      if (!tags) return;
+      body.tags = tags.split(',').map(t => t.trim()).filter(t => t);
+    } else if (action === 'delete') {
+      if (!confirm(`Удалить навсегда ${selected.size} мемов?`)) return;
+    }
+    const r = await fetch('/api/batch', {
+      method: 'POST',
+      headers: {'Content-Type':'application/json'},
+      body: JSON.stringify(body)
+    });
+    if (!r.ok) { alert('Ошибка пакетной операции'); return; }
+    const data = await r.json();
+    if (action === 'tag' || action === 'untag') {
+      clearSelection();
+    } else {
+      Array.from(selected).forEach(id => removeThumbAnimated(id));
+      clearSelection();
+      updateCount();
+    }
+    console.log('batch', action, data);
+  };
+});
+
+loadMore.onclick = () => loadPage(false);
+document.getElementById('refresh').onclick = reloadGallery;
+
 document.getElementById('upload').onchange = async (e) => {
   const files = e.target.files;
   if (!files.length) return;
 
   const fd = new FormData();
   for (const f of files) fd.append('files', f);
+  const tags = prompt('Теги для новых мемов через запятую (можно оставить пустым):');
+  if (tags) fd.append('tags', tags);
 
   const input = document.getElementById('upload');
   const text = document.getElementById('uploadText');
@@ -271,20 +496,54 @@ document.getElementById('upload').onchange = async (e) => {
   e.target.value = '';
 
   if (r.ok) {
-    gallery.innerHTML = '';
-    page = 1;
-    loadMore.style.display = 'block';
-    loadPage(1);
-    updateCount();
+    reloadGallery();
   } else {
     alert('Ошибка загрузки');
   }
 };
 
 
+// ZIP импорт: сервер присылает прогресс построчно (NDJSON)
+document.getElementById('importZip').onchange = async (e) => {
+  const file = e.target.files[0];
+  if (!file) return;
+  const input = e.target;
+  const text = document.getElementById('importText');
+  const fd = new FormData();
+  fd.append('archive', file);
+  input.disabled = true;
+  text.textContent = 'Импорт...';
+  let stats = null;
+  try {
+    const r = await fetch('/api/import', {method: 'POST', body: fd});
+    if (!r.ok) { alert('Ошибка импорта: ' + await r.text()); return; }
+    const reader = r.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const {value, done} = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, {stream: true});
+      const lines = buffer.split('\n');
+      buffer = lines.pop();
+      for (const line of lines) {
+        if (!line.trim()) continue;
+        stats = JSON.parse(line);
+        if (stats.error) { alert('Ошибка импорта: ' + stats.error); return; }
+        text.textContent = `Импорт ${stats.processed}/${stats.total}`;
+      }
+    }
+    if (stats) alert(`Добавлено ${stats.added}, дубликатов ${stats.duplicates}, пропущено ${stats.skipped}`);
+    reloadGallery();
+  } finally {
+    input.disabled = false;
+    input.value = '';
+    text.textContent = 'Импорт ZIP';
+  }
+};
+
 // initial load
-loadPage(1);
-updateCount();
+loadPage(true);
 </script>
 </body>
 </html>
@@ -297,31 +556,104 @@ def index():
     return render_template_string(HTML, cols=IMAGES_PER_ROW, per_page=THUMBNAILS_PER_PAGE)
 
 
+def iter_image_chunks(meme_id, rev, data):
+    """
+    Куски ответа картинки. Из кеша — срезы готовых байт (memoryview, без копий);
+    с промаха — base64 декодируется кусками по границе 4 символов, так что первый
+    кусок уходит клиенту до декодирования всей картинки, а целиком она собирается
+    только для кеша после отправки.
+    """
+    if isinstance(data, bytes):
+        view = memoryview(data)
+        for start in range(0, len(view), IMAGE_STREAM_CHUNK):
+            yield view[start:start + IMAGE_STREAM_CHUNK]
+        return
+    step = IMAGE_STREAM_CHUNK // 3 * 4
+    parts = []
+    for start in range(0, len(data), step):
+        part = base64.b64decode(data[start:start + step])
+        parts.append(part)
+        yield part
+    get_image_cache().put(meme_id, rev, b"".join(parts))
+
+
 @app.route("/memes/<int:meme_id>")
 def serve_image(meme_id):
-    meme = mongo.get_meme_by_id(meme_id)
-    if not meme or "image" not in meme:
+    # Дешёвая проверка кеша браузера: только ревизия, без картинки
+    rev = mongo.get_meme_rev(meme_id)
+    if rev is None:
+        abort(404)
+    etag = f"{meme_id}-{rev}"
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    # Картинка из общего LRU кеша; промах — одна загрузка base64 из Mongo
+    with image_slots:
+        loaded = mongo.load_meme_image(meme_id, include_deleted=True)
+    if loaded is None:
         abort(404)
-    img_data = base64.b64decode(meme["image"])
-    # Попытка минимально корректно вернуть тип, хотя в коде раньше было png
-    return Response(img_data, mimetype="image/png")
+    rev, data = loaded
+    if isinstance(data, str) and (len(data) % 4 or "\n" in data):
+        # base64 с переводами строк (не прошедший проверку картинок) кусками не режется
+        data = base64.b64decode(data)
+        get_image_cache().put(meme_id, rev, data)
+    if isinstance(data, bytes):
+        head, size = data[:12], len(data)
+    else:
+        # Формат и размер — по началу и длине base64, без декодирования целиком
+        head, size = base64.b64decode(data[:16]), base64_decoded_size(len(data), data[-2:])
+    response = Response(iter_image_chunks(meme_id, rev, data), mimetype=detect_mimetype(head))
+    response.headers["Cache-Control"] = f"private, max-age={IMAGE_CACHE_MAX_AGE}"
+    response.headers["ETag"] = f'"{meme_id}-{rev}"'
+    response.headers["Content-Length"] = str(size)
+    return response
 
 
-@app.route("/api/images")
-def api_images():
-    page = int(request.args.get("page", 1))
-    per_page = THUMBNAILS_PER_PAGE
+@app.route("/api/cache_stats")
+def api_cache_stats():
+    """Статистика LRU кеша картинок этого воркера"""
+    return jsonify(get_image_cache().stats())
 
-    all_memes = mongo.get_all_memes()
-    start = (page - 1) * per_page
-    end = start + per_page
 
-    memes_page = all_memes[start:end]
-    meme_ids = [m["_id"] for m in memes_page]
+@app.route("/api/images")
+def api_images():
+    """
+    Страница галереи. sort: new | old | size | id; фильтры uploader и min_size (байты).
+    Следующая страница запрашивается с after=<cursor> из ответа (keyset, без skip).
+    q — поиск по распознанному тексту: результаты по релевантности, after — смещение,
+    сортировка и фильтры не применяются.
+    """
+    sort = request.args.get("sort", DEFAULT_SORT)
+    if sort not in MEME_SORTS:
+        return "Неизвестная сортировка", 400
+    deleted = request.args.get("deleted", "0") == "1"
+    q = request.args.get("q", "").strip()
+    if q:
+        try:
+            skip = int(request.args.get("after") or 0)
+        except ValueError:
+            return "Неверный запрос", 400
+        docs, has_more = mongo.search_memes(q, limit=THUMBNAILS_PER_PAGE, skip=skip, deleted=deleted)
+        return jsonify({
+            "images": [meme_info(doc) for doc in docs],
+            "next": str(skip + len(docs)) if has_more else None,
+            "has_more": has_more,
+        })
+    uploader = request.args.get("uploader", "").strip() or None
+    try:
+        min_size = int(request.args.get("min_size") or 0)
+        after = decode_cursor(request.args["after"], sort) if request.args.get("after") else None
+    except ValueError:
+        return "Неверный запрос", 400
 
+    docs, next_after = mongo.list_memes(
+        sort=sort, after=after, limit=THUMBNAILS_PER_PAGE,
+        uploader=uploader, min_size=min_size, deleted=deleted,
+    )
     return jsonify({
-        "images": meme_ids,
-        "has_more": end < len(all_memes)
+        "images": [meme_info(doc) for doc in docs],
+        "next": encode_cursor(next_after) if next_after else None,
+        "has_more": next_after is not None,
     })
 
 
@@ -339,17 +671,39 @@ def api_upload():
     files = request.files.getlist("files")
     if not files:
         return "Нет файлов", 400
+    tags = request.form.get("tags", "").split(",")
     saved_ids = []
     for f in files:
         name = secure_filename(f.filename)
         if not allowed_file(name):
             return f"Недопустимое расширение: {name}", 400
         base64_str = base64.b64encode(f.read()).decode("utf-8")
-        meme_id = mongo.add_meme_base64(base64_str)
+        meme_id = mongo.add_meme_base64(base64_str, uploader="panel", tags=tags)
         saved_ids.append(meme_id)
     return jsonify({"saved": saved_ids})
 
 
+@app.route("/api/import", methods=["POST"])
+def api_import():
+    """ZIP архив мемов; ответ — NDJSON строки с прогрессом после каждой пачки"""
+    archive = request.files.get("archive")
+    if archive is None:
+        return "Нет архива", 400
+    if not zipfile.is_zipfile(archive.stream):
+        return "Это не ZIP архив", 400
+    archive.stream.seek(0)
+
+    def progress():
+        try:
+            for stats in import_memes_zip(archive.stream, uploader="panel"):
+                yield json.dumps(stats) + "\n"
+        except Exception as e:
+            app.logger.error(f"ZIP import failed: {e}")
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return Response(stream_with_context(progress()), mimetype="application/x-ndjson")
+
+
 @app.route("/api/delete", methods=["POST"])
 def api_delete():
     data = request.get_json()
@@ -365,6 +719,55 @@ def api_delete():
         return "Не найден", 404
 
 
+@app.route("/api/batch", methods=["POST"])
+def api_batch():
+    """Пакетные операции: delete, soft_delete, restore, tag, untag"""
+    data = request.get_json(silent=True)
+    if not data or "ids" not in data or "action" not in data:
+        return "Неверный запрос", 400
+    try:
+        meme_ids = [int(x) for x in data["ids"]]
+    except Exception:
+        return "Неверный id", 400
+    if len(meme_ids) > BATCH_MAX_IDS:
+        return f"Слишком много мемов за раз (максимум {BATCH_MAX_IDS})", 400
+
+    action = data["action"]
+    if action == "delete":
+        affected = mongo.delete_memes(meme_ids)
+    elif action == "soft_delete":
+        affected = mongo.soft_delete_memes(meme_ids)
+    elif action == "restore":
+        affected = mongo.restore_memes(meme_ids)
+    elif action in ("tag", "untag"):
+        tags = normalize_tags(data.get("tags", []))
+        if not tags:
+            return "Не указаны теги", 400
+        if action == "tag":
+            affected = mongo.add_tags(meme_ids, tags)
+        else:
+            affected = mongo.remove_tags(meme_ids, tags)
+    else:
+        return "Неизвестное действие", 400
+    return jsonify({"action": action, "affected": affected})
+
+
+@app.route("/api/profile")
+def api_profile():
+    """Сэмплирующий профиль воркера панели (collapsed stacks). Нужен profiling.token"""
+    if not PROFILING_TOKEN or request.headers.get("X-Profiling-Token") != PROFILING_TOKEN:
+        abort(404)
+    try:
+        seconds = int(request.args.get("seconds", 10))
+        folded = profiling.sample_stacks(seconds)
+    except ValueError:
+        return "Неверная длительность", 400
+    except RuntimeError as e:
+        return str(e), 409
+    return Response(folded, mimetype="text/plain",
+                    headers={"Content-Disposition": "attachment; filename=profile.folded"})
+
+
 if __name__ == "__main__":
     # На Windows watchdog/reloader иногда вызывает OSError 10038 (select на не-сокете).
     # Чтобы избежать этой ошибки в разработке — выключаем use_reloader.
@@ -0,0 +1,17 @@
+# Настройки gunicorn для панели управления (control_panel_ui.py)
+#
+# gthread: каждый воркер обслуживает запросы пулом потоков, поэтому
+# медленная загрузка или отдача большой картинки не блокирует остальных
+# пользователей панели. Галерея делает ~80 запросов картинок разом —
+# потоки позволяют отдавать их параллельно.
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PANEL_PORT', '8501')}"
+workers = int(os.getenv("PANEL_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("PANEL_THREADS", "16"))
+# Ограничение очереди ожидающих соединений
+backlog = int(os.getenv("PANEL_BACKLOG", "256"))
+timeout = int(os.getenv("PANEL_TIMEOUT", "60"))
+keepalive = 5
@@ -0,0 +1,322 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочного тестирования bot.py.
+
+Запуск:
+    python -m loadtest.fake_bot_api --port 8081 --latency-ms 30 --rate-limit-prob 0.01
+
+В config.yaml бота:
+    token: "123:TEST"
+    bot_api_url: http://127.0.0.1:8081/bot
+    bot_api_file_url: http://127.0.0.1:8081/file/bot
+
+Поддерживается то, что использует бот: getMe, getUpdates (long polling),
+sendPhoto, sendMessage, sendDocument, getFile и скачивание файлов, плюс
+setWebhook/deleteWebhook и т.п. как no-op. Задержка ответа и доля ответов
+429 (RetryAfter) настраиваются.
+
+Служебные эндпоинты для loadtest/replay.py:
+    POST /_control/updates  — JSON список апдейтов в очередь getUpdates
+    POST /_control/track    — {"chat_ids": [...]} апдейты ушли боту напрямую (webhook)
+    GET  /_control/stats    — метрики: ответы бота, задержки по чатам, 429
+    POST /_control/reset    — сбросить метрики
+"""
+
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+# Минимальный валидный JPEG 1x1 — им «являются» все файлы заглушки
+FAKE_JPEG = bytes.fromhex(
+    "ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f141d1a1f1e1d1a1c1c"
+    "20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100ffc4001f000001050101010101010000"
+    "0000000000000102030405060708090a0bffc400b5100002010303020403050504040000017d01020300041105122131410613516107227114328191"
+    "a1082342b1c11552d1f02433627282090a161718191a25262728292a3435363738393a434445464748494a535455565758595a636465666768696a73"
+    "7475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9da"
+    "e1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9faffda0008010100003f00fbd0ffd9"
+)
+
+
+class FakeBotState:
+    """Очередь апдейтов и метрики заглушки (общие для всех потоков сервера)"""
+
+    def __init__(self, latency_ms=0, rate_limit_prob=0.0, retry_after=1):
+        self.latency = latency_ms / 1000
+        self.rate_limit_prob = rate_limit_prob
+        self.retry_after = retry_after
+        self.lock = threading.Condition()
+        self.updates = []
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.delivered_at = {}    # chat_id -> время передачи апдейта боту
+            self.latencies = []       # секунды от передачи апдейта до первого ответа бота
+            self.calls = {}           # метод -> количество вызовов
+            self.rate_limited = 0
+            self.started_at = time.monotonic()
+
+    def push_updates(self, updates):
+        with self.lock:
+            self.updates.extend(updates)
+            self.lock.notify_all()
+
+    def track(self, chat_ids):
+        now = time.monotonic()
+        with self.lock:
+            for chat_id in chat_ids:
+                self.delivered_at.setdefault(chat_id, now)
+
+    def get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            if offset:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.lock.wait(deadline - time.monotonic())
+            batch = self.updates[:limit]
+            now = time.monotonic()
+            for update in batch:
+                chat_id = update_chat_id(update)
+                if chat_id is not None:
+                    self.delivered_at.setdefault(chat_id, now)
+            return batch
+
+    def record_reply(self, method, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            started = self.delivered_at.pop(chat_id, None)
+            if started is not None:
+                self.latencies.append(now - started)
+
+    def record_call(self, method):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def should_rate_limit(self):
+        if self.rate_limit_prob and random.random() < self.rate_limit_prob:
+            with self.lock:
+                self.rate_limited += 1
+            return True
+        return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                "elapsed": time.monotonic() - self.started_at,
+                "calls": dict(self.calls),
+                "replies": len(self.latencies),
+                "latencies": list(self.latencies),
+                "pending": len(self.delivered_at),
+                "queued_updates": len(self.updates),
+                "rate_limited": self.rate_limited,
+            }
+
+
+def update_chat_id(update):
+    message = update.get("message") or update.get("edited_message") or {}
+    chat = message.get("chat") or {}
+    return chat.get("id")
+
+
+def parse_params(handler):
+    """Параметры запроса Bot API: query, urlencoded, JSON или multipart (файлы пропускаются)"""
+    params = dict(parse_qsl(urlparse(handler.path).query))
+    length = int(handler.headers.get("Content-Length") or 0)
+    body = handler.rfile.read(length) if length else b""
+    content_type = handler.headers.get("Content-Type", "")
+    if not body:
+        return params
+    if content_type.startswith("application/json"):
+        params.update(json.loads(body))
+    elif content_type.startswith("application/x-www-form-urlencoded"):
+        params.update(parse_qsl(body.decode("utf-8")))
+    elif content_type.startswith("multipart/form-data"):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+        )
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is None and name:
+                params[name] = part.get_content().strip() if part.get_content_maintype() == "text" \
+                    else part.get_payload(decode=True).decode("utf-8")
+            elif name:
+                params[name] = f"<file {part.get_filename()}>"
+    return params
+
+
+def chat_of(params):
+    try:
+        return int(params.get("chat_id"))
+    except (TypeError, ValueError):
+        return params.get("chat_id")
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    state: FakeBotState = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        path = urlparse(self.path).path
+        if path.startswith("/_control/"):
+            return self._control(path[len("/_control/"):])
+        if path.startswith("/file/bot"):
+            return self._file()
+        if path.startswith("/bot"):
+            method = path.rsplit("/", 1)[-1]
+            return self._api(method, parse_params(self))
+        self._send_json({"ok": False, "error_code": 404, "description": "Not Found"}, 404)
+
+    # -------------------- Bot API --------------------
+    def _api(self, method, params):
+        state = self.state
+        if method != "getUpdates":
+            if state.latency:
+                time.sleep(state.latency)
+            if state.should_rate_limit():
+                return self._send_json({
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {state.retry_after}",
+                    "parameters": {"retry_after": state.retry_after},
+                }, 429)
+
+        handler = getattr(self, f"_api_{method}", None)
+        if handler is None:
+            state.record_call(method)
+            return self._send_json({"ok": True, "result": True})
+        return self._send_json({"ok": True, "result": handler(params)})
+
+    def _api_getMe(self, params):
+        self.state.record_call("getMe")
+        return {"id": 1, "is_bot": True, "first_name": "FakeMemeBot", "username": "fake_meme_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False,
+                "supports_inline_queries": True}
+
+    def _api_getUpdates(self, params):
+        self.state.record_call("getUpdates")
+        return self.state.get_updates(
+            offset=int(params.get("offset") or 0),
+            limit=int(params.get("limit") or 100),
+            timeout=min(float(params.get("timeout") or 0), 10.0),
+        )
+
+    def _message(self, params, **extra):
+        return {
+            "message_id": next(self.state.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_of(params), "type": "private"},
+            **extra,
+        }
+
+    def _api_sendPhoto(self, params):
+        self.state.record_reply("sendPhoto", chat_of(params))
+        file_id = f"fake-photo-{next(self.state.file_ids)}"
+        return self._message(params, photo=[{
+            "file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1,
+            "file_size": len(FAKE_JPEG),
+        }])
+
+    def _api_sendMediaGroup(self, params):
+        self.state.record_reply("sendMediaGroup", chat_of(params))
+        return [self._message(params)]
+
+    def _api_sendMessage(self, params):
+        self.state.record_reply("sendMessage", chat_of(params))
+        return self._message(params, text=params.get("text", ""))
+
+    def _api_sendDocument(self, params):
+        self.state.record_reply("sendDocument", chat_of(params))
+        file_id = f"fake-doc-{next(self.state.file_ids)}"
+        return self._message(params, document={"file_id": file_id, "file_unique_id": file_id})
+
+    def _api_getFile(self, params):
+        self.state.record_call("getFile")
+        file_id = params.get("file_id", "unknown")
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(FAKE_JPEG),
+                "file_path": f"photos/{file_id}.jpg"}
+
+    # -------------------- файлы --------------------
+    def _file(self):
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        self.state.record_call("downloadFile")
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(FAKE_JPEG)))
+        self.end_headers()
+        self.wfile.write(FAKE_JPEG)
+
+    # -------------------- управление --------------------
+    def _control(self, action):
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length)) if length else None
+        if action == "updates":
+            self.state.push_updates(payload or [])
+            return self._send_json({"ok": True, "queued": len(payload or [])})
+        if action == "track":
+            self.state.track((payload or {}).get("chat_ids", []))
+            return self._send_json({"ok": True})
+        if action == "stats":
+            return self._send_json(self.state.stats())
+        if action == "reset":
+            self.state.reset()
+            return self._send_json({"ok": True})
+        self._send_json({"ok": False}, 404)
+
+
+def run_server(host, port, state):
+    handler = type("Handler", (FakeBotApiHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка каждого вызова API")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429")
+    args = parser.parse_args()
+
+    state = FakeBotState(args.latency_ms, args.rate_limit_prob, args.retry_after)
+    server = run_server(args.host, args.port, state)
+    print(f"Fake Bot API on http://{args.host}:{args.port} "
+          f"(latency {args.latency_ms} ms, 429 probability {args.rate_limit_prob})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
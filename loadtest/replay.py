@@ -0,0 +1,202 @@
+"""
+Генератор/проигрыватель потока апдейтов для нагрузочного теста bot.py.
+
+1. Запустить заглушку:     python -m loadtest.fake_bot_api --port 8081
+2. Запустить бота с bot_api_url / bot_api_file_url на заглушку (см. fake_bot_api.py)
+3. Запустить нагрузку:
+    python -m loadtest.replay --rate 50 --duration 60 \\
+        --mix random_meme=6,meme_of_the_day=2,meme_count=1,photo=1,album=0.2
+
+Для webhook-режима апдейты отправляются прямо в бота:
+    python -m loadtest.replay --webhook-url http://127.0.0.1:8443/telegram --secret-token ...
+
+--record-file updates.jsonl проигрывает записанные апдейты (по одному JSON в строке)
+вместо синтетических. В конце печатается пропускная способность, перцентили
+задержки обработки (от передачи апдейта боту до его первого ответа в чат) и,
+если задан --mongo-uri, число операций MongoDB за время теста.
+"""
+
+import argparse
+import itertools
+import json
+import random
+import time
+import urllib.request
+
+from loadtest.fake_bot_api import update_chat_id
+
+COMMANDS = ("random_meme", "meme_of_the_day", "meme_count", "start", "help")
+
+
+def post_json(url, payload, headers=None):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json", **(headers or {})}, method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        body = response.read()
+    return json.loads(body) if body else None
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return json.loads(response.read())
+
+
+class UpdateFactory:
+    """Синтетические апдейты: команды, одиночные фото и альбомы"""
+
+    def __init__(self, chat_id_base=10_000_000):
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.chat_ids = itertools.count(chat_id_base)
+
+    def _message(self, chat_id, **extra):
+        user = {"id": chat_id, "is_bot": False, "first_name": "load", "username": f"load{chat_id}"}
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": user,
+                **extra,
+            },
+        }
+
+    def command(self, name):
+        # Каждый апдейт — свой чат: так ответ бота однозначно сопоставляется с апдейтом
+        text = f"/{name}"
+        return [self._message(next(self.chat_ids), text=text,
+                              entities=[{"type": "bot_command", "offset": 0, "length": len(text)}])]
+
+    def _photo(self, file_id):
+        return [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1, "file_size": 332}]
+
+    def photo(self):
+        chat_id = next(self.chat_ids)
+        return [self._message(chat_id, photo=self._photo(f"upload-{chat_id}"))]
+
+    def album(self, size=3):
+        chat_id = next(self.chat_ids)
+        group = f"album-{chat_id}"
+        return [
+            self._message(chat_id, photo=self._photo(f"upload-{chat_id}-{i}"), media_group_id=group)
+            for i in range(size)
+        ]
+
+    def make(self, kind):
+        if kind == "photo":
+            return self.photo()
+        if kind == "album":
+            return self.album()
+        return self.command(kind)
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in COMMANDS + ("photo", "album"):
+            raise SystemExit(f"Unknown update kind: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def synthetic_batches(mix, factory):
+    kinds, weights = zip(*mix.items())
+    while True:
+        yield factory.make(random.choices(kinds, weights)[0])
+
+
+def recorded_batches(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield [json.loads(line)]
+
+
+def mongo_opcounters(uri):
+    if not uri:
+        return None
+    from pymongo import MongoClient
+    client = MongoClient(uri, serverSelectionTimeoutMS=3000)
+    try:
+        return client.admin.command("serverStatus")["opcounters"]
+    finally:
+        client.close()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api-url", default="http://127.0.0.1:8081", help="адрес fake_bot_api")
+    parser.add_argument("--webhook-url", default="", help="слать апдейты прямо в webhook бота")
+    parser.add_argument("--secret-token", default="")
+    parser.add_argument("--rate", type=float, default=20, help="апдейтов в секунду")
+    parser.add_argument("--duration", type=float, default=30, help="секунд нагрузки")
+    parser.add_argument("--mix", default="random_meme=6,meme_of_the_day=2,meme_count=1,photo=1,album=0.2")
+    parser.add_argument("--record-file", default="", help="JSONL с записанными апдейтами")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="ожидание ответов после нагрузки")
+    parser.add_argument("--mongo-uri", default="", help="для подсчёта операций MongoDB")
+    args = parser.parse_args()
+
+    batches = recorded_batches(args.record_file) if args.record_file \
+        else synthetic_batches(parse_mix(args.mix), UpdateFactory())
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret_token} if args.secret_token else {}
+
+    post_json(f"{args.api_url}/_control/reset", {})
+    ops_before = mongo_opcounters(args.mongo_uri)
+
+    sent = 0
+    interval = 1 / args.rate
+    started = time.monotonic()
+    next_at = started
+    for batch in batches:
+        now = time.monotonic()
+        if now - started >= args.duration:
+            break
+        if next_at > now:
+            time.sleep(next_at - now)
+        if args.webhook_url:
+            post_json(f"{args.api_url}/_control/track", {"chat_ids": [update_chat_id(u) for u in batch]})
+            for update in batch:
+                post_json(args.webhook_url, update, headers)
+        else:
+            post_json(f"{args.api_url}/_control/updates", batch)
+        sent += len(batch)
+        next_at += interval
+    load_time = time.monotonic() - started
+
+    # Ждём, пока бот ответит на всё отправленное
+    deadline = time.monotonic() + args.drain_timeout
+    stats = get_json(f"{args.api_url}/_control/stats")
+    while (stats["pending"] or stats["queued_updates"]) and time.monotonic() < deadline:
+        time.sleep(0.5)
+        stats = get_json(f"{args.api_url}/_control/stats")
+    ops_after = mongo_opcounters(args.mongo_uri)
+
+    latencies = stats["latencies"]
+    print(f"updates sent:      {sent} in {load_time:.1f}s ({sent / load_time:.1f}/s)")
+    print(f"bot replies:       {stats['replies']} ({stats['replies'] / stats['elapsed']:.1f}/s), "
+          f"unanswered: {stats['pending']}")
+    print("handler latency:   " + ", ".join(
+        f"p{q}={percentile(latencies, q) * 1000:.0f}ms" for q in (50, 90, 99)
+    ) + f", max={max(latencies, default=0) * 1000:.0f}ms")
+    print(f"API calls:         {stats['calls']}")
+    print(f"injected 429:      {stats['rate_limited']}")
+    if ops_before and ops_after:
+        elapsed = stats["elapsed"]
+        ops = {k: ops_after[k] - ops_before[k] for k in ops_before}
+        total = sum(ops.values())
+        print(f"MongoDB ops:       {ops} ({total / elapsed:.0f}/s, {total / max(sent, 1):.1f} per update)")
+
+
+if __name__ == "__main__":
+    main()
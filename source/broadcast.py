@@ -0,0 +1,213 @@
+# Ежедневная рассылка мема дня подписанным чатам
+#
+# Рассылка идёт в три шага, состояние каждого хранится в Mongo, поэтому
+# после перезапуска бота она продолжается с места остановки:
+# 1. resolving — выбирается набор мемов дня (variety штук из общей ротации),
+#    каждому подписчику назначается один из них (по хешу chat_id), назначения
+#    пишутся пачками insert_many в broadcast_items, а в личных чатах ещё и
+#    становятся мемом дня пользователя (тот же мем по /meme_of_the_day;
+#    если пользователь уже выбрал мем дня, рассылка пришлёт его);
+# 2. sending — неотправленные элементы читаются пачками и уходят через
+#    очередь исходящих сообщений (лимиты Telegram, повторы после 429).
+#    Каждая картинка загружается в Telegram один раз, дальше шлётся её file_id;
+#    статусы пачки пишутся одним bulk_write;
+# 3. done.
+
+import asyncio
+import datetime
+import logging
+import zlib
+
+from telegram.error import Forbidden, BadRequest
+
+from source import meme_manager
+from source.send_queue import outbox
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "variety": 20,          # разных мемов в рассылке дня
+    "batch_size": 100,      # элементов за одно чтение/запись прогресса
+    "resolve_batch": 1000,  # подписчиков за одну вставку назначений
+}
+
+_lock = asyncio.Lock()
+
+
+def assign_meme(chat_id, day, meme_ids):
+    """Стабильный выбор мема дня для чата: тот же при повторном разрешении"""
+    return meme_ids[zlib.crc32(f"{day}:{chat_id}".encode()) % len(meme_ids)]
+
+
+def _resolve(day, config):
+    """Шаг 1 (синхронный, в пуле потоков): набор мемов и назначения подписчикам"""
+    mongo = meme_manager.mongo
+    state = mongo.get_broadcast(day)
+    meme_ids = state.get("meme_ids")
+    if not meme_ids:
+        meme_ids = meme_manager.pick_meme_ids(int(config["variety"]))
+        if not meme_ids:
+            return 0
+        mongo.update_broadcast(day, {"meme_ids": meme_ids})
+
+    total = 0
+    batch = {}
+
+    def flush():
+        nonlocal total
+        # Кто уже взял мем дня командой, получит в рассылке его же
+        private = [chat_id for chat_id in batch if chat_id > 0]
+        chosen = mongo.get_user_memes_for_day(private, day)
+        batch.update(chosen)
+        mongo.add_broadcast_items(day, batch)
+        mongo.set_user_memes_bulk(
+            {c: batch[c] for c in private if c not in chosen}, day, meme_manager.day_expires_at(day)
+        )
+        total += len(batch)
+        batch.clear()
+
+    for chat_id in mongo.iter_subscriber_ids():
+        batch[chat_id] = assign_meme(chat_id, day, meme_ids)
+        if len(batch) >= int(config["resolve_batch"]):
+            flush()
+    if batch:
+        flush()
+    mongo.update_broadcast(day, {"status": "sending", "total": total})
+    return total
+
+
+async def _send_one(bot, chat_id, meme_id, file_ids):
+    """Отправка одного элемента; возвращает статус для broadcast_items"""
+    file_id = file_ids.get(meme_id)
+    if file_id is not None:
+        photo = file_id
+    else:
+        data = await asyncio.get_running_loop().run_in_executor(None, meme_manager.mongo.get_meme_image, meme_id)
+        if data is None:
+            return "failed"
+        photo = meme_manager.to_photo(data)
+    try:
+        message = await outbox.send(chat_id, bot.send_photo, chat_id=chat_id, photo=photo,
+                                    caption="Мем дня 🎉", disable_notification=True)
+    except Forbidden:
+        return "blocked"
+    except BadRequest as e:
+        logger.warning(f"Broadcast to {chat_id} failed: {e}")
+        return "blocked" if "chat not found" in str(e).lower() else "failed"
+    if file_id is None and message and message.photo:
+        file_ids[meme_id] = message.photo[-1].file_id
+        meme_manager.remember_file_id(meme_id, file_ids[meme_id])
+    return "sent"
+
+
+async def _send(bot, day, config):
+    """Шаг 2: рассылка неотправленных элементов пачками"""
+    mongo = meme_manager.mongo
+    loop = asyncio.get_running_loop()
+    state = await loop.run_in_executor(None, mongo.get_broadcast, day)
+    file_ids = await loop.run_in_executor(None, mongo.get_meme_file_ids, state.get("meme_ids", []))
+
+    while True:
+        items = await loop.run_in_executor(
+            None, mongo.get_pending_broadcast_items, day, int(config["batch_size"])
+        )
+        if not items:
+            break
+        # Личные мемы дня (не из набора) тоже могут быть уже известны Telegram
+        unknown = {item["meme_id"] for item in items} - file_ids.keys()
+        if unknown:
+            file_ids.update(await loop.run_in_executor(None, mongo.get_meme_file_ids, unknown))
+        # Картинки без file_id сначала уходят по одной — дальше весь набор шлётся по file_id
+        first_sends = {}
+        for item in items:
+            if item["meme_id"] not in file_ids and item["meme_id"] not in first_sends:
+                first_sends[item["meme_id"]] = item
+        statuses = {}
+        for item in first_sends.values():
+            statuses[item["_id"]] = await _send_one(bot, item["chat_id"], item["meme_id"], file_ids)
+        rest = [item for item in items if item["_id"] not in statuses]
+        results = await asyncio.gather(
+            *(_send_one(bot, item["chat_id"], item["meme_id"], file_ids) for item in rest),
+            return_exceptions=True,
+        )
+        for item, result in zip(rest, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Broadcast to {item['chat_id']} failed: {result}")
+                result = "failed"
+            statuses[item["_id"]] = result
+
+        blocked = [item["chat_id"] for item in items if statuses[item["_id"]] == "blocked"]
+        sent = sum(1 for status in statuses.values() if status == "sent")
+
+        def save():
+            mongo.finish_broadcast_items(statuses)
+            mongo.unsubscribe_chats(blocked, reason="blocked")
+            mongo.update_broadcast(day, inc_fields={"sent": sent, "failed": len(statuses) - sent})
+
+        await loop.run_in_executor(None, save)
+
+
+async def run_broadcast(bot, day=None, config=None):
+    """Рассылка дня day (по умолчанию сегодня); повторный вызов продолжает незавершённую"""
+    config = {**DEFAULTS, **(config or {})}
+    day = day or meme_manager.today()
+    mongo = meme_manager.mongo
+    loop = asyncio.get_running_loop()
+    if _lock.locked():
+        logger.info("Broadcast already running")
+        return None
+    async with _lock:
+        state = await loop.run_in_executor(None, mongo.create_broadcast, day)
+        if state["status"] == "done":
+            return state
+        started = loop.time()
+        if state["status"] == "resolving":
+            total = await loop.run_in_executor(None, _resolve, day, config)
+            logger.info(f"Broadcast {day}: {total} chats resolved")
+        await _send(bot, day, config)
+        await loop.run_in_executor(
+            None, mongo.update_broadcast, day, {"status": "done", "finished_at": datetime.datetime.utcnow()}
+        )
+        state = await loop.run_in_executor(None, mongo.get_broadcast, day)
+        logger.info(f"Broadcast {day} done in {loop.time() - started:.0f}s: "
+                    f"{state['sent']} sent, {state['failed']} failed of {state['total']}")
+        return state
+
+
+async def broadcast_job(context):
+    try:
+        await run_broadcast(context.bot, config=context.job.data)
+    except Exception as e:
+        logger.error(f"Broadcast failed: {e}")
+
+
+async def resume_broadcast_job(context):
+    """После перезапуска: продолжить сегодняшнюю рассылку, если она не закончена"""
+    day = meme_manager.today()
+    state = await asyncio.get_running_loop().run_in_executor(None, meme_manager.mongo.get_broadcast, day)
+    if state and state["status"] != "done":
+        logger.info(f"Resuming broadcast {day} ({state['status']})")
+        await broadcast_job(context)
+
+
+def parse_time(value, tz_name="UTC"):
+    """"HH:MM" -> datetime.time с часовым поясом"""
+    hours, minutes = (int(part) for part in str(value).split(":"))
+    if tz_name in ("UTC", "", None):
+        tz = datetime.timezone.utc
+    else:
+        from zoneinfo import ZoneInfo
+        tz = ZoneInfo(tz_name)
+    return datetime.time(hours, minutes, tzinfo=tz)
+
+
+def register_broadcast_jobs(application, broadcast_config=None, worker_id=0):
+    """Ежедневная рассылка (только в worker 0, если включена в конфиге)"""
+    broadcast_config = broadcast_config or {}
+    if worker_id != 0 or not broadcast_config.get("enabled"):
+        return
+    config = {k: broadcast_config[k] for k in DEFAULTS if k in broadcast_config}
+    at = parse_time(broadcast_config.get("time", "10:00"), broadcast_config.get("timezone", "UTC"))
+    application.job_queue.run_daily(broadcast_job, time=at, data=config, name="daily_broadcast")
+    application.job_queue.run_once(resume_broadcast_job, when=15, data=config, name="resume_broadcast")
+    logger.info(f"Daily broadcast scheduled at {at.isoformat()}")
@@ -0,0 +1,243 @@
+# Деградированный режим: выдача мемов, пока MongoDB тормозит или недоступна
+#
+# * CircuitBreaker — каждый вызов слоя данных ограничен по времени
+#   (pymongo.timeout); после failure_threshold ошибок подряд цепь размыкается
+#   и следующие reset_timeout секунд Mongo не трогается вовсе. Затем один
+#   пробный вызов (half-open) решает, замкнуть цепь или ждать дальше;
+# * WarmCache — ограниченный по числу и байтам набор недавно выданных мемов
+#   (картинка и file_id) со своей ротацией: при разомкнутой цепи мемы идут
+#   отсюда за микросекунды;
+# * PendingWrites — записи, которые не удалось сделать (мем дня пользователя,
+#   file_id), копятся в очереди и повторяются по порядку, когда Mongo снова
+#   отвечает: состояние ротаций сходится обратно.
+
+import collections
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "enabled": True,
+    "call_timeout": 2.0,        # секунд на один вызов слоя данных
+    "failure_threshold": 3,     # ошибок подряд до размыкания
+    "reset_timeout": 10.0,      # секунд до пробного вызова
+    "warm_entries": 200,
+    "warm_mb": 32,
+    "max_pending_writes": 10000,
+}
+
+
+class DataLayerUnavailable(Exception):
+    """Цепь разомкнута или вызов Mongo не уложился во время"""
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=10.0, call_timeout=2.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.call_timeout = call_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        # Глубина вложенных guard() потока и была ли в них ошибка Mongo
+        self._local = threading.local()
+        self.stats = {"failures": 0, "rejected": 0, "opened": 0}
+
+    def _acquire(self):
+        """Можно ли звать Mongo сейчас; в half-open пропускается один пробный вызов"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def _on_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Data layer recovered, circuit closed")
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def _release(self):
+        """Блок завершился без ответа о здоровье Mongo: освободить пробный вызов, цепь не трогать"""
+        with self._lock:
+            self._probing = False
+
+    def _on_failure(self, error):
+        with self._lock:
+            self.stats["failures"] += 1
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats["opened"] += 1
+                    logger.warning(f"Data layer unavailable, circuit opened: {error}")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    @property
+    def closed(self):
+        return self.state == self.CLOSED
+
+    @contextmanager
+    def guard(self, timed=True):
+        """
+        Все запросы Mongo внутри блока ограничены call_timeout (в сумме).
+        timed=False — без ограничения (заведомо долгая работа вроде полного
+        перемешивания), но с учётом ошибок и отказом при разомкнутой цепи.
+        DataLayerUnavailable — цепь разомкнута или Mongo не ответил.
+        Вложенный блок работает под доступом внешнего; цепь замыкает только
+        внешний блок, и только если ни один запрос внутри него не упал.
+        """
+        local = self._local
+        if getattr(local, "depth", 0):
+            local.depth += 1
+            try:
+                with pymongo.timeout(self.call_timeout if timed else None):
+                    yield
+            except PyMongoError as e:
+                local.failed = True
+                self._on_failure(e)
+                raise DataLayerUnavailable(str(e)) from e
+            finally:
+                local.depth -= 1
+            return
+
+        if not self._acquire():
+            raise DataLayerUnavailable("circuit open")
+        local.depth, local.failed = 1, False
+        try:
+            with pymongo.timeout(self.call_timeout if timed else None):
+                yield
+        except PyMongoError as e:
+            self._on_failure(e)
+            raise DataLayerUnavailable(str(e)) from e
+        except BaseException:
+            # DataLayerUnavailable вложенного блока уже учтена, прочие ошибки —
+            # не ответ Mongo: пробный вызов освобождается, но цепь не замыкается
+            self._release()
+            raise
+        finally:
+            local.depth = 0
+        if local.failed:
+            self._release()
+        else:
+            self._on_success()
+
+    def call(self, func, *args, **kwargs):
+        with self.guard():
+            return func(*args, **kwargs)
+
+
+class WarmCache:
+    """Недавно выданные мемы {ID: (bytes, file_id)} со своей ротацией без повторов"""
+
+    def __init__(self, max_entries=200, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items = collections.OrderedDict()
+        self._bytes = 0
+        self._order = []
+        self._pos = 0
+        self._lock = threading.Lock()
+        self.served = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def remember(self, meme_id, data=None, file_id=None):
+        """Запомнить выданный мем (данные и/или file_id дополняют уже известное)"""
+        with self._lock:
+            old_data, old_file_id = self._items.pop(meme_id, (None, None))
+            data = data if data is not None else old_data
+            file_id = file_id or old_file_id
+            if data is None and file_id is None:
+                return
+            if old_data is not None:
+                self._bytes -= len(old_data)
+            self._items[meme_id] = (data, file_id)
+            self._bytes += len(data) if data is not None else 0
+            while len(self._items) > self.max_entries or self._bytes > self.max_bytes:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self._bytes -= len(evicted) if evicted is not None else 0
+
+    def forget(self, meme_id):
+        with self._lock:
+            data, _ = self._items.pop(meme_id, (None, None))
+            if data is not None:
+                self._bytes -= len(data)
+
+    def next(self):
+        """Следующий мем ротации: (ID, bytes или None, file_id или None); None — кеш пуст"""
+        with self._lock:
+            for _ in range(2):
+                while self._pos < len(self._order):
+                    meme_id = self._order[self._pos]
+                    self._pos += 1
+                    item = self._items.get(meme_id)
+                    if item is not None:
+                        self.served += 1
+                        return meme_id, item[0], item[1]
+                # Цикл пройден (или ещё не начат): новая перестановка того, что сейчас в кеше
+                self._order = list(self._items)
+                random.shuffle(self._order)
+                self._pos = 0
+            return None
+
+    def stats(self):
+        return {"entries": len(self._items), "bytes": self._bytes, "served": self.served}
+
+
+class PendingWrites:
+    """Отложенные записи (имя метода MongoManager, аргументы), повторяются по порядку"""
+
+    def __init__(self, max_size=10000):
+        self._queue = collections.deque(maxlen=max_size)
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def add(self, method, *args):
+        with self._lock:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append((method, args))
+
+    def replay(self, target, breaker):
+        """Повторить записи через breaker; при первой неудаче остаток остаётся в очереди"""
+        done = 0
+        while True:
+            with self._lock:
+                if not self._queue:
+                    break
+                method, args = self._queue[0]
+            try:
+                breaker.call(getattr(target, method), *args)
+            except DataLayerUnavailable:
+                break
+            with self._lock:
+                if self._queue and self._queue[0] == (method, args):
+                    self._queue.popleft()
+            done += 1
+        if done:
+            logger.info(f"Replayed {done} deferred writes, {len(self._queue)} left")
+        return done
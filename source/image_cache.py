@@ -0,0 +1,208 @@
+# LRU кеш декодированных картинок мемов
+#
+# Ключ — _id мема и ревизия его содержимого (поле rev, меняется при перезаписи
+# картинки), значение — готовые байты, поэтому горячие мемы не гоняются из
+# Mongo и не декодируются из base64 на каждый запрос.
+# Память ограничена по байтам. Необязательный дисковый уровень (каталог
+# IMAGE_CACHE_DIR) общий для всех воркеров gunicorn и процессов бота на хосте.
+
+import os
+import glob
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Каталог дискового уровня пересчитывается не чаще раза в столько секунд
+# (или раньше, если по оценке процесса бюджет превышен): его пополняют и другие процессы
+DISK_RESCAN_SECONDS = 60
+
+
+class ImageCache:
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._items = OrderedDict()  # meme_id -> (rev, bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Оценка занятого на диске: последний пересчёт каталога + записи этого процесса после него
+        self._disk_bytes = None
+        self._disk_scanned_at = 0.0
+        self._disk_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    # -------------------- память --------------------
+    def get(self, meme_id, rev=0):
+        """Байты картинки или None"""
+        with self._lock:
+            item = self._items.get(meme_id)
+            if item is not None and item[0] == rev:
+                self._items.move_to_end(meme_id)
+                self.hits += 1
+                return item[1]
+
+        data = self._disk_get(meme_id, rev)
+        if data is not None:
+            self.disk_hits += 1
+            self._memory_put(meme_id, rev, data)
+            return data
+
+        self.misses += 1
+        return None
+
+    def put(self, meme_id, rev, data):
+        self._memory_put(meme_id, rev, data)
+        self._disk_put(meme_id, rev, data)
+
+    def _memory_put(self, meme_id, rev, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(meme_id, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._items[meme_id] = (rev, data)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, meme_id):
+        """Убрать мем из кеша (все ревизии, память и диск)"""
+        with self._lock:
+            old = self._items.pop(meme_id, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+        if self.disk_dir:
+            for path in glob.glob(os.path.join(self.disk_dir, f"{meme_id}-*.img")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._items),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+    # -------------------- диск --------------------
+    def _disk_path(self, meme_id, rev):
+        return os.path.join(self.disk_dir, f"{meme_id}-{rev}.img")
+
+    def _disk_get(self, meme_id, rev):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(meme_id, rev)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # для вытеснения по давности использования
+            return data
+        except OSError:
+            return None
+
+    def _disk_put(self, meme_id, rev, data):
+        if not self.disk_dir or len(data) > self.disk_max_bytes:
+            return
+        path = self._disk_path(meme_id, rev)
+        # Запись через временный файл: другой процесс не увидит недописанную картинку
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Image cache disk write failed: {e}")
+            return
+        self._disk_evict_if_needed(len(data))
+
+    def _disk_evict_if_needed(self, written=0):
+        """
+        Запись стоит O(1): каталог сканируется, только когда оценка превысила бюджет
+        или прошло DISK_RESCAN_SECONDS с прошлого пересчёта.
+        """
+        with self._disk_lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += written
+                fresh = time.monotonic() - self._disk_scanned_at < DISK_RESCAN_SECONDS
+                if fresh and self._disk_bytes <= self.disk_max_bytes:
+                    return
+            self._disk_bytes = self._disk_scan_and_evict()
+            self._disk_scanned_at = time.monotonic()
+
+    def _disk_scan_and_evict(self):
+        """Пересчитать каталог и вытеснить давно не использованное; возвращает занятые байты"""
+        entries = []
+        try:
+            for entry in os.scandir(self.disk_dir):
+                if entry.name.endswith(".img"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # удалён другим процессом
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return 0
+        total = sum(size for _, size, _ in entries)
+        if total <= self.disk_max_bytes:
+            return total
+        # Освобождаем с запасом, чтобы следующий пересчёт был нескоро
+        target = int(self.disk_max_bytes * 0.8)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        return total
+
+
+_CACHE = None
+# Потоки gthread воркеров панели могут впервые обратиться к кешу одновременно
+_CACHE_LOCK = threading.Lock()
+
+
+def get_image_cache():
+    """Кеш процесса; размеры берутся из окружения"""
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = ImageCache(
+                    max_bytes=int(os.getenv("IMAGE_CACHE_MB", "64")) * 1024 * 1024,
+                    disk_dir=os.getenv("IMAGE_CACHE_DIR") or None,
+                    disk_max_bytes=int(os.getenv("IMAGE_CACHE_DISK_MB", "512")) * 1024 * 1024,
+                )
+    return _CACHE
+
+
+def _reset_cache_lock_after_fork():
+    # Блокировки могли быть захвачены потоком родителя в момент fork
+    global _CACHE_LOCK
+    _CACHE_LOCK = threading.Lock()
+    if _CACHE is not None:
+        _CACHE._lock = threading.Lock()
+        _CACHE._disk_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_cache_lock_after_fork)
@@ -0,0 +1,38 @@
+# Определение формата картинки по сигнатуре (первым байтам)
+
+import base64
+
+MIMETYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "webp": "image/webp",
+}
+
+
+def detect_image_format(head):
+    """jpeg | png | gif | webp | None по первым 12 байтам"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def detect_mimetype(head):
+    return MIMETYPES.get(detect_image_format(head), "application/octet-stream")
+
+
+def base64_decoded_size(length, tail):
+    """Размер данных по длине base64 строки и двум последним её символам"""
+    return length * 3 // 4 - tail.count("=")
+
+
+def base64_info(base64_str):
+    """(формат, размер в байтах) картинки в base64 без декодирования целиком"""
+    head = base64.b64decode(base64_str[:16])
+    return detect_image_format(head), base64_decoded_size(len(base64_str), base64_str[-2:])
@@ -0,0 +1,232 @@
+# Проверка целостности картинок в библиотеке
+#
+# Коллекция проходится пачками по _id: основной процесс читает из MongoDB
+# только _id и раздаёт процессам пула диапазоны, каждый процесс сам читает
+# картинки своего диапазона и возвращает лишь счётчики и проблемные ID
+# (многомегабайтный base64 между процессами не гоняется). Процессы создаются
+# через forkserver (работающий многопоточный бот не форкается) и живут между
+# проходами: импорт bot.py в каждом из них происходит один раз, а не на каждый
+# проход. При workers: 1 диапазоны проверяются в потоке вызова.
+# Что проверяется:
+# * base64 декодируется строго; если не выходит, пробуется починка
+#   (пробелы/переводы строк, urlsafe алфавит, потерянный паддинг) — удачно
+#   починенная картинка перезаписывается в нормальном base64;
+# * у картинки должна быть известная сигнатура и целый конец файла
+#   (маркер конца JPEG, IEND у PNG, терминатор GIF, длина RIFF у WebP);
+# * остальное уходит в карантин: мем убирается из ротации, как при переносе
+#   в корзину (в корзине панели видно, почему), и больше не занимает слот
+#   выдачи и не ломает экспорт.
+# Позиция прохода хранится в bot_state (IMAGE_VERIFY): прерванный проход
+# продолжается с последней пачки, следующий проверяет только новые мемы.
+
+import base64
+import binascii
+import datetime
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from source import meme_manager
+from source.image_info import detect_image_format
+from source.mongo_manager import ACTIVE_FILTER, get_client
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "workers": 2,
+    "batch_size": 200,
+}
+
+_config = dict(DEFAULTS)
+_pool = None
+_pool_lock = threading.Lock()
+# Один проход за раз на процесс (фоновая задача и /verify_images)
+_running = threading.Lock()
+
+
+def configure(config=None):
+    """Настройки из секции image_verify конфига"""
+    global _config
+    _config = {**DEFAULTS, **{k: v for k, v in (config or {}).items() if v is not None}}
+
+
+def check_trailer(image_format, data):
+    """Конец файла на месте (картинка не обрезана); мусор после конца допускается"""
+    tail = data[-32:].rstrip(b"\x00")
+    if image_format == "jpeg":
+        # Внутри сжатых данных FF всегда экранирован, так что FFD9 — только маркер конца
+        return b"\xff\xd9" in tail
+    if image_format == "png":
+        return b"IEND" in tail
+    if image_format == "gif":
+        return tail.endswith(b"\x3b")
+    if image_format == "webp":
+        return int.from_bytes(data[4:8], "little") + 8 <= len(data)
+    return False
+
+
+def repair_base64(base64_str):
+    """Попытка прочитать повреждённый base64: пробелы, urlsafe алфавит, паддинг"""
+    cleaned = "".join(base64_str.split()).replace("-", "+").replace("_", "/").rstrip("=")
+    cleaned += "=" * (-len(cleaned) % 4)
+    return base64.b64decode(cleaned, validate=True)
+
+
+def verify_image(base64_str):
+    """
+    Проверка одной картинки.
+    Возвращает (статус, причина, починенный base64 или None):
+    ok | repaired | corrupt.
+    """
+    if not isinstance(base64_str, str) or not base64_str:
+        return "corrupt", "empty image", None
+    repaired = None
+    try:
+        data = base64.b64decode(base64_str, validate=True)
+    except (binascii.Error, ValueError):
+        try:
+            data = repair_base64(base64_str)
+        except (binascii.Error, ValueError) as e:
+            return "corrupt", f"base64: {e}", None
+        repaired = base64.b64encode(data).decode("ascii")
+    image_format = detect_image_format(data[:12])
+    if image_format is None:
+        return "corrupt", "unknown image signature", None
+    if not check_trailer(image_format, data):
+        return "corrupt", f"truncated {image_format}", None
+    if repaired is not None:
+        return "repaired", "base64 normalized", repaired
+    return "ok", None, None
+
+
+def verify_range(uri, db_name, since_id, max_id):
+    """
+    Проверка мемов с since_id < _id <= max_id (в процессе пула или в потоке вызова).
+    Картинки читаются здесь же; возвращаются счётчики, починенные base64
+    и причины карантина — только для проблемных мемов.
+    """
+    memes = get_client(uri)[db_name]["memes"]
+    query = {**ACTIVE_FILTER, "_id": {"$gt": since_id, "$lte": max_id}}
+    result = {"checked": 0, "ok": 0, "bytes": 0, "repaired": {}, "quarantined": {}}
+    for doc in memes.find(query, {"image": 1}):
+        image = doc.get("image")
+        status, reason, fixed = verify_image(image)
+        result["checked"] += 1
+        result["bytes"] += len(image or "")
+        if status == "ok":
+            result["ok"] += 1
+        elif status == "repaired":
+            result["repaired"][doc["_id"]] = fixed
+        else:
+            result["quarantined"][doc["_id"]] = reason
+    return result
+
+
+def split_ranges(since_id, ids, batch_size):
+    """Пачки ID -> диапазоны (since_id, max_id] по batch_size мемов"""
+    ranges = []
+    for start in range(0, len(ids), batch_size):
+        max_id = ids[min(start + batch_size, len(ids)) - 1]
+        ranges.append((since_id, max_id))
+        since_id = max_id
+    return ranges
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=int(_config["workers"]), mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _pool
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def verify_library(batch_size=None, limit=None, restart=False):
+    """
+    Проход проверки (синхронно, из фоновой задачи или команды).
+    restart — начать с начала коллекции, иначе с сохранённой позиции.
+    limit — не больше стольких мемов за вызов.
+    Возвращает отчёт: проверено/починено/в карантине, скорость (мемов/с, МБ/с);
+    None — проход уже идёт.
+    """
+    if not _running.acquire(blocking=False):
+        return None
+    try:
+        return _verify_library(int(_config["workers"]), int(batch_size or _config["batch_size"]), limit, restart)
+    finally:
+        _running.release()
+
+
+def _verify_library(workers, batch_size, limit, restart):
+    mongo = meme_manager.mongo
+
+    state = {} if restart else mongo.get_verify_state()
+    last_id = state.get("last_id", -1)
+    report = {"checked": 0, "ok": 0, "repaired": 0, "quarantined": 0, "bytes": 0, "last_id": last_id}
+    started = time.perf_counter()
+    pool = get_pool() if workers > 1 else None
+
+    try:
+        while limit is None or report["checked"] < limit:
+            # На каждый процесс пула — по пачке
+            wanted = batch_size * workers
+            if limit is not None:
+                wanted = min(wanted, limit - report["checked"])
+            ids = [doc["_id"] for doc in mongo.get_memes_cursor(since_id=last_id, fields={"_id": 1}).limit(wanted)]
+            if not ids:
+                last_id = None
+                break
+            ranges = split_ranges(last_id, ids, batch_size)
+            starts, ends = zip(*ranges)
+            uris, db_names = [mongo._uri] * len(ranges), [mongo.db.name] * len(ranges)
+            results = (pool.map if pool is not None else map)(verify_range, uris, db_names, starts, ends)
+            repaired, quarantined = {}, {}
+            for result in results:
+                for key in ("checked", "ok", "bytes"):
+                    report[key] += result[key]
+                repaired.update(result["repaired"])
+                quarantined.update(result["quarantined"])
+            report["repaired"] += len(repaired)
+            report["quarantined"] += len(quarantined)
+            if repaired:
+                mongo.replace_meme_images(repaired)
+            if quarantined:
+                mongo.quarantine_memes(quarantined)
+                for meme_id, reason in quarantined.items():
+                    logger.warning(f"Meme {meme_id} quarantined: {reason}")
+            last_id = ids[-1]
+            mongo.set_verify_state({"last_id": last_id, "updated_at": datetime.datetime.utcnow()})
+    except BrokenProcessPool:
+        # Процесс пула упал (например, OOM): следующий проход создаст пул заново
+        shutdown()
+        raise
+
+    if last_id is None:
+        # Коллекция пройдена: следующий проход начнётся с новых мемов
+        last_id = mongo.get_max_meme_id()
+        mongo.set_verify_state({
+            "last_id": last_id if last_id is not None else -1,
+            "updated_at": datetime.datetime.utcnow(),
+            "finished_at": datetime.datetime.utcnow(),
+        })
+    seconds = time.perf_counter() - started
+    report.update({
+        "last_id": last_id,
+        "seconds": round(seconds, 2),
+        "memes_per_s": round(report["checked"] / seconds, 1) if seconds else 0.0,
+        "mb_per_s": round(report["bytes"] / 1024 / 1024 / seconds, 2) if seconds else 0.0,
+    })
+    logger.info(f"Image verification: {report}")
+    return report
@@ -0,0 +1,173 @@
+# Неблокирующее логирование
+#
+# Хендлеры бота пишут записи в очередь (QueueHandler), а файл и консоль
+# обслуживает отдельный поток QueueListener, поэтому запись лога никогда не
+# останавливает event loop на дисковом вводе-выводе. Файл ротируется по
+# размеру, записи могут писаться в JSON, а частые события (например, запросы
+# httpx на каждый getUpdates) прореживаются.
+
+import os
+import json
+import queue
+import atexit
+import logging
+import datetime
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Стандартные атрибуты LogRecord — всё остальное считается полями extra
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener = None
+_queue_handler = None
+_queue_size = 10000
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна JSON строка; поля из extra= попадают в запись как есть"""
+
+    def format(self, record):
+        payload = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает долю записей частых событий.
+    rates — {имя логгера: доля}; запись также может задать extra={"sample_rate": доля}.
+    WARNING и выше не прореживаются.
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates or {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def _rate(self, record):
+        rate = getattr(record, "sample_rate", None)
+        if rate is not None:
+            return rate
+        name = record.name
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record)
+        if rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        # Детерминированно: каждая round(1/rate)-я запись данного логгера и уровня.
+        # Не по тексту: сообщения собираются f-строками, и ключей было бы без счёта
+        key = (record.name, record.levelno)
+        step = max(1, round(1 / rate))
+        with self._lock:
+            count = self._counters.get(key, 0)
+            self._counters[key] = count + 1
+        return count % step == 0
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler с ограниченной очередью: при переполнении запись отбрасывается, а не блокирует"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def worker_log_file(log_file, worker_id):
+    """log/log.log -> log/log.worker1.log: у каждого процесса свой файл и своя ротация"""
+    root, ext = os.path.splitext(log_file)
+    return f"{root}.worker{worker_id}{ext}"
+
+
+def setup_logging(log_file=None, level="INFO", max_mb=20, backup_count=5,
+                  json_format=False, sampling=None, queue_size=10000, worker_id=None):
+    """
+    Настраивает корневой логгер: очередь -> поток -> (ротируемый файл, консоль).
+    worker_id — номер процесса, когда несколько процессов пишут лог в один каталог:
+    RotatingFileHandler не умеет делить файл между процессами.
+    Повторный вызов заменяет предыдущую настройку.
+    """
+    global _listener, _queue_handler, _queue_size
+
+    root = logging.getLogger()
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        root.removeHandler(_queue_handler)
+
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        if worker_id is not None:
+            log_file = worker_log_file(log_file, worker_id)
+        os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        handlers.append(RotatingFileHandler(
+            log_file, maxBytes=int(max_mb * 1024 * 1024), backupCount=backup_count, encoding="utf-8"
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _queue_size = queue_size
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    _queue_handler.addFilter(SamplingFilter(sampling))
+    _listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    # basicConfig и прочие ранее добавленные хендлеры больше не нужны
+    for handler in list(root.handlers):
+        if handler is not _queue_handler:
+            root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+
+def stop_logging():
+    """Дописать очередь и остановить поток логирования"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_after_fork():
+    """
+    Поток QueueListener не переживает fork: в дочернем процессе запускаем свой.
+    Файл остаётся родительским, пока процесс не вызовет setup_logging со своим worker_id.
+    """
+    global _listener
+    if _listener is None:
+        return
+    handlers = _listener.handlers
+    _queue_handler.queue = queue.Queue(maxsize=_queue_size)
+    _listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
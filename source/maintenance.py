@@ -0,0 +1,178 @@
+# Фоновое обслуживание бота через JobQueue
+#
+# Всё, что раньше выполнялось внутри хендлеров (сверка MEME_ORDER и т.п.),
+# запускается здесь по расписанию и в пуле потоков, поэтому хендлеры
+# никогда не платят за обслуживание.
+
+import asyncio
+import logging
+
+from telegram.ext import ContextTypes
+
+from source import meme_manager
+from source import ocr
+from source import image_integrity
+
+logger = logging.getLogger(__name__)
+
+# Интервалы по умолчанию, секунды
+DEFAULT_INTERVALS = {
+    "order_check_interval": 300,
+    "warmup_interval": 60,
+    "integrity_interval": 3600,
+    "popularity_flush_interval": 10,
+    "popularity_refresh_interval": 60,
+    "popularity_full_refresh_interval": 3600,
+    "tag_pool_check_interval": 3600,
+    "data_layer_probe_interval": 5,
+    "ocr_backfill_interval": 600,
+    "ocr_backfill_limit": 500,
+    "image_verify_interval": 3600,
+    "image_verify_limit": 5000,
+}
+
+
+async def run_blocking(func, *args):
+    """Выполнить синхронную функцию с Mongo вне event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+async def order_consistency_job(context: ContextTypes.DEFAULT_TYPE):
+    """Сверка MEME_ORDER с коллекцией мемов"""
+    try:
+        await run_blocking(meme_manager.check_meme_order_consistency)
+    except Exception as e:
+        logger.error(f"Meme order consistency check failed: {e}")
+
+
+async def cache_warmup_job(context: ContextTypes.DEFAULT_TYPE):
+    """Подгружает актуальный MEME_ORDER в кеш процесса, чтобы выдача мема его не читала"""
+    try:
+        await run_blocking(meme_manager.warm_up_caches)
+    except Exception as e:
+        logger.error(f"Cache warmup failed: {e}")
+
+
+async def integrity_check_job(context: ContextTypes.DEFAULT_TYPE):
+    """Проверка инвариантов состояния бота"""
+    try:
+        problems = await run_blocking(meme_manager.check_state_integrity)
+        for problem in problems:
+            logger.warning(f"Integrity check: {problem}")
+    except Exception as e:
+        logger.error(f"Integrity check failed: {e}")
+
+
+async def metadata_backfill_job(context: ContextTypes.DEFAULT_TYPE):
+    """Метаданные (created_at, size, format) для мемов, добавленных до их появления"""
+    try:
+        await run_blocking(meme_manager.mongo.backfill_meme_metadata)
+    except Exception as e:
+        logger.error(f"Meme metadata backfill failed: {e}")
+
+
+async def popularity_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    """Сброс буфера счётчиков отправок/лайков в Mongo"""
+    try:
+        await run_blocking(meme_manager.flush_popularity)
+    except Exception as e:
+        logger.error(f"Popularity flush failed: {e}")
+
+
+async def popularity_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    """Обновление весов режима popular; data={"full": True} — полная пересборка"""
+    full = bool((context.job.data or {}).get("full"))
+    try:
+        await run_blocking(meme_manager.refresh_popularity, full)
+    except Exception as e:
+        logger.error(f"Popularity refresh failed: {e}")
+
+
+async def data_layer_recovery_job(context: ContextTypes.DEFAULT_TYPE):
+    """Проверка Mongo после сбоя и повтор отложенных записей"""
+    try:
+        await run_blocking(meme_manager.recover_data_layer)
+    except Exception as e:
+        logger.error(f"Data layer recovery failed: {e}")
+
+
+async def tag_pools_job(context: ContextTypes.DEFAULT_TYPE):
+    """Сверка пулов тегов с коллекцией мемов (первый запуск строит пулы для старых тегов)"""
+    try:
+        await run_blocking(meme_manager.mongo.rebuild_tag_pools)
+    except Exception as e:
+        logger.error(f"Tag pools check failed: {e}")
+
+
+async def ocr_backfill_job(context: ContextTypes.DEFAULT_TYPE):
+    """Распознавание текста мемов, добавленных не через бота или до появления OCR"""
+    try:
+        await run_blocking(ocr.backfill, None, int(context.job.data["limit"]))
+    except Exception as e:
+        logger.error(f"OCR backfill failed: {e}")
+
+
+async def image_verify_job(context: ContextTypes.DEFAULT_TYPE):
+    """Проверка картинок новых и ещё не проверенных мемов (с сохранённой позиции)"""
+    try:
+        await run_blocking(image_integrity.verify_library, None, int(context.job.data["limit"]))
+    except Exception as e:
+        logger.error(f"Image verification failed: {e}")
+
+
+def register_maintenance_jobs(application, maintenance_config=None, worker_id=0):
+    """
+    Регистрирует задачи обслуживания в JobQueue.
+    Сверка и проверки нужны одни на весь бот (worker 0),
+    прогрев кеша и счётчики популярности — в каждом процессе.
+    """
+    intervals = {**DEFAULT_INTERVALS, **(maintenance_config or {})}
+    job_queue = application.job_queue
+
+    job_queue.run_repeating(
+        cache_warmup_job, interval=int(intervals["warmup_interval"]), first=1, name="cache_warmup"
+    )
+    # Цепь слоя данных, тёплый кеш и отложенные записи — свои у каждого процесса
+    job_queue.run_repeating(
+        data_layer_recovery_job, interval=int(intervals["data_layer_probe_interval"]),
+        name="data_layer_recovery"
+    )
+    # Счётчики и веса свои у каждого процесса
+    job_queue.run_repeating(
+        popularity_flush_job, interval=int(intervals["popularity_flush_interval"]),
+        name="popularity_flush"
+    )
+    if meme_manager.SELECTION_STRATEGY == "popular":
+        job_queue.run_repeating(
+            popularity_refresh_job, interval=int(intervals["popularity_refresh_interval"]), first=1,
+            name="popularity_refresh"
+        )
+        job_queue.run_repeating(
+            popularity_refresh_job, interval=int(intervals["popularity_full_refresh_interval"]),
+            data={"full": True}, name="popularity_full_refresh"
+        )
+    if worker_id == 0:
+        job_queue.run_repeating(
+            order_consistency_job, interval=int(intervals["order_check_interval"]), first=10,
+            name="order_consistency"
+        )
+        job_queue.run_repeating(
+            integrity_check_job, interval=int(intervals["integrity_interval"]), first=30,
+            name="integrity_check"
+        )
+        job_queue.run_once(metadata_backfill_job, when=20, name="metadata_backfill")
+        job_queue.run_repeating(
+            tag_pools_job, interval=int(intervals["tag_pool_check_interval"]), first=15, name="tag_pools"
+        )
+        # Каждый запуск ограничен limit мемами: очередной не начнётся, пока идёт предыдущий
+        if ocr.available():
+            job_queue.run_repeating(
+                ocr_backfill_job, interval=int(intervals["ocr_backfill_interval"]), first=60,
+                data={"limit": intervals["ocr_backfill_limit"]}, name="ocr_backfill"
+            )
+        job_queue.run_repeating(
+            image_verify_job, interval=int(intervals["image_verify_interval"]), first=120,
+            data={"limit": intervals["image_verify_limit"]}, name="image_verify"
+        )
+    logger.info(f"Maintenance jobs registered (worker {worker_id}): {intervals}")
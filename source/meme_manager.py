@@ -1,11 +1,22 @@
 import os
+import json
 import datetime
 import numpy as np
 import logging
 import base64
 from io import BytesIO
+import random
 import zipfile
-from source.mongo_manager import MongoManager
+import threading
+from contextlib import contextmanager
+from zoneinfo import ZoneInfo
+from source.mongo_manager import (
+    MongoManager, ORDER_CAS_RETRIES, ORDER_HOLE, TAG_POOL_HOLE, day_end, order_filter, order_key,
+)
+from source.permutation import get_permutation
+from source import popularity
+from source import degraded
+from source.image_info import detect_image_format
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +25,62 @@ mongo = MongoManager()
 # Глобальная переменная для папки с мемами (будет установлена из bot.py)
 MEMES_FOLDER = None
 
+# Способ выбора следующего мема (будет установлен из bot.py):
+#   array  — хранимая перестановка MEME_ORDER
+#   seeded — перестановка Фейстеля над снимком ID, хранятся только seed и позиция
+ORDER_MODE = "array"
+# Сколько промахов подряд (удалённые мемы, дыры пулов) допускается до проверки,
+# не пора ли сдаться; seeded-ротации после этого идут до конца цикла
+SEEDED_MAX_SKIPS = 32
+# Своя ротация без повторов у каждого чата (будет установлено из bot.py)
+PER_CHAT_ROTATION = False
+# Стратегия выбора (будет установлена из bot.py):
+#   shuffle — ротации выше (без повторов)
+#   popular — взвешенный случайный выбор, чаще лайкнутые мемы
+SELECTION_STRATEGY = "shuffle"
+LIKE_WEIGHT = popularity.DEFAULT_LIKE_WEIGHT
+# Перекрытие окна инкрементального обновления весов (расхождение часов процессов)
+POPULARITY_REFRESH_OVERLAP = datetime.timedelta(seconds=30)
+# Перекрытие окна инкрементального экспорта: created_at ставится до вставки, и мем
+# может появиться в коллекции уже после выгрузки (пачка импорта, расхождение часов)
+EXPORT_OVERLAP = datetime.timedelta(minutes=5)
+
+# Счётчики отправок/лайков этого процесса и веса для режима popular
+popularity_counters = popularity.PopularityCounters()
+popularity_sampler = popularity.WeightedSampler()
+_popularity_synced_at = None
+
+# Часовой пояс суток мема дня (будет установлен из bot.py): в его полночь
+# «сегодня» сменяется и TTL-индекс удаляет вчерашние записи user_memes
+DAY_TIMEZONE = datetime.timezone.utc
+
+# Деградированный режим (см. source/degraded.py; настраивается из bot.py)
+DEGRADED_MODE = True
+breaker = degraded.CircuitBreaker()
+warm_cache = degraded.WarmCache()
+pending_writes = degraded.PendingWrites()
+
+
+def set_selection_strategy(strategy, like_weight=popularity.DEFAULT_LIKE_WEIGHT):
+    """Установить стратегию выбора мемов: shuffle | popular"""
+    global SELECTION_STRATEGY, LIKE_WEIGHT
+    if strategy not in ("shuffle", "popular"):
+        raise ValueError(f"Unknown selection strategy: {strategy}")
+    SELECTION_STRATEGY = strategy
+    LIKE_WEIGHT = float(like_weight)
+
+
+def set_degraded_mode(config=None):
+    """Настройки выдачи при недоступной Mongo (секция degraded конфига)"""
+    global DEGRADED_MODE, breaker, warm_cache, pending_writes
+    cfg = {**degraded.DEFAULTS, **{k: v for k, v in (config or {}).items() if v is not None}}
+    DEGRADED_MODE = bool(cfg["enabled"])
+    breaker = degraded.CircuitBreaker(
+        int(cfg["failure_threshold"]), float(cfg["reset_timeout"]), float(cfg["call_timeout"])
+    )
+    warm_cache = degraded.WarmCache(int(cfg["warm_entries"]), int(float(cfg["warm_mb"]) * 1024 * 1024))
+    pending_writes = degraded.PendingWrites(int(cfg["max_pending_writes"]))
+
 
 def set_memes_folder(folder_path):
     """Установить путь к папке с мемами"""
@@ -21,6 +88,36 @@ def set_memes_folder(folder_path):
     MEMES_FOLDER = folder_path
 
 
+def set_order_mode(mode):
+    """Установить режим выбора мемов: array | seeded"""
+    global ORDER_MODE
+    if mode not in ("array", "seeded"):
+        raise ValueError(f"Unknown order mode: {mode}")
+    ORDER_MODE = mode
+
+
+def set_day_timezone(name="UTC"):
+    """Установить часовой пояс суток мема дня (имя из базы tz, например Europe/Moscow)"""
+    global DAY_TIMEZONE
+    DAY_TIMEZONE = datetime.timezone.utc if name in ("UTC", "", None) else ZoneInfo(name)
+
+
+def today():
+    """Сегодняшняя дата ("YYYY-MM-DD") в часовом поясе мема дня"""
+    return datetime.datetime.now(DAY_TIMEZONE).date().isoformat()
+
+
+def day_expires_at(date):
+    """Когда истекает запись мема дня date: полночь после него в часовом поясе мема дня (UTC)"""
+    return day_end(date, DAY_TIMEZONE)
+
+
+def set_per_chat_rotation(enabled):
+    """Включить отдельную ротацию для каждого чата"""
+    global PER_CHAT_ROTATION
+    PER_CHAT_ROTATION = bool(enabled)
+
+
 # -------------------- MEMES_LIST (синхронизация с папкой) --------------------
 def load_memes_list():
     """Возвращает список файлов мемов в папке memes"""
@@ -41,185 +138,522 @@ def sync_memes_with_db():
 
 
 # -------------------- MEME_ORDER (перемешивание) --------------------
-def shuffle_meme_order(admin_shuffle=False):
+# MEME_ORDER — np.ndarray[int32] (в БД упакован в Binary, см. MongoManager).
+# MEME_INDEX — позиция в MEME_ORDER следующего мема к показу.
+# Всё, что левее MEME_INDEX, уже показано в текущем цикле, правее — «непросмотренный хвост».
+# Добавление и удаление мемов правят MEME_ORDER точечно (см. MongoManager),
+# а полная сверка с коллекцией выполняется периодически (check_meme_order_consistency).
+def shuffle_meme_order(admin_shuffle=False, observed=None):
     """
     Перемешивание MEME_ORDER с учётом логики:
-    1) Удаление несуществующих индексов
+    1) Удаление несуществующих индексов (и дыр)
     2) Коррекция MEME_INDEX при удалениях
-    3) Частичное перемешивание хвоста после MEME_INDEX
+    3) Частичное перемешивание хвоста начиная с MEME_INDEX
     4) Полное перемешивание при admin_shuffle=True
+    Запись условная (порядок не менялся с момента чтения), при гонке — повтор.
+    observed — состояние, в котором цикл увиден исчерпанным: порядок пишется,
+    только если с тех пор его никто не менял, иначе возвращается None
+    (новый цикл уже начал другой процесс).
     """
+    for _ in range(ORDER_CAS_RETRIES):
+        state = mongo.get_bot_state()
+        if observed is not None and order_key(state) != order_key(observed):
+            return None
+        # Все существующие _id (только id, без картинок)
+        all_meme_ids = np.asarray(mongo.get_all_meme_ids(), dtype=np.int32)
+
+        if not len(all_meme_ids):
+            logger.warning("No memes in database")
+            mongo.set_meme_order(all_meme_ids, meme_index=0, last_count=0)
+            return all_meme_ids
+
+        # MEME_ORDER и MEME_INDEX
+        current_order = mongo.get_meme_order(state)
+        meme_index = min(state.get("MEME_INDEX", 0), len(current_order))  # Важно: это позиция, а не ID!
+        expected = order_filter(state)
+
+        # --- 4. Admin shuffle = полный пересорт ---
+        if admin_shuffle:
+            new_order = np.random.permutation(all_meme_ids)
+            meme_index = 0
+            logger.info("Admin shuffle: full reshuffle")
+        else:
+            # --- 1. Фильтрация MEME_ORDER от отсутствующих ID (дублей и дыр) ---
+            keep = np.zeros(len(current_order), dtype=bool)
+            keep[np.unique(current_order, return_index=True)[1]] = True  # первое вхождение
+            keep &= np.isin(current_order, all_meme_ids)
+            removed_count_left = int(np.count_nonzero(~keep[:meme_index]))
+            cleaned_order = current_order[keep]
+
+            # ⭐ ДОБАВЛЯЕМ ОТСУТСТВУЮЩИЕ ID ⭐ (в хвост, ниже он перемешивается)
+            missing_ids = np.setdiff1d(all_meme_ids, cleaned_order, assume_unique=True)
+            cleaned_order = np.concatenate([cleaned_order, missing_ids])
+
+            # --- 2. Корректируем MEME_INDEX после удаления слева ---
+            # Просмотренное слева от курсора сохраняется: курсор входит в условие записи
+            expected["MEME_INDEX"] = state.get("MEME_INDEX", 0)
+            meme_index = min(max(0, meme_index - removed_count_left), len(cleaned_order))
+
+            # --- 3. Частичное перемешивание непросмотренного хвоста ---
+            left = cleaned_order[:meme_index]
+            right = cleaned_order[meme_index:]
+            new_order = np.concatenate([left, np.random.permutation(right)])
+            logger.info(
+                f"Partial shuffle from MEME_INDEX={meme_index}, "
+                f"left size={len(left)}, right size={len(right)}"
+            )
 
-    state = mongo.get_bot_state()
-    memes = mongo.get_all_memes()
+        # --- Сохраняем в БД ---
+        if mongo.set_meme_order(new_order, meme_index=meme_index, last_count=len(all_meme_ids), expected=expected):
+            return new_order
+        if observed is not None:
+            return None
 
-    if not memes:
-        logger.warning("No memes in database")
-        return []
+    logger.warning("MEME_ORDER shuffle lost after retries, left for consistency check")
+    return None
 
-    # Все существующие _id
-    all_meme_ids = sorted(m["_id"] for m in memes)
 
-    # MEME_ORDER и MEME_INDEX
-    current_order = state.get("MEME_ORDER", [])
-    meme_index = state.get("MEME_INDEX", 0)  # Важно: это позиция, а не ID!
+def check_meme_order_consistency():
+    """
+    Периодическая сверка MEME_ORDER с коллекцией мемов.
+    Дешёвая проверка (count + размер массива); пересборка только при расхождении.
+    Возвращает True, если порядок пришлось пересобрать.
+    """
+    current_count = get_meme_count()
+    summary = mongo.get_meme_order_summary()
+
+    if (summary["LAST_MEMES_COUNT"] != current_count
+            or summary["order_size"] != current_count):
+        logger.info(
+            f"MEME_ORDER out of sync: count={current_count}, "
+            f"last_count={summary['LAST_MEMES_COUNT']}, order_size={summary['order_size']}"
+        )
+        shuffle_meme_order(admin_shuffle=False)
+        return True
 
-    # --- 1. Фильтрация MEME_ORDER от отсутствующих ID ---
-    cleaned_order = []
-    removed_count_left = 0
+    return False
 
-    for pos, meme_id in enumerate(current_order):
-        if meme_id in all_meme_ids:
-            cleaned_order.append(meme_id)
-        else:
-            if pos <= meme_index:
-                removed_count_left += 1
 
-    # ⭐ ДОБАВЛЯЕМ ОТСУТСТВУЮЩИЕ ID ⭐
-    missing_ids = [m for m in all_meme_ids if m not in cleaned_order]
-    cleaned_order.extend(missing_ids)
+def ensure_memes_count_is_actual():
+    """Совместимость: то же, что check_meme_order_consistency()"""
+    return check_meme_order_consistency()
 
-    # Если список пуст — создаём полный порядок по БД
-    if not cleaned_order:
-        cleaned_order = all_meme_ids.copy()
-        meme_index = 0
-    else:
-        # --- 2. Корректируем MEME_INDEX после удаления слева ---
-        meme_index = max(0, meme_index - removed_count_left)
-        # MEME_INDEX не должен выходить за пределы списка
-        if meme_index >= len(cleaned_order):
-            meme_index = max(0, len(cleaned_order) - 1)
-
-    # Список актуален
-    current_order = cleaned_order
-
-    # --- 4. Admin shuffle = полный пересорт ---
-    if admin_shuffle:
-        new_order = [int(x) for x in np.random.permutation(all_meme_ids)]
-        meme_index = 0
-        logger.info("Admin shuffle: full reshuffle")
-    else:
-        # --- 3. Частичное перемешивание правой части ---
-        if meme_index < len(current_order) - 1:
-            left = current_order[:meme_index + 1]
-            right = current_order[meme_index + 1:]
 
-            right_shuffled = [int(x) for x in np.random.permutation(right)]
-            new_order = left + right_shuffled
+def warm_up_caches():
+    """
+    Прогрев кешей процесса: актуальный MEME_ORDER читается заранее, а не при выдаче мема;
+    тёплый кеш деградированного режима дополняется свежими file_id (без картинок);
+    в режиме popular первый раз строятся веса (вне ограничения времени вызова — это полный проход).
+    """
+    if SELECTION_STRATEGY == "popular" and _popularity_synced_at is None:
+        refresh_popularity(full=True)
+    with data_layer():
+        if ORDER_MODE == "array":
+            mongo.get_meme_order(mongo.get_bot_state())
+        if DEGRADED_MODE and len(warm_cache) < warm_cache.max_entries // 2:
+            for meme_id, file_id in mongo.get_file_id_page(limit=warm_cache.max_entries // 2):
+                warm_cache.remember(meme_id, file_id=file_id)
 
-            logger.info(
-                f"Partial shuffle after MEME_INDEX={meme_index}, "
-                f"left size={len(left)}, right size={len(right)}"
-            )
-        else:
-            # Нечего перемешивать
-            new_order = current_order.copy()
-            logger.info("Nothing to shuffle (pointer at end)")
 
-    # --- Сохраняем в БД ---
-    mongo.update_bot_state({
-        "MEME_ORDER": new_order,
-        "MEME_INDEX": int(meme_index),
-        "LAST_MEMES_COUNT": len(all_meme_ids)
-    })
+class OrderCycleExhausted(Exception):
+    """MEME_ORDER исчерпан внутри ограниченного по времени блока: перемешивание — вне его"""
 
-    return new_order
 
+# Поток сейчас внутри data_layer() с ограничением времени
+_budget = threading.local()
 
-def prepare_meme_order_if_needed():
+
+@contextmanager
+def data_layer(timed=True):
+    """
+    Блок запросов к Mongo: в деградированном режиме — через breaker
+    (timed — с ограничением времени call_timeout на весь блок).
     """
-    Подготовить MEME_ORDER, если нужно (когда количество мемов изменилось)
-    Возвращает True, если было выполнено перемешивание
+    if not DEGRADED_MODE:
+        yield
+        return
+    outer = getattr(_budget, "active", False)
+    with breaker.guard(timed):
+        _budget.active = timed
+        try:
+            yield
+        finally:
+            _budget.active = outer
+
+
+def call_data_layer(func, *args, **kwargs):
+    """func(*args, **kwargs) внутри data_layer() — для хендлеров через run_in_executor"""
+    with data_layer():
+        return func(*args, **kwargs)
+
+
+def recover_data_layer():
+    """
+    Пока цепь разомкнута — пробный ping; когда Mongo отвечает — отложенные
+    записи повторяются по порядку. Возвращает число повторённых записей.
+    """
+    if not breaker.closed:
+        try:
+            breaker.call(mongo.client.admin.command, "ping")
+        except degraded.DataLayerUnavailable:
+            return 0
+    return pending_writes.replay(mongo, breaker)
+
+
+def deferred_write(method, *args):
+    """Запись в Mongo через breaker; при недоступности — в очередь повторов"""
+    if not DEGRADED_MODE:
+        return getattr(mongo, method)(*args)
+    try:
+        return breaker.call(getattr(mongo, method), *args)
+    except degraded.DataLayerUnavailable:
+        pending_writes.add(method, *args)
+        return None
+
+
+def check_state_integrity():
     """
+    Проверка инвариантов состояния; найденное исправляется на месте.
+    Возвращает список описаний проблем (пустой — всё в порядке).
+    """
+    problems = []
     state = mongo.get_bot_state()
-    current_count = mongo.count_memes()
-    last_count = state.get("LAST_MEMES_COUNT", 0)
-    
-    if current_count != last_count or not state.get("MEME_ORDER"):
+    meme_index = state.get("MEME_INDEX", 0)
+    order_size = state.get("ORDER_SIZE", 0)
+
+    if not 0 <= meme_index <= order_size:
+        problems.append(f"MEME_INDEX={meme_index} out of range [0, {order_size}]")
+        mongo.update_bot_state({"MEME_INDEX": min(max(0, meme_index), order_size)})
+
+    order = mongo.get_meme_order(state)
+    if len(order) != order_size:
+        problems.append(f"ORDER_SIZE={order_size} but MEME_ORDER has {len(order)} entries")
+    live = order[order != ORDER_HOLE]
+    if len(np.unique(live)) != len(live):
+        problems.append("MEME_ORDER contains duplicates")
+    if problems:
         shuffle_meme_order(admin_shuffle=False)
-        return True
-    return False
 
-def ensure_memes_count_is_actual():
-    """Проверяет, совпадает ли количество мемов с сохранённым LAST_MEMES_COUNT.
-    Если нет — перемешивает MEME_ORDER и обновляет LAST_MEMES_COUNT.
+    legacy = mongo.cleanup_legacy_user_memes(today())
+    if legacy:
+        problems.append(f"removed {legacy} legacy user_memes without expires_at")
+
+    return problems
+
+
+# -------------------- get_random_meme (ОСНОВНОЕ ИЗМЕНЕНИЕ) --------------------
+def to_photo(data):
+    """Байты картинки -> файл для отправки в Telegram"""
+    bio = BytesIO(data)
+    bio.name = f"image.jpg"  # важно указать имя файла!
+    return bio
+
+
+def next_meme_id_from_order():
+    """
+    Атомарно сдвигает MEME_INDEX и возвращает ID мема на прежней позиции.
+    Конец цикла -> полное перемешивание и новый цикл (см. start_order_cycle).
+    Внутри data_layer() с ограничением времени вместо перемешивания —
+    OrderCycleExhausted: на большой библиотеке оно не уложится в call_timeout
+    и разомкнёт цепь.
+    """
+    for _ in range(3):
+        meme_id = mongo.advance_meme_index()
+        if meme_id is not None:
+            return meme_id
+        if getattr(_budget, "active", False):
+            raise OrderCycleExhausted()
+        # Порядок пуст или исчерпан: новый цикл
+        if not start_order_cycle():
+            return None
+    return None
+
+
+def start_order_cycle():
+    """
+    Новый цикл MEME_ORDER, если текущий исчерпан и его ещё никто не перезапустил:
+    перемешивает только процесс, чья условная запись прошла, остальные просто
+    перечитывают состояние. False — мемов нет.
     """
-    current_count = get_meme_count()
     state = mongo.get_bot_state()
+    if state.get("MEME_INDEX", 0) < state.get("ORDER_SIZE", 0):
+        return True
+    new_order = shuffle_meme_order(admin_shuffle=True, observed=state)
+    return new_order is None or len(new_order) > 0
 
-    last_count = state.get("LAST_MEMES_COUNT", None)
 
-    print('last_count', last_count, 'current_count', current_count)
+def rotation_meme_id(state):
+    """
+    ID мема на позиции цикла seeded-ротации (общей или чата): ранг в снимке ID цикла.
+    У циклов, начатых до снимков, индекс перестановки — сам _id.
+    None — снимок истёк (цикл пережил срок хранения снимков), нужен новый цикл.
+    """
+    index = get_permutation(state["domain"], state["seed"])[state["pos"]]
+    if not state.get("snapshot"):
+        return int(index)
+    ids = mongo.get_snapshot_ids(state["snapshot"])
+    return None if ids is None else int(ids[index])
 
-    # Если кол-во другое → надо пересоздать и перемешать порядок
-    if last_count is None or last_count != current_count:
-        new_order = shuffle_meme_order(admin_shuffle=False)
-        print(new_order)
-        return True
 
-    return False
+def next_meme_id_seeded():
+    """
+    Следующий кандидат в seeded-режиме: ID = снимок[perm(seed)[pos]].
+    Снимок — активные мемы на начало цикла, поэтому промахом кандидат бывает, только
+    если мем удалили посреди цикла (вызывающий берёт следующий).
+    Мемы, добавленные посреди цикла, попадут в перестановку со следующего цикла.
+    """
+    for _ in range(2):
+        state = mongo.advance_seeded_position()
+        stale = None
+        if state is not None:
+            meme_id = rotation_meme_id(state)
+            if meme_id is not None:
+                return meme_id
+            stale = state["snapshot"]["version"]
+        snapshot = mongo.get_id_snapshot()
+        if not snapshot["count"]:
+            return None
+        # Новый цикл — новый seed
+        mongo.start_seeded_cycle(random.getrandbits(63), snapshot, stale=stale)
+        logger.info(f"Seeded order: new cycle over {snapshot['count']} memes")
+    return None
+
+
+def next_meme_id_for_chat(chat_id):
+    """
+    Следующий кандидат из ротации чата: та же перестановка Фейстеля над снимком ID,
+    что и в seeded-режиме, но seed и позиция свои у каждого чата (коллекция chat_rotations).
+    """
+    for _ in range(2):
+        state = mongo.advance_chat_position(chat_id)
+        stale = None
+        if state is not None:
+            meme_id = rotation_meme_id(state)
+            if meme_id is not None:
+                return meme_id
+            stale = state["snapshot"]["version"]
+        snapshot = mongo.get_id_snapshot()
+        if not snapshot["count"]:
+            return None
+        mongo.start_chat_cycle(chat_id, random.getrandbits(63), snapshot, stale=stale)
+    return None
+
+
+def next_meme_id_for_tag(tag):
+    """
+    Следующий мем из пула тега: позиция ротации тега -> индекс перестановки ->
+    ID из упакованного массива пула. Без выборки по коллекции мемов.
+    Мемы, добавленные в пул посреди цикла, попадут в перестановку со следующего цикла.
+    """
+    restarts = 0
+    for _ in range(SEEDED_MAX_SKIPS):
+        state = mongo.advance_tag_position(tag)
+        if state is None:
+            # Цикл исчерпан (или ещё не начат): новый seed над текущим размером пула
+            restarts += 1
+            if restarts > 2 or not mongo.start_tag_cycle(tag, random.getrandbits(63)):
+                return None
+            continue
+        ids = mongo.get_tag_pool_ids(tag, state.get("version"))
+        index = get_permutation(state["domain"], state["seed"])[state["pos"]]
+        # Пул мог измениться посреди цикла: дыры на месте убранных ID пропускаются
+        if index < len(ids) and ids[index] != TAG_POOL_HOLE:
+            return int(ids[index])
+    return None
+
+
+# -------------------- популярность --------------------
+def flush_popularity():
+    """Записать накопленные счётчики одним bulk_write"""
+    pending = popularity_counters.drain()
+    if not pending:
+        return 0
+    try:
+        mongo.inc_meme_stats(pending)
+    except Exception:
+        popularity_counters.restore(pending)
+        raise
+    return len(pending)
 
 
-# -------------------- get_random_meme (ОСНОВНОЕ ИЗМЕНЕНИЕ) --------------------
-def get_random_meme():
+def refresh_popularity(full=False):
+    """
+    Обновляет веса режима popular: первый раз (и при full) — по всем мемам,
+    дальше — только по изменившимся с прошлого обновления.
+    """
+    global _popularity_synced_at
+    started = datetime.datetime.utcnow()
+    since = None if full or _popularity_synced_at is None else _popularity_synced_at
+    weights = {
+        meme_id: 0 if counts is None else popularity.meme_weight(*counts, like_weight=LIKE_WEIGHT)
+        for meme_id, counts in mongo.get_meme_stats(since).items()
+    }
+    if since is None:
+        popularity_sampler.replace(weights)
+    else:
+        popularity_sampler.update(weights)
+    _popularity_synced_at = started - POPULARITY_REFRESH_OVERLAP
+    return len(weights)
+
+
+def record_like(meme_id, message_key, user_id):
     """
-    Возвращает BASE64 строки мема с учётом MEME_ORDER и MEME_INDEX.
+    Лайк мема под сообщением message_key. Повтор отсекается памятью процесса,
+    а между процессами — отметкой в Mongo; если Mongo не отвечает, только памятью.
+    Возвращает True, если лайк засчитан.
+    """
+    key = (message_key, user_id)
+    if popularity_counters.is_liked(key):
+        return False
+    try:
+        with data_layer():
+            first = mongo.claim_like(message_key, user_id)
+    except degraded.DataLayerUnavailable:
+        first = True
+    return popularity_counters.record_like(meme_id, key, counted=first)
+
+
+def next_meme_id_popular():
+    """
+    Взвешенный по популярности случайный ID (повторы возможны).
+    Веса строит фоновая задача; пока их нет, мем берётся из обычной ротации.
+    """
+    if _popularity_synced_at is None:
+        return next_meme_id_seeded() if ORDER_MODE == "seeded" else next_meme_id_from_order()
+    return popularity_sampler.sample()
+
+
+# -------------------- file_id Telegram --------------------
+# ID мемов, чей file_id уже записан (чтобы не писать его при каждой отправке)
+_KNOWN_FILE_IDS_MAX = 100_000
+_known_file_ids = set()
+
+
+def remember_file_id(meme_id, file_id):
+    """Сохранить file_id отправленного мема — по нему мем работает в инлайн-режиме"""
+    if meme_id is None or not file_id:
+        return
+    warm_cache.remember(meme_id, file_id=file_id)
+    if meme_id in _known_file_ids:
+        return
+    deferred_write("set_meme_file_id", meme_id, file_id)
+    if len(_known_file_ids) >= _KNOWN_FILE_IDS_MAX:
+        _known_file_ids.clear()
+    _known_file_ids.add(meme_id)
+
+
+def get_random_meme(chat_id=None, tag=None):
+    """
+    Возвращает BASE64 строки мема с учётом MEME_ORDER и MEME_INDEX
+    (или seed/позиции в режиме seeded, или ротации чата chat_id,
+    или ротации пула тега tag).
     Больше НЕ использует папку с мемами.
+    Если Mongo не отвечает — мем из тёплого кеша (file_id или картинка).
     """
-    # Никакой sync с файлов нет
-    # prepare_meme_order_if_needed()
-    
-    state = mongo.get_bot_state()
-    meme_order = state.get("MEME_ORDER", [])
-    current_meme_id = state.get("MEME_INDEX", 0)
-    total_memes = mongo.count_memes()
-    
-    if not meme_order or total_memes == 0:
-        logger.warning("No memes available in DB")
-        return None, None
-    
-    # Если текущего ID нет в порядке — пересобираем порядок
-    if current_meme_id not in meme_order or len(meme_order) != total_memes:
-        shuffle_meme_order(admin_shuffle=False)
-        state = mongo.get_bot_state()
-        meme_order = state.get("MEME_ORDER", [])
-        current_meme_id = state.get("MEME_INDEX", 0)
-    
-    # Определяем позицию
     try:
-        position = meme_order.index(current_meme_id)
-    except ValueError:
-        position = 0
-        current_meme_id = meme_order[0]
-    
-    # Если дошли до конца — полное перемешивание
-    if position >= len(meme_order) - 1:
-        shuffle_meme_order(admin_shuffle=True)
-        state = mongo.get_bot_state()
-        meme_order = state.get("MEME_ORDER", [])
-        position = 0
-        current_meme_id = meme_order[0]
-    else:
-        position += 1
-        current_meme_id = meme_order[position]
-    
-    # Получаем документ мема
-    meme_doc = mongo.get_meme_by_id(current_meme_id)
-    if not meme_doc:
-        logger.error(f"Meme with _id={current_meme_id} not found in DB")
+        for attempt in range(2):
+            try:
+                with data_layer():
+                    data, meme_id = next_meme(chat_id, tag)
+                break
+            except OrderCycleExhausted:
+                if attempt:
+                    return None, None
+                # Новый цикл MEME_ORDER: полное перемешивание — без ограничения времени
+                with data_layer(timed=False):
+                    start_order_cycle()
+    except degraded.DataLayerUnavailable:
+        return get_warm_meme()
+    if data is None:
         return None, None
-    
-    base64_image = meme_doc["image"]
+    if DEGRADED_MODE:
+        warm_cache.remember(meme_id, data)
+    return to_photo(data), meme_id
 
-    # Обновляем индекс
-    mongo.update_bot_state({'MEME_INDEX': current_meme_id})
 
-    # Возвращаем base64 изображение
-    data = base64.b64decode(base64_image)
-    bio = BytesIO(data)
-    bio.name = f"image.jpg"  # важно указать имя файла!
-
-    return bio, current_meme_id
+def get_warm_meme():
+    """Мем из тёплого кеша (Mongo не трогается): file_id, если известен, иначе картинка"""
+    item = warm_cache.next()
+    if item is None:
+        logger.warning("Data layer unavailable and warm cache is empty")
+        return None, None
+    meme_id, data, file_id = item
+    popularity_counters.record_send(meme_id)
+    return (file_id if file_id else to_photo(data)), meme_id
+
+
+def next_meme(chat_id=None, tag=None):
+    """Следующий мем выбранной ротации: (bytes, ID) или (None, None)"""
+    # В seeded-ротациях промахи (удалённые посреди цикла мемы) ожидаемы, поэтому попыток больше;
+    # until_exhausted — после SEEDED_MAX_SKIPS промахов не сдаваться, а идти до конца цикла
+    seeded, until_exhausted = True, False
+    if tag is not None:
+        next_id, attempts = (lambda: next_meme_id_for_tag(tag)), SEEDED_MAX_SKIPS
+    elif SELECTION_STRATEGY == "popular":
+        next_id, attempts = next_meme_id_popular, SEEDED_MAX_SKIPS
+    elif PER_CHAT_ROTATION and chat_id is not None:
+        next_id, attempts, until_exhausted = (lambda: next_meme_id_for_chat(chat_id)), SEEDED_MAX_SKIPS, True
+    elif ORDER_MODE == "seeded":
+        next_id, attempts, until_exhausted = next_meme_id_seeded, SEEDED_MAX_SKIPS, True
+    else:
+        # Несколько попыток на случай, если мем удалили между сверками порядка
+        next_id, attempts, seeded = next_meme_id_from_order, 3, False
+
+    misses = 0
+    while misses < attempts:
+        current_meme_id = next_id()
+        if current_meme_id is None:
+            logger.warning("No memes available in DB")
+            return None, None
+
+        # Получаем картинку мема (через кеш)
+        data = mongo.get_meme_image(current_meme_id)
+        if data is not None:
+            popularity_counters.record_send(current_meme_id)
+            return data, current_meme_id
+
+        if SELECTION_STRATEGY == "popular":
+            # Мем удалён после последнего обновления весов
+            popularity_sampler.update({current_meme_id: 0})
+        if not seeded:
+            logger.error(f"Meme with _id={current_meme_id} not found in DB")
+        misses += 1
+        if until_exhausted and misses == SEEDED_MAX_SKIPS:
+            # Посреди цикла удалили много мемов снимка: снимок не длиннее max(_id) + 1,
+            # а новый цикл снимается уже без них — столько попыток хватит до живого мема
+            attempts += (mongo.get_max_meme_id() or 0) + 1
+
+    return None, None
+
+
+def pick_meme_ids(count):
+    """
+    До count разных существующих мемов из общей ротации (без привязки к чату) —
+    например, набор дня для рассылки. Проверка существования — одним запросом.
+    """
+    if SELECTION_STRATEGY == "popular":
+        next_id = next_meme_id_popular
+    elif ORDER_MODE == "seeded":
+        next_id = next_meme_id_seeded
+    else:
+        next_id = next_meme_id_from_order
+    picked = []
+    for _ in range(SEEDED_MAX_SKIPS):
+        candidates = []
+        for _ in range(count - len(picked)):
+            meme_id = next_id()
+            if meme_id is None:
+                break
+            meme_id = int(meme_id)
+            if meme_id not in picked and meme_id not in candidates:
+                candidates.append(meme_id)
+        if not candidates:
+            break
+        active = mongo.get_active_meme_ids(candidates)
+        picked.extend(meme_id for meme_id in candidates if meme_id in active)
+        if len(picked) >= count:
+            break
+    return picked
 
 
 # -------------------- MEMES_DAY --------------------
@@ -227,32 +661,30 @@ def get_user_meme_of_the_day(user_id):
     """
     Возвращает base64 мема дня.
     """
-    today = datetime.date.today().isoformat()
-    
-    user_doc = mongo.get_user_meme(user_id)
-
-    # Если мем уже есть и сегодняшний
-    if user_doc and user_doc.get("date") == today:
-        meme_id = user_doc.get("meme_id")
-        meme_doc = mongo.get_meme_by_id(meme_id)
-        if meme_doc:
-            base64_img = meme_doc["image"]
-            data = base64.b64decode(base64_img)
-            base64_img = BytesIO(data)
-            base64_img.name = f"image.jpg"
-            return base64_img
-        else:
-            mongo.delete_user_meme(user_id)
-            # Выбираем новый мем
-            base64_img, meme_id = get_random_meme()
-    else:
-        # Выбираем новый мем
-        base64_img, meme_id = get_random_meme()
+    day = today()
+
+    try:
+        with data_layer():
+            user_doc = mongo.get_user_meme(user_id)
+
+            # Если мем уже есть и сегодняшний
+            if user_doc and user_doc.get("date") == day:
+                meme_id = user_doc.get("meme_id")
+                data = mongo.get_meme_image(meme_id)
+                if data is not None:
+                    return to_photo(data)
+                mongo.delete_user_meme(user_id)
+    except degraded.DataLayerUnavailable:
+        # Mongo не отвечает: мем дня из тёплого кеша, запись — когда Mongo вернётся
+        pass
+
+    # Выбираем новый мем (личная ротация пользователя, если включена)
+    base64_img, meme_id = get_random_meme(chat_id=user_id)
 
     if base64_img is None:
         return 'None', 'None'
-    
-    mongo.set_user_meme(user_id, meme_id, today)
+
+    deferred_write("set_user_meme", user_id, meme_id, day, day_expires_at(day))
 
     return base64_img
 
@@ -264,16 +696,29 @@ def get_meme_count():
 
 
 # -------------------- create_memes_zip_from_db --------------------
-def create_memes_zip_from_db_stream():
+def create_memes_zip_from_db_stream(watermark=None):
     """
     Создает ZIP архив мемов из MongoDB без загрузки всех мемов в память.
+    watermark — отметка прошлого экспорта ({"at"}): в архив попадут мемы, добавленные
+    или восстановленные из корзины после неё (с запасом EXPORT_OVERLAP, поэтому соседние
+    архивы могут повторять мемы — импорт их отсекает по содержимому), а manifest.json
+    перечислит удалённые. Отметка — время, а не наибольший _id: _id выдаётся до вставки,
+    и мем с меньшим _id может появиться позже выгруженного большего.
+    Без watermark — полный архив.
+    Возвращает (путь к архиву, новая отметка, манифест).
     """
-    cursor = mongo.get_memes_cursor()  # <- новый потоковый метод
+    started_at = datetime.datetime.utcnow()
+    since = watermark["at"] - EXPORT_OVERLAP if watermark else None
+    cursor = mongo.get_memes_cursor(since=since)
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     temp_folder = 'temp'
     os.makedirs(temp_folder, exist_ok=True)
-    zip_path = f"{temp_folder}/memes_export_{timestamp}.zip"
+    kind = "incremental" if watermark else "full"
+    zip_path = f"{temp_folder}/memes_export_{kind}_{timestamp}.zip"
 
+    exported = []
+    restored = []
+    skipped = []
     with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as zipf:
         for meme in cursor:
             meme_id = meme["_id"]
@@ -282,9 +727,80 @@ def create_memes_zip_from_db_stream():
                 binary = base64.b64decode(base64_str)
             except Exception as e:
                 logger.error(f"Ошибка декодирования base64 для ID={meme_id}: {e}")
+                skipped.append(meme_id)
                 continue
 
             filename = f"{meme_id:04d}.jpg"
             zipf.writestr(filename, binary)  # записываем сразу в ZIP
-
-    return zip_path
\ No newline at end of file
+            exported.append(meme_id)
+            if since is not None and meme.get("restored_at") and meme["restored_at"] > since:
+                restored.append(meme_id)
+
+        # Удалённые после прошлой выгрузки: по ним восстановление из бэкапов убирает лишнее
+        deleted = [] if watermark is None else [
+            {"id": t["_id"], "kind": t["kind"], "deleted_at": t["deleted_at"].isoformat()}
+            for t in mongo.get_tombstones_since(since)
+        ]
+        manifest = {
+            "type": kind,
+            "created_at": started_at.isoformat(),
+            "since": since.isoformat() if since else None,
+            "last_id": exported[-1] if exported else None,
+            "memes": len(exported),
+            "restored": restored,
+            "deleted": deleted,
+            # Не попали в архив: картинка не декодируется (см. /verify_images)
+            "skipped": skipped,
+        }
+        zipf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    new_watermark = {"at": started_at}
+    return zip_path, new_watermark, manifest
+
+
+# -------------------- импорт из ZIP --------------------
+# Картинок в одной пачке insert_many
+IMPORT_BATCH_SIZE = 100
+# Записи архива больше этого размера пропускаются (защита от zip-бомб)
+IMPORT_MAX_ENTRY_BYTES = 20 * 1024 * 1024
+
+
+def import_memes_zip(fileobj, uploader=None, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Импортирует картинки из ZIP архива (например, из /export_memes).
+    Записи читаются из архива по одной, без распаковки на диск, и пишутся
+    пачками с дедупликацией по содержимому. Генератор: после каждой пачки
+    отдаёт статистику {"total", "processed", "added", "duplicates", "skipped"},
+    последнее значение — итог.
+    """
+    stats = {"total": 0, "processed": 0, "added": 0, "duplicates": 0, "skipped": 0}
+    with zipfile.ZipFile(fileobj) as archive:
+        entries = [info for info in archive.infolist() if not info.is_dir()]
+        stats["total"] = len(entries)
+        batch = []
+
+        def flush():
+            new_ids, duplicates = mongo.add_memes_batch(batch, uploader=uploader)
+            stats["added"] += len(new_ids)
+            stats["duplicates"] += duplicates
+            batch.clear()
+
+        for info in entries:
+            stats["processed"] += 1
+            if info.file_size > IMPORT_MAX_ENTRY_BYTES:
+                stats["skipped"] += 1
+                continue
+            with archive.open(info) as entry:
+                data = entry.read()
+            # manifest.json и прочие не-картинки
+            if detect_image_format(data[:12]) is None:
+                stats["skipped"] += 1
+                continue
+            batch.append(data)
+            if len(batch) >= batch_size:
+                flush()
+                yield dict(stats)
+        if batch:
+            flush()
+    logger.info(f"ZIP import finished: {stats}")
+    yield dict(stats)
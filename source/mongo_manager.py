@@ -1,8 +1,20 @@
+# Модули для работы с мемами и MongoDB
+
 import os
 import logging
 import base64
-from pymongo import MongoClient
+import hashlib
+import random
+import datetime
+import threading
+import numpy as np
+from bson import Binary, ObjectId
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from dotenv import load_dotenv
+from source.image_cache import get_image_cache
+from source.image_info import base64_info, base64_decoded_size, detect_image_format
+from source import profiling
 
 load_dotenv()  # Загружаем .env
 
@@ -10,102 +22,1022 @@ logger = logging.getLogger(__name__)
 
 # DB_NAME = "memebot_db"
 
+# Мемы, участвующие в ротации (мягко удалённые лежат в корзине панели)
+ACTIVE_FILTER = {"deleted": {"$ne": True}}
+
+# MEME_ORDER: упакованный int32 little-endian
+ORDER_DTYPE = np.dtype("<i4")
+# Больше стольких элементов порядок пишется кусками (лимит документа Mongo — 16 МБ)
+ORDER_CHUNK_ENTRIES = 2_000_000
+# Попыток условного обновления порядка при гонке с другими процессами
+ORDER_CAS_RETRIES = 5
+# Место убранного из MEME_ORDER ID до конца цикла
+ORDER_HOLE = -1
+# После стольких точечных правок MEME_ORDER они вливаются в сам массив
+ORDER_PATCH_MAX_OPS = 256
+# Поля bot_state, по которым собирается MEME_ORDER (без самого массива)
+ORDER_META_PROJECTION = {
+    "ORDER_VERSION": 1, "ORDER_SIZE": 1, "ORDER_PATCH": 1, "ORDER_PATCH_SEQ": 1, "MEME_ORDER_CHUNKS": 1,
+}
+# Сколько дней хранится ротация неактивного чата
+CHAT_ROTATION_TTL_DAYS = 180
+# Снимки ID для seeded-ротаций живут столько же (на снимок ссылается цикл чата)
+ID_SNAPSHOT_TTL_DAYS = CHAT_ROTATION_TTL_DAYS
+# Сколько снимков ID процесс держит в кеше
+ID_SNAPSHOT_CACHE_SIZE = 4
+
+# Сортировки списка мемов панели: поле ключа и направление.
+# Вторым ключом всегда идёт _id в том же направлении — по паре (ключ, _id)
+# строится курсор keyset-пагинации, и каждой сортировке соответствует индекс.
+MEME_SORTS = {
+    "id": (None, 1),
+    "new": ("created_at", -1),
+    "old": ("created_at", 1),
+    "size": ("size", -1),
+}
+# Сколько дней хранятся поэлементные записи рассылок (сводка в broadcasts остаётся)
+BROADCAST_ITEMS_TTL_DAYS = 7
+# Сколько пулов тегов процесс держит в кеше (ID пула читаются заново только при смене версии)
+TAG_POOL_CACHE_SIZE = 256
+# Место убранного из пула тега ID до конца цикла ротации
+TAG_POOL_HOLE = -1
+# Язык стемминга текстового индекса распознанных подписей
+OCR_TEXT_LANGUAGE = "russian"
+# Сколько дней помнятся лайки (сообщение, пользователь) для защиты от повторов
+LIKE_DEDUP_TTL_DAYS = 30
+# Сколько часов хранится сборка альбома (после сводки она не нужна)
+PENDING_ALBUM_TTL_HOURS = 1
+# Мемов за один проход дозаполнения метаданных
+METADATA_BACKFILL_BATCH = 500
+# Для хеша нужна сама картинка — эти пачки меньше
+HASH_BACKFILL_BATCH = 50
+
+
+def day_end(date, tz=datetime.timezone.utc):
+    """Конец суток date ("YYYY-MM-DD") в часовом поясе tz — aware datetime в UTC"""
+    day = datetime.date.fromisoformat(date)
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min, tzinfo=tz)
+    return end.astimezone(datetime.timezone.utc)
+
+
+def content_hash(data):
+    """sha256 содержимого картинки — ключ дедупликации"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def normalize_tags(tags):
+    """Теги в нижнем регистре без # и пробелов по краям, без повторов (порядок сохраняется)"""
+    normalized = (str(tag).strip().lstrip("#").strip().lower() for tag in tags or [])
+    return list(dict.fromkeys(tag for tag in normalized if tag))
+
+
+def group_by_tag(docs):
+    """Документы мемов с полем tags -> {тег: [_id]}"""
+    members = {}
+    for doc in docs:
+        for tag in doc.get("tags") or []:
+            members.setdefault(tag, []).append(doc["_id"])
+    return members
+
+
+def order_key(state):
+    """Версия MEME_ORDER с учётом правок: (ORDER_VERSION, ORDER_PATCH_SEQ)"""
+    return state.get("ORDER_VERSION"), state.get("ORDER_PATCH_SEQ") or 0
+
+
+def order_filter(state):
+    """Условие «MEME_ORDER не менялся с чтения state» (без курсора MEME_INDEX)"""
+    version, seq = order_key(state)
+    return {"ORDER_VERSION": version, "ORDER_PATCH_SEQ": seq if seq else {"$in": [0, None]}}
+
+
+def encode_order(order):
+    """np.ndarray / list -> BSON Binary с int32"""
+    return Binary(np.ascontiguousarray(order, dtype=ORDER_DTYPE).tobytes())
+
+
+def decode_order(value):
+    """BSON Binary (или старый массив) -> np.ndarray[int32]; для Binary без копирования"""
+    if value is None:
+        return np.empty(0, dtype=ORDER_DTYPE)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return np.frombuffer(value, dtype=ORDER_DTYPE)
+    return np.asarray(value, dtype=ORDER_DTYPE)
+
+
+# -------------------- Реестр клиентов (один пул на процесс) --------------------
+# MongoClient сам по себе является пулом соединений и потокобезопасен,
+# поэтому держим ровно один клиент на URI в рамках процесса.
+# Ключ включает PID: после fork (gunicorn --preload) дочерний процесс
+# не должен пользоваться сокетами родителя — он создаст свой клиент.
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+# Коллекции, для которых индексы уже созданы в этом процессе
+_INDEXES_READY = set()
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def build_mongo_uri():
+    """Собирает URI подключения из окружения"""
+    # Приоритет 1: Используем MONGO_URI если он задан (из docker-compose)
+    mongo_uri = os.getenv("MONGO_URI")
+    if mongo_uri:
+        logger.info("Using MONGO_URI from environment")
+        return mongo_uri
+
+    # Приоритет 2: Собираем URI из отдельных переменных
+    mongo_user = os.getenv("MONGO_USER", "")
+    mongo_pass = os.getenv("MONGO_PASS", "")
+    mongo_port = os.getenv("MONGO_PORT") or "27017"
+    # MONGO_HOST может быть задан в .env или docker-compose, иначе localhost
+    mongo_host = os.getenv("MONGO_HOST") or "localhost"
+
+    logger.info(f"Using MongoDB connection: {mongo_host}:{mongo_port}")
+    if mongo_user and mongo_pass:
+        return f"mongodb://{mongo_user}:{mongo_pass}@{mongo_host}:{mongo_port}"
+    return f"mongodb://{mongo_host}:{mongo_port}"
+
+
+def client_options():
+    """
+    Параметры пула и сети для MongoClient.
+    Все значения можно переопределить через .env.
+    """
+    return {
+        "maxPoolSize": _env_int("MONGO_MAX_POOL_SIZE", 20),
+        "minPoolSize": _env_int("MONGO_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": _env_int("MONGO_MAX_IDLE_TIME_MS", 300000),
+        "connectTimeoutMS": _env_int("MONGO_CONNECT_TIMEOUT_MS", 5000),
+        "serverSelectionTimeoutMS": _env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+        "socketTimeoutMS": _env_int("MONGO_SOCKET_TIMEOUT_MS", 20000),
+        # Картинки хранятся в base64 — сжатие заметно уменьшает трафик.
+        # zstd — пакет zstandard из requirements, zlib встроен в Python;
+        # snappy можно добавить через .env, установив python-snappy.
+        "compressors": os.getenv("MONGO_COMPRESSORS", "zstd,zlib"),
+        "retryReads": True,
+        "retryWrites": True,
+        # Подсчёт запросов на хендлер — только при включённом профилировании
+        "event_listeners": profiling.command_listeners(),
+    }
+
+
+def _reset_clients_after_fork():
+    """Забываем клиентов родителя в дочернем процессе (их сокеты нельзя переиспользовать)"""
+    global _CLIENTS_LOCK
+    _CLIENTS.clear()
+    _INDEXES_READY.clear()
+    _CLIENTS_LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+
+def get_client(uri=None):
+    """Возвращает общий для процесса MongoClient (создаёт при первом обращении)"""
+    uri = uri or build_mongo_uri()
+    key = (os.getpid(), uri)
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            options = client_options()
+            client = MongoClient(uri, **options)
+            _CLIENTS[key] = client
+            logger.info(
+                f"Created MongoClient for pid={os.getpid()} "
+                f"(maxPoolSize={options['maxPoolSize']}, compressors={options['compressors']})"
+            )
+    return client
+
+
+def close_clients():
+    """Закрывает все клиенты текущего процесса (при остановке)"""
+    with _CLIENTS_LOCK:
+        pid = os.getpid()
+        for key in [k for k in _CLIENTS if k[0] == pid]:
+            _CLIENTS.pop(key).close()
+
+
+# Клиенты, созданные до чтения конфига (при импорте модулей), после включения
+# профилирования пересоздаются уже со счётчиком команд
+profiling.on_toggle(close_clients)
+
 
 class MongoManager:
     def __init__(self):
         """Инициализация подключения к MongoDB"""
         try:
-            # Приоритет 1: Используем MONGO_URI если он задан (из docker-compose)
-            mongo_uri = os.getenv("MONGO_URI")
-            if mongo_uri:
-                uri = mongo_uri
-                logger.info("Using MONGO_URI from environment")
-            else:
-                # Приоритет 2: Собираем URI из отдельных переменных
-                mongo_user = os.getenv("MONGO_USER", "")
-                mongo_pass = os.getenv("MONGO_PASS", "")
-                mongo_port = os.getenv("MONGO_PORT", "27017")
-                # MONGO_HOST может быть задан в .env или docker-compose, иначе localhost
-                mongo_host = os.getenv("MONGO_HOST", "localhost")
-                mongo_db_name = os.getenv("MONGO_DB_NAME", "memebot_db")
-                
-                if mongo_user and mongo_pass:
-                    uri = f"mongodb://{mongo_user}:{mongo_pass}@{mongo_host}:{mongo_port}"
-                else:
-                    uri = f"mongodb://{mongo_host}:{mongo_port}"
-                
-                logger.info(f"Using MongoDB connection: {mongo_host}:{mongo_port}")
-            
-            self.client = MongoClient(uri)
-            self.db = self.client[mongo_db_name]
-            # Коллекции
-            self.bot_state = self.db["bot_state"]
-            self.memes = self.db["memes"]
-            self.user_memes = self.db["user_memes"]
-            
-            # Создаем индексы для оптимизации
-            self.memes.create_index("_id")
-            self.user_memes.create_index("_id")
-            
-            logger.info(f"Connected to MongoDB: {mongo_db_name}")
+            self._uri = build_mongo_uri()
+            self._db_name = os.getenv("MONGO_DB_NAME", "memebot_db")
+            # (ORDER_VERSION, np.ndarray) — последний прочитанный массив MEME_ORDER
+            self._base_cache = None
+            # ((ORDER_VERSION, ORDER_PATCH_SEQ), np.ndarray) — он же с наложенными правками
+            self._order_cache = None
+            # тег -> (version, np.ndarray) — последние прочитанные ID пулов тегов
+            self._tag_pool_cache = {}
+            # version -> np.ndarray — снимки ID seeded-ротаций
+            self._id_snapshot_cache = {}
+            self.ensure_indexes()
+            self.migrate_meme_order()
+            logger.info(f"Connected to MongoDB: {self._db_name}")
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB: {e}")
             raise
 
+    # Клиент и коллекции берутся из реестра при каждом обращении,
+    # поэтому объект MongoManager можно безопасно создать до fork.
+    @property
+    def client(self):
+        return get_client(self._uri)
+
+    @property
+    def db(self):
+        return self.client[self._db_name]
+
+    # Коллекции
+    @property
+    def bot_state(self):
+        return self.db["bot_state"]
+
+    @property
+    def memes(self):
+        return self.db["memes"]
+
+    @property
+    def user_memes(self):
+        return self.db["user_memes"]
+
+    # Подписки чатов на ежедневную рассылку и прогресс рассылок (см. source/broadcast.py)
+    @property
+    def subscriptions(self):
+        return self.db["subscriptions"]
+
+    @property
+    def broadcasts(self):
+        return self.db["broadcasts"]
+
+    @property
+    def broadcast_items(self):
+        return self.db["broadcast_items"]
+
+    @property
+    def counters(self):
+        return self.db["counters"]
+
+    @property
+    def tag_pools(self):
+        return self.db["tag_pools"]
+
+    # Отметки лайков: один лайк пользователя под сообщением на все процессы бота
+    @property
+    def meme_likes(self):
+        return self.db["meme_likes"]
+
+    # Альбомы, сообщения которых приходят в разные процессы бота (см. add_meme в bot.py)
+    @property
+    def pending_albums(self):
+        return self.db["pending_albums"]
+
+    # Следы удалений: _id мема и когда/как он удалён — для манифеста инкрементального экспорта
+    @property
+    def meme_tombstones(self):
+        return self.db["meme_tombstones"]
+
+    def ensure_indexes(self):
+        """Создаёт индексы один раз на процесс (индекс по _id Mongo создаёт сам)"""
+        key = (self._uri, self._db_name)
+        if key in _INDEXES_READY:
+            return
+        # Счётчик _id мемов не ниже текущего максимума (_id больше не переиспользуются)
+        max_id_doc = self.memes.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        self.counters.update_one(
+            {"_id": "memes"},
+            {"$max": {"next": (max_id_doc["_id"] + 1) if max_id_doc else 0}},
+            upsert=True,
+        )
+        # Мем дня живёт до конца суток: Mongo сам удаляет истёкшие документы
+        self.user_memes.create_index("expires_at", expireAfterSeconds=0)
+        # Ротации чатов, не заходивших дольше CHAT_ROTATION_TTL_DAYS, удаляются
+        self.chat_rotations.create_index(
+            "updated_at", expireAfterSeconds=CHAT_ROTATION_TTL_DAYS * 24 * 3600
+        )
+        self.id_snapshots.create_index("created_at", expireAfterSeconds=ID_SNAPSHOT_TTL_DAYS * 24 * 3600)
+        # Списки панели: свежие/старые, по загрузившему, самые большие
+        self.memes.create_index([("created_at", -1), ("_id", -1)])
+        self.memes.create_index([("uploader", 1), ("created_at", -1), ("_id", -1)])
+        self.memes.create_index([("size", -1), ("_id", -1)])
+        # Дедупликация импорта по содержимому (у старых мемов хеш дозаполняется фоном)
+        self.memes.create_index("hash", sparse=True)
+        # Среди импортированных мемов содержимое уникально: два одновременных импорта
+        # (бот и панель) не вставят одну картинку дважды. Загруженные по одной и старые
+        # мемы под ограничение не попадают — среди них дубликаты уже могут быть
+        self.memes.create_index(
+            [("hash", 1), ("unique_hash", 1)], unique=True,
+            partialFilterExpression={"unique_hash": True}, name="hash_unique_import",
+        )
+        # Инкрементальный экспорт: восстановленные из корзины и удалённые после прошлой выгрузки
+        self.memes.create_index("restored_at", sparse=True)
+        self.meme_tombstones.create_index("deleted_at")
+        self.meme_likes.create_index("created_at", expireAfterSeconds=LIKE_DEDUP_TTL_DAYS * 24 * 3600)
+        # Инкрементальное обновление весов популярности
+        self.memes.create_index("stats.updated_at", sparse=True)
+        self.memes.create_index("deleted_at", sparse=True)
+        # Инлайн-режим по тегу (без тега страницы идут по индексу _id)
+        self.memes.create_index([("tags", 1), ("_id", -1)])
+        # Рассылка: активные подписчики и неотправленные элементы дня
+        self.subscriptions.create_index([("active", 1), ("_id", 1)])
+        self.broadcast_items.create_index([("day", 1), ("status", 1), ("_id", 1)])
+        self.broadcast_items.create_index("created_at", expireAfterSeconds=BROADCAST_ITEMS_TTL_DAYS * 24 * 3600)
+        self.pending_albums.create_index("created_at", expireAfterSeconds=PENDING_ALBUM_TTL_HOURS * 3600)
+        # Поиск по распознанному тексту (/search, поиск панели)
+        self.memes.create_index([("ocr_text", "text")], default_language=OCR_TEXT_LANGUAGE)
+        _INDEXES_READY.add(key)
+
     # -------------------- bot_state --------------------
     def get_bot_state(self):
-        """Получить состояние бота (MEME_INDEX, LAST_MEMES_COUNT, MEME_ORDER)"""
-        doc = self.bot_state.find_one({"_id": 0})
+        """Получить состояние бота (MEME_INDEX, LAST_MEMES_COUNT, ORDER_SIZE, ORDER_VERSION).
+        Сам MEME_ORDER сюда не входит — см. get_meme_order()"""
+        doc = self.bot_state.find_one({"_id": 0}, {"MEME_ORDER": 0, "ORDER_PATCH": 0})
         if doc is None:
-            doc = {"_id": 0, "MEME_INDEX": 0, "LAST_MEMES_COUNT": 0, "MEME_ORDER": []}
-            self.bot_state.insert_one(doc)
+            self.bot_state.update_one(
+                {"_id": 0},
+                {"$setOnInsert": {"MEME_INDEX": 0, "LAST_MEMES_COUNT": 0, "ORDER_SIZE": 0}},
+                upsert=True,
+            )
+            doc = self.bot_state.find_one({"_id": 0}, {"MEME_ORDER": 0, "ORDER_PATCH": 0})
         return doc
 
     def update_bot_state(self, state: dict) -> None:
             """Обновляет документ состояния бота (upsert)."""
             # пример реализации:
-            self.bot_state.update_one({}, {"$set": state}, upsert=True)
+            self.bot_state.update_one({"_id": 0}, {"$set": state}, upsert=True)
 
-    def get_meme_order(self):
-        """Получить MEME_ORDER из bot_state"""
+    def is_user_add_allowed(self):
+        """Флаг ALLOW_USER_ADD общий для всех процессов бота"""
+        doc = self.bot_state.find_one({"_id": 0}, {"ALLOW_USER_ADD": 1})
+        return (doc or {}).get("ALLOW_USER_ADD", True)
+
+    def set_user_add_allowed(self, allowed):
+        self.update_bot_state({"ALLOW_USER_ADD": bool(allowed)})
+
+    def get_editors(self):
+        """Редакторы общие для всех процессов бота (меняются /add_editor и /remove_editor)"""
+        doc = self.bot_state.find_one({"_id": 0}, {"EDITORS": 1})
+        return set((doc or {}).get("EDITORS", []))
+
+    def add_editors(self, usernames):
+        """Добавляет редакторов; False — все уже были в списке"""
+        usernames = list(usernames)
+        if not usernames:
+            return False
+        self.get_bot_state()  # документ состояния должен существовать
+        result = self.bot_state.update_one({"_id": 0}, {"$addToSet": {"EDITORS": {"$each": usernames}}})
+        return result.modified_count > 0
+
+    def remove_editor(self, username):
+        """Убирает редактора; False — его не было в списке"""
+        result = self.bot_state.update_one({"_id": 0}, {"$pull": {"EDITORS": username}})
+        return result.modified_count > 0
+
+    def get_export_watermark(self):
+        """{"at"} последнего экспорта (None — экспорта ещё не было)"""
+        doc = self.bot_state.find_one({"_id": 0}, {"EXPORT_WATERMARK": 1})
+        return (doc or {}).get("EXPORT_WATERMARK")
+
+    def set_export_watermark(self, watermark):
+        self.update_bot_state({"EXPORT_WATERMARK": watermark})
+
+    def get_verify_state(self):
+        """{"last_id", "updated_at", "finished_at"} прохода проверки картинок ({} — проверки ещё не было)"""
+        doc = self.bot_state.find_one({"_id": 0}, {"IMAGE_VERIFY": 1})
+        return (doc or {}).get("IMAGE_VERIFY") or {}
+
+    def set_verify_state(self, state):
+        self.update_bot_state({"IMAGE_VERIFY": state})
+
+    def get_meme_order_summary(self):
+        """MEME_INDEX, LAST_MEMES_COUNT и число мемов в MEME_ORDER (без дыр) без чтения самого массива"""
+        doc = self.bot_state.find_one(
+            {"_id": 0},
+            {"MEME_INDEX": 1, "LAST_MEMES_COUNT": 1, "ORDER_SIZE": 1, "ORDER_HOLES": 1},
+        ) or {}
+        return {
+            "MEME_INDEX": doc.get("MEME_INDEX", 0),
+            "LAST_MEMES_COUNT": doc.get("LAST_MEMES_COUNT", 0),
+            "order_size": doc.get("ORDER_SIZE", 0) - doc.get("ORDER_HOLES", 0),
+        }
+
+    def advance_meme_index(self):
+        """
+        Атомарно: вернуть ID на позиции MEME_INDEX и сдвинуть MEME_INDEX на 1.
+        None — порядок пуст или исчерпан (нужен новый цикл).
+        Несколько процессов бота никогда не получат одну и ту же позицию.
+        Дыры (убранные мемы) пропускаются: серия дыр — одним условным $max курсора.
+        """
+        while True:
+            doc = self.bot_state.find_one_and_update(
+                {"_id": 0, "$expr": {"$lt": [{"$ifNull": ["$MEME_INDEX", 0]}, {"$ifNull": ["$ORDER_SIZE", 0]}]}},
+                {"$inc": {"MEME_INDEX": 1}},
+                projection={"MEME_INDEX": 1, "ORDER_VERSION": 1, "ORDER_PATCH_SEQ": 1},
+                return_document=ReturnDocument.BEFORE,
+            )
+            if doc is None:
+                return None
+            # Массив берётся из кеша процесса, если порядок не менялся
+            order = self.get_meme_order(doc)
+            position = doc.get("MEME_INDEX", 0)
+            if self._order_cache is not None and self._order_cache[0][0] != doc.get("ORDER_VERSION"):
+                # Порядок переписан после сдвига курсора: позиция потеряна, берём следующую
+                continue
+            if position >= len(order):
+                return None
+            if order[position] != ORDER_HOLE:
+                return int(order[position])
+            live = np.flatnonzero(order[position + 1:] != ORDER_HOLE)
+            next_live = position + 1 + (int(live[0]) if len(live) else len(order) - position - 1)
+            self.bot_state.update_one(
+                {"_id": 0, **order_filter(doc)}, {"$max": {"MEME_INDEX": next_live}}
+            )
+
+    # -------------------- id_snapshots (ранги для seeded-ротаций) --------------------
+    # Цикл seeded-ротации (общей и чата) идёт по снимку активных ID на момент старта:
+    # упакованные по возрастанию int32 кусками {"_id": {"v", "n"}, "data", "created_at"}.
+    # Перестановка Фейстеля — над рангами [0, count) снимка, а не над диапазоном _id,
+    # так что дыры в _id не тратят позиций. Пока набор мемов не менялся (MEMES_SEQ
+    # в bot_state растёт с каждой вставкой в MEME_ORDER и удалением из него),
+    # последний снимок (ID_SNAPSHOT) общий для всех новых циклов.
+    @property
+    def id_snapshots(self):
+        return self.db["id_snapshots"]
+
+    def get_id_snapshot(self):
+        """Снимок для нового цикла: {"version", "chunks", "count", "seq"} (count 0 — мемов нет)"""
+        state = self.bot_state.find_one({"_id": 0}, {"ID_SNAPSHOT": 1, "MEMES_SEQ": 1}) or {}
+        seq = state.get("MEMES_SEQ", 0)
+        current = state.get("ID_SNAPSHOT")
+        if current and current.get("seq") == seq and self.get_snapshot_ids(current) is not None:
+            return current
+        ids = np.fromiter(
+            (doc["_id"] for doc in self.memes.find(ACTIVE_FILTER, {"_id": 1}, sort=[("_id", 1)])),
+            dtype=ORDER_DTYPE,
+        )
+        version = ObjectId()
+        now = datetime.datetime.utcnow()
+        chunks = [ids[i:i + ORDER_CHUNK_ENTRIES] for i in range(0, len(ids), ORDER_CHUNK_ENTRIES)] or [ids]
+        self.id_snapshots.insert_many([
+            {"_id": {"v": version, "n": n}, "data": encode_order(chunk), "created_at": now}
+            for n, chunk in enumerate(chunks)
+        ])
+        snapshot = {"version": version, "chunks": len(chunks), "count": int(len(ids)), "seq": seq}
+        # Параллельно снятые снимки равноправны: каждый доживёт до TTL у своих циклов
+        self.update_bot_state({"ID_SNAPSHOT": snapshot})
+        self._cache_id_snapshot(version, ids)
+        return snapshot
+
+    def get_snapshot_ids(self, snapshot):
+        """ID снимка {"version", "chunks"} как np.ndarray[int32] через кеш процесса; None — снимок истёк"""
+        version = snapshot["version"]
+        ids = self._id_snapshot_cache.get(version)
+        if ids is None:
+            ids = self._read_order_chunks(version, snapshot["chunks"], self.id_snapshots)
+            if ids is not None:
+                self._cache_id_snapshot(version, ids)
+        return ids
+
+    def _cache_id_snapshot(self, version, ids):
+        if len(self._id_snapshot_cache) >= ID_SNAPSHOT_CACHE_SIZE:
+            self._id_snapshot_cache.clear()
+        self._id_snapshot_cache[version] = ids
+
+    @staticmethod
+    def _cycle_fields(seed, snapshot):
+        return {
+            "seed": seed, "pos": 0, "domain": snapshot["count"],
+            "snapshot": {"version": snapshot["version"], "chunks": snapshot["chunks"]},
+        }
+
+    # -------------------- SEEDED (порядок без массива) --------------------
+    # SEEDED = {"seed", "pos", "domain", "snapshot": {"version", "chunks"}}: позиция pos
+    # переводится перестановкой Фейстеля над [0, domain) в ранг ID в снимке цикла.
+    # У циклов, начатых до снимков, snapshot нет и domain = max(_id) + 1.
+    def advance_seeded_position(self):
+        """Атомарно вернуть состояние цикла (до сдвига) и сдвинуть pos. None — цикл исчерпан"""
+        doc = self.bot_state.find_one_and_update(
+            {"_id": 0, "$expr": {"$lt": [
+                {"$ifNull": ["$SEEDED.pos", 0]}, {"$ifNull": ["$SEEDED.domain", 0]},
+            ]}},
+            {"$inc": {"SEEDED.pos": 1}},
+            projection={"SEEDED": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+        return doc["SEEDED"] if doc else None
+
+    def start_seeded_cycle(self, seed, snapshot, stale=None):
+        """
+        Начать новый цикл над снимком ID, если текущий ещё никто не перезапустил.
+        stale — version истёкшего снимка: цикл по нему перезапускается, не дожидаясь конца.
+        """
+        self.get_bot_state()  # документ состояния должен существовать
+        if stale is not None:
+            condition = {"SEEDED.snapshot.version": stale}
+        else:
+            condition = {"$expr": {"$gte": [
+                {"$ifNull": ["$SEEDED.pos", 0]}, {"$ifNull": ["$SEEDED.domain", 0]},
+            ]}}
+        self.bot_state.update_one({"_id": 0, **condition}, {"$set": {"SEEDED": self._cycle_fields(seed, snapshot)}})
+
+    # -------------------- chat_rotations (ротация на каждый чат) --------------------
+    # Документ на чат: {"_id": chat_id, "seed", "pos", "domain", "snapshot", "updated_at"} —
+    # несколько десятков байт вместо перестановки на чат: снимок ID общий (см. id_snapshots).
+    # Неактивные чаты удаляет TTL-индекс.
+    @property
+    def chat_rotations(self):
+        return self.db["chat_rotations"]
+
+    def advance_chat_position(self, chat_id):
+        """Атомарно вернуть состояние цикла чата (до сдвига) и сдвинуть pos. None — цикл исчерпан или его нет"""
+        return self.chat_rotations.find_one_and_update(
+            {"_id": chat_id, "$expr": {"$lt": ["$pos", "$domain"]}},
+            {"$inc": {"pos": 1}, "$set": {"updated_at": datetime.datetime.utcnow()}},
+            projection={"seed": 1, "pos": 1, "domain": 1, "snapshot": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    def start_chat_cycle(self, chat_id, seed, snapshot, stale=None):
+        """Начать новый цикл чата над снимком ID, если его ещё никто не перезапустил (stale — как у seeded)"""
+        if stale is not None:
+            condition = {"snapshot.version": stale}
+        else:
+            condition = {"$expr": {"$gte": [{"$ifNull": ["$pos", 0]}, {"$ifNull": ["$domain", 0]}]}}
+        try:
+            self.chat_rotations.update_one(
+                {"_id": chat_id, **condition},
+                {"$set": {**self._cycle_fields(seed, snapshot), "updated_at": datetime.datetime.utcnow()}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Цикл уже начал параллельный запрос того же чата
+            pass
+
+    # -------------------- MEME_ORDER (бинарный формат) --------------------
+    # MEME_ORDER хранится как BSON Binary с упакованными int32 (little-endian)
+    # и читается без копирования через np.frombuffer. Каждая запись получает
+    # новый ORDER_VERSION: по нему процесс понимает, что закешированный массив
+    # устарел, и по нему же делаются условные (compare-and-set) обновления.
+    # Очень большие порядки разбиваются на куски в коллекции bot_state_chunks.
+
+    @property
+    def bot_state_chunks(self):
+        return self.db["bot_state_chunks"]
+
+    def _read_order_chunks(self, version, chunks, collection=None):
+        """Куски версии version; None — их уже удалил писатель следующей версии"""
+        keys = [{"v": version, "n": n} for n in range(chunks)]
+        collection = self.bot_state_chunks if collection is None else collection
+        docs = {doc["_id"]["n"]: doc["data"] for doc in collection.find({"_id": {"$in": keys}})}
+        if len(docs) != chunks:
+            return None
+        return np.concatenate(
+            [decode_order(docs[n]) for n in range(chunks)] or [np.empty(0, dtype=ORDER_DTYPE)]
+        )
+
+    def _read_order_base(self, meta):
+        """Сам массив MEME_ORDER версии из meta (None — версию заменили во время чтения)"""
+        version = meta.get("ORDER_VERSION")
+        cached = self._base_cache
+        if version is not None and cached is not None and cached[0] == version:
+            return cached[1]
+        if meta.get("MEME_ORDER_CHUNKS"):
+            base = self._read_order_chunks(version, meta["MEME_ORDER_CHUNKS"])
+        else:
+            doc = self.bot_state.find_one({"_id": 0, "ORDER_VERSION": version}, {"MEME_ORDER": 1})
+            base = None if doc is None else decode_order(doc.get("MEME_ORDER"))
+        if base is not None and version is not None:
+            self._base_cache = (version, base)
+        return base
+
+    def get_meme_order(self, state=None):
+        """
+        MEME_ORDER с наложенными правками (ORDER_PATCH) как np.ndarray[int32]
+        (только для чтения); на местах убранных мемов — ORDER_HOLE.
+        Массив читается только при смене ORDER_VERSION, правки — при смене ORDER_PATCH_SEQ.
+        """
+        if state is not None:
+            cached = self._order_cache
+            if cached is not None and cached[0] == order_key(state):
+                return cached[1]
+
+        for _ in range(ORDER_CAS_RETRIES):
+            meta = self.bot_state.find_one({"_id": 0}, ORDER_META_PROJECTION) or {}
+            key = order_key(meta)
+            cached = self._order_cache
+            if key[0] is not None and cached is not None and cached[0] == key:
+                return cached[1]
+            base = self._read_order_base(meta)
+            if base is None:
+                continue
+            patch = meta.get("ORDER_PATCH") or {}
+            size = meta.get("ORDER_SIZE", len(base))
+            if patch or size != len(base):
+                order = np.full(size, ORDER_HOLE, dtype=ORDER_DTYPE)
+                order[:min(size, len(base))] = base[:size]
+                for position, meme_id in patch.items():
+                    order[int(position)] = meme_id
+            else:
+                order = base
+            if key[0] is not None:
+                self._order_cache = (key, order)
+            return order
+        logger.error("MEME_ORDER kept changing while being read")
+        return np.empty(0, dtype=ORDER_DTYPE)
+
+    def _write_order(self, order, expected=None, extra_set=None, extra_inc=None):
+        """
+        Записывает MEME_ORDER целиком новой версией (правки ORDER_PATCH сбрасываются).
+        expected — поля состояния, которые не должны были измениться с момента
+        чтения (compare-and-set); при расхождении ничего не пишет и возвращает False.
+        """
+        order = np.ascontiguousarray(order, dtype=ORDER_DTYPE)
+        version = ObjectId()
+        update_set = {
+            "ORDER_VERSION": version,
+            "ORDER_SIZE": int(len(order)),
+            "ORDER_PATCH_SEQ": 0,
+            "ORDER_HOLES": int(np.count_nonzero(order == ORDER_HOLE)),
+            **(extra_set or {}),
+        }
+
+        if len(order) > ORDER_CHUNK_ENTRIES:
+            chunks = [order[i:i + ORDER_CHUNK_ENTRIES] for i in range(0, len(order), ORDER_CHUNK_ENTRIES)]
+            self.bot_state_chunks.insert_many([
+                {"_id": {"v": version, "n": n}, "data": encode_order(chunk)}
+                for n, chunk in enumerate(chunks)
+            ])
+            update_set["MEME_ORDER_CHUNKS"] = len(chunks)
+            unset = {"MEME_ORDER": "", "ORDER_PATCH": ""}
+        else:
+            update_set["MEME_ORDER"] = encode_order(order)
+            unset = {"MEME_ORDER_CHUNKS": "", "ORDER_PATCH": ""}
+
+        update = {"$set": update_set, "$unset": unset}
+        if extra_inc:
+            update["$inc"] = extra_inc
+        previous = self.bot_state.find_one_and_update(
+            {"_id": 0, **(expected or {})},
+            update,
+            projection={"MEME_ORDER_CHUNKS": 1, "ORDER_VERSION": 1},
+            upsert=expected is None,
+            return_document=ReturnDocument.BEFORE,
+        )
+        # При upsert новой записи previous тоже None, но запись состоялась
+        written = previous is not None or expected is None
+
+        if written:
+            if (previous or {}).get("MEME_ORDER_CHUNKS"):
+                # Куски заменённой версии больше не нужны. Только её: куски другого
+                # писателя, который ещё не дошёл до своего compare-and-set, трогать нельзя
+                self.bot_state_chunks.delete_many({"_id.v": previous.get("ORDER_VERSION")})
+            self._base_cache = (version, order)
+            self._order_cache = ((version, 0), order)
+        elif len(order) > ORDER_CHUNK_ENTRIES:
+            self.bot_state_chunks.delete_many({"_id.v": version})
+        return written
+
+    def set_meme_order(self, meme_order, meme_index=None, last_count=None, expected=None):
+        """
+        Установить MEME_ORDER в bot_state (вместе с MEME_INDEX / LAST_MEMES_COUNT, если заданы).
+        expected — условие записи (см. _write_order); False — порядок успели изменить.
+        """
+        extra = {}
+        if meme_index is not None:
+            extra["MEME_INDEX"] = int(meme_index)
+        if last_count is not None:
+            extra["LAST_MEMES_COUNT"] = int(last_count)
+        return self._write_order(meme_order, expected=expected, extra_set=extra)
+
+    def _patch_order(self, build):
+        """
+        Точечная правка MEME_ORDER: build(state, order) -> (условие, {позиция: ID}, $inc)
+        или None (править нечего). Пишется только правка; условие — версия порядка
+        и правок (order_filter) и то, что вернул build. Повторяет при гонке.
+        После ORDER_PATCH_MAX_OPS правок они вливаются в массив.
+        """
+        for _ in range(ORDER_CAS_RETRIES):
+            state = self.get_bot_state()
+            order = self.get_meme_order(state)
+            planned = build(state, order)
+            if planned is None:
+                return True
+            condition, changes, inc = planned
+            update = {"$inc": {"ORDER_PATCH_SEQ": 1, **inc}}
+            if changes:
+                update["$set"] = {f"ORDER_PATCH.{position}": int(meme_id) for position, meme_id in changes.items()}
+            result = self.bot_state.update_one({"_id": 0, **order_filter(state), **condition}, update)
+            if result.matched_count:
+                if (state.get("ORDER_PATCH_SEQ") or 0) + 1 >= ORDER_PATCH_MAX_OPS:
+                    self._compact_order()
+                return True
+        logger.warning("MEME_ORDER update lost after retries, left for consistency check")
+        return False
+
+    def _compact_order(self):
+        """
+        Влить правки в массив MEME_ORDER. Позиции (и дыры) сохраняются,
+        поэтому курсор MEME_INDEX не трогается и в условие не входит.
+        """
         state = self.get_bot_state()
-        return state.get("MEME_ORDER", [])
+        return self._write_order(self.get_meme_order(state), expected=order_filter(state))
 
-    def set_meme_order(self, meme_order):
-        """Установить MEME_ORDER в bot_state"""
-        self.update_bot_state({'MEME_ORDER': meme_order})
+    def migrate_meme_order(self):
+        """Переводит старый MEME_ORDER (BSON массив) в бинарный формат"""
+        doc = self.bot_state.find_one({"_id": 0}, {"MEME_ORDER": 1, "ORDER_VERSION": 1})
+        if doc and isinstance(doc.get("MEME_ORDER"), list):
+            order = decode_order(doc["MEME_ORDER"])
+            if self._write_order(order, expected={"ORDER_VERSION": doc.get("ORDER_VERSION")}):
+                logger.info(f"Migrated MEME_ORDER to binary int32 format ({len(order)} entries)")
 
   # -------------------- memes (NEW VERSION) --------------------
     def get_all_memes(self):
         """Получить все мемы с Base64, отсортированные по _id"""
-        return list(self.memes.find({}, sort=[("_id", 1)]))
+        return list(self.memes.find(ACTIVE_FILTER, sort=[("_id", 1)]))
+
+    def get_all_meme_ids(self):
+        """Все _id активных мемов (по возрастанию), без картинок"""
+        return [doc["_id"] for doc in self.memes.find(ACTIVE_FILTER, {"_id": 1}, sort=[("_id", 1)])]
+
+    def get_max_meme_id(self):
+        """Наибольший _id мема (None — мемов нет)"""
+        doc = self.memes.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        return doc["_id"] if doc else None
 
     def get_meme_by_id(self, meme_id):
         """Получить мем по _id"""
         return self.memes.find_one({"_id": meme_id})
 
+    def get_meme_image(self, meme_id, include_deleted=False):
+        """
+        Байты картинки мема через LRU кеш (None — мема нет или он в корзине).
+        Попадание в кеш стоит одного маленького запроса (rev/deleted) вместо
+        передачи и декодирования всей картинки.
+        """
+        loaded = self.load_meme_image(meme_id, include_deleted)
+        if loaded is None:
+            return None
+        rev, data = loaded
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+            get_image_cache().put(meme_id, rev, data)
+        return data
+
+    def load_meme_image(self, meme_id, include_deleted=False):
+        """
+        Картинка для потоковой отдачи: (rev, bytes) из кеша или (rev, base64 строка)
+        при промахе — её декодирует (и кладёт в кеш) вызывающий. None — мема нет.
+        """
+        meta = self.memes.find_one({"_id": meme_id}, {"rev": 1, "deleted": 1})
+        if meta is None or (meta.get("deleted") and not include_deleted):
+            return None
+        data = get_image_cache().get(meme_id, meta.get("rev", 0))
+        if data is not None:
+            return meta.get("rev", 0), data
+        doc = self.memes.find_one({"_id": meme_id}, {"image": 1, "rev": 1})
+        if doc is None:
+            return None
+        return doc.get("rev", 0), doc["image"]
+
+    def get_meme_rev(self, meme_id):
+        """Ревизия содержимого мема (None — мема нет)"""
+        doc = self.memes.find_one({"_id": meme_id}, {"rev": 1})
+        return doc.get("rev", 0) if doc else None
+
+    def get_meme_image_size(self, meme_id):
+        """Длина base64 строки мема без загрузки самой картинки (None — мема нет)"""
+        doc = self.memes.find_one({"_id": meme_id}, {"size": {"$strLenBytes": "$image"}})
+        return doc["size"] if doc else None
+
+    def list_memes(self, sort="new", after=None, limit=50, uploader=None, min_size=None, deleted=False):
+        """
+        Страница метаданных мемов (без картинок) с keyset-пагинацией.
+        after — курсор из предыдущей страницы; возвращает (мемы, курсор следующей страницы или None).
+        """
+        field, direction = MEME_SORTS[sort]
+        query = {"deleted": True} if deleted else dict(ACTIVE_FILTER)
+        if uploader:
+            query["uploader"] = uploader
+        if min_size:
+            query["size"] = {"$gte": int(min_size)}
+
+        op = "$gt" if direction > 0 else "$lt"
+        if after is not None:
+            value, last_id = after
+            if field is None:
+                query["_id"] = {op: last_id}
+            else:
+                query["$or"] = [{field: value, "_id": {op: last_id}}]
+                # Мемы без поля (null) идут первыми по возрастанию и последними по убыванию,
+                # а $lt/$gt между null и значением не срабатывают — это отдельные ветки
+                if value is not None:
+                    query["$or"].append({field: {op: value}})
+                    if direction < 0:
+                        query["$or"].append({field: None})
+                elif direction > 0:
+                    query["$or"].append({field: {"$ne": None}})
+        sort_spec = [("_id", direction)] if field is None else [(field, direction), ("_id", direction)]
+
+        docs = list(self.memes.find(
+            query,
+            {"_id": 1, "created_at": 1, "uploader": 1, "size": 1, "format": 1, "tags": 1, "quarantine_reason": 1},
+            sort=sort_spec,
+            limit=limit + 1,
+        ))
+        next_after = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            last = docs[-1]
+            next_after = (None if field is None else last.get(field), last["_id"])
+        return docs, next_after
+
+    def backfill_meme_metadata(self, batch_size=METADATA_BACKFILL_BATCH):
+        """
+        Заполняет created_at, size, format и hash у мемов, добавленных до появления метаданных.
+        Размер и формат считает сам Mongo по длине и началу base64 — картинки не передаются;
+        для хеша картинки читаются небольшими пачками.
+        Точное время загрузки старых мемов неизвестно: им ставится время дозаполнения.
+        """
+        filled = 0
+        now = datetime.datetime.utcnow()
+        while True:
+            docs = list(self.memes.find(
+                {"created_at": {"$exists": False}},
+                {
+                    "length": {"$strLenBytes": "$image"},
+                    "head": {"$substrBytes": ["$image", 0, 16]},
+                    "tail": {"$substrBytes": [
+                        "$image", {"$max": [0, {"$subtract": [{"$strLenBytes": "$image"}, 2]}]}, 2
+                    ]},
+                },
+                limit=batch_size,
+            ))
+            if not docs:
+                break
+            self.memes.bulk_write([
+                UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$set": {
+                        "created_at": now,
+                        "size": base64_decoded_size(doc["length"], doc["tail"]),
+                        "format": detect_image_format(base64.b64decode(doc["head"])),
+                    }},
+                )
+                for doc in docs
+            ], ordered=False)
+            filled += len(docs)
+        while True:
+            docs = list(self.memes.find({"hash": {"$exists": False}}, {"image": 1}, limit=HASH_BACKFILL_BATCH))
+            if not docs:
+                break
+            self.memes.bulk_write([
+                UpdateOne({"_id": doc["_id"]}, {"$set": {"hash": content_hash(base64.b64decode(doc["image"]))}})
+                for doc in docs
+            ], ordered=False)
+            filled += len(docs)
+        if filled:
+            logger.info(f"Backfilled metadata for {filled} memes")
+        return filled
+
     def count_memes(self):
-        return self.memes.count_documents({})
+        return self.memes.count_documents(ACTIVE_FILTER)
+
+    # -------------------- file_id Telegram --------------------
+    def set_meme_file_id(self, meme_id, file_id):
+        """Запоминает file_id отправленной ботом картинки (если его ещё нет)"""
+        self.memes.update_one({"_id": meme_id, "file_id": {"$exists": False}}, {"$set": {"file_id": file_id}})
+
+    def get_file_id_page(self, before_id=None, limit=50, tag=None):
+        """
+        Страница (ID, file_id) мемов, уже известных Telegram, от новых к старым —
+        один запрос без картинок. before_id — курсор: последний ID предыдущей страницы.
+        """
+        query = {"file_id": {"$exists": True}, **ACTIVE_FILTER}
+        if before_id is not None:
+            query["_id"] = {"$lt": before_id}
+        if tag:
+            query["tags"] = tag
+        cursor = self.memes.find(query, {"file_id": 1}, sort=[("_id", -1)], limit=limit)
+        return [(doc["_id"], doc["file_id"]) for doc in cursor]
+
+    def allocate_meme_ids(self, count=1):
+        """
+        Выделяет count новых _id подряд (атомарно, без гонок между процессами).
+        _id удалённых мемов не переиспользуются, поэтому содержимое по _id неизменно.
+        """
+        doc = self.counters.find_one_and_update(
+            {"_id": "memes"},
+            {"$inc": {"next": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return doc["next"] - count
 
-    def add_meme_base64(self, base64_str):
-        """Добавляет мем, переданный как base64 строка"""
-        max_id_doc = self.memes.find_one(sort=[("_id", -1)])
-        new_id = (max_id_doc["_id"] + 1) if max_id_doc else 0
+    def add_meme_base64(self, base64_str, uploader=None, file_id=None, tags=None):
+        """
+        Добавляет мем, переданный как base64 строка.
+        uploader — кто загрузил (username/ID пользователя бота или "panel"),
+        file_id — file_id картинки в Telegram, если она пришла через бота,
+        tags — теги мема (мем сразу попадает в их пулы).
+        """
+        new_id = self.allocate_meme_ids(1)
+        image_format, size = base64_info(base64_str)
 
-        self.memes.insert_one({
+        doc = {
             "_id": new_id,
-            "image": base64_str
-        })
+            "image": base64_str,
+            "created_at": datetime.datetime.utcnow(),
+            "uploader": uploader,
+            "size": size,
+            "format": image_format,
+            "hash": content_hash(base64.b64decode(base64_str)),
+        }
+        if file_id:
+            doc["file_id"] = file_id
+        tags = normalize_tags(tags)
+        if tags:
+            doc["tags"] = tags
+        self.memes.insert_one(doc)
+        # O(1): новый мем сразу попадает в случайное место непросмотренного хвоста
+        self.insert_into_meme_order([new_id])
+        if tags:
+            self.update_tag_pools(add={tag: [new_id] for tag in tags})
 
         logger.info(f"Added meme (base64) with _id={new_id}")
         return new_id
 
-    def add_meme_from_file(self, file_path):
+    def add_memes_batch(self, images, uploader=None):
+        """
+        Добавляет пачку картинок (bytes) одним insert_many, пропуская те,
+        что уже есть в библиотеке (по sha256) или повторяются в самой пачке.
+        Предварительное чтение отсекает известные дубликаты, а гонку с другим
+        импортом решает уникальный индекс: такие вставки тоже считаются дубликатами.
+        Возвращает (новые _id, число дубликатов).
+        """
+        by_hash = {}
+        for data in images:
+            by_hash.setdefault(content_hash(data), data)
+        existing = {
+            doc["hash"] for doc in
+            self.memes.find({"hash": {"$in": list(by_hash)}}, {"hash": 1})
+        }
+        fresh = [(digest, data) for digest, data in by_hash.items() if digest not in existing]
+        duplicates = len(images) - len(fresh)
+        if not fresh:
+            return [], duplicates
+
+        first_id = self.allocate_meme_ids(len(fresh))
+        now = datetime.datetime.utcnow()
+        docs = [
+            {
+                "_id": first_id + i,
+                "image": base64.b64encode(data).decode("utf-8"),
+                "created_at": now,
+                "uploader": uploader,
+                "size": len(data),
+                "format": detect_image_format(data[:12]),
+                "hash": digest,
+                "unique_hash": True,
+            }
+            for i, (digest, data) in enumerate(fresh)
+        ]
+        try:
+            self.memes.insert_many(docs, ordered=False)
+            new_ids = [doc["_id"] for doc in docs]
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            # Ту же картинку только что вставил другой импорт
+            lost = {error["index"] for error in errors}
+            new_ids = [doc["_id"] for i, doc in enumerate(docs) if i not in lost]
+            duplicates += len(lost)
+            if not new_ids:
+                return [], duplicates
+        # Одно условное обновление MEME_ORDER на пачку
+        self.insert_into_meme_order(new_ids)
+        logger.info(f"Added batch of {len(new_ids)} memes ({duplicates} duplicates skipped)")
+        return new_ids, duplicates
+
+    def add_meme_from_file(self, file_path, uploader="folder"):
         """Прочитать файл -> сохранить как base64"""
         with open(file_path, "rb") as f:
             encoded = base64.b64encode(f.read()).decode("utf-8")
 
-        return self.add_meme_base64(encoded)
+        return self.add_meme_base64(encoded, uploader=uploader)
 
     def sync_memes_from_folder(self, folder):
         """
@@ -129,34 +1061,609 @@ class MongoManager:
         return added
 
     def delete_meme(self, meme_id):
-        result = self.memes.delete_one({"_id": meme_id})
-        return result.deleted_count > 0
+        return self.delete_memes([meme_id]) > 0
+
+    # -------------------- пакетная модерация --------------------
+    def _record_tombstones(self, meme_ids, kind):
+        """Запоминает удаление мемов (kind: delete | soft_delete)"""
+        if not meme_ids:
+            return
+        now = datetime.datetime.utcnow()
+        self.meme_tombstones.bulk_write([
+            UpdateOne({"_id": meme_id}, {"$set": {"deleted_at": now, "kind": kind}}, upsert=True)
+            for meme_id in meme_ids
+        ], ordered=False)
+
+    # -------------------- популярность --------------------
+    def inc_meme_stats(self, deltas):
+        """deltas: {ID: (отправки, лайки)} — одним bulk_write; удалённые мемы пропускаются"""
+        if not deltas:
+            return
+        now = datetime.datetime.utcnow()
+        self.memes.bulk_write([
+            UpdateOne(
+                {"_id": meme_id},
+                {"$inc": {"stats.sends": sends, "stats.likes": likes}, "$set": {"stats.updated_at": now}},
+            )
+            for meme_id, (sends, likes) in deltas.items()
+        ], ordered=False)
+
+    def claim_like(self, message_key, user_id):
+        """Первый лайк пользователя под сообщением (во всех процессах бота); False — уже был"""
+        try:
+            self.meme_likes.insert_one(
+                {"_id": f"{message_key}:{user_id}", "created_at": datetime.datetime.utcnow()}
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def get_meme_stats(self, since=None):
+        """
+        Счётчики мемов: {ID: (отправки, лайки) или None, если мем убран из ротации}.
+        since=None — все активные мемы; иначе только изменившиеся после since
+        (новые, со свежими счётчиками, восстановленные, удалённые).
+        """
+        if since is None:
+            query = ACTIVE_FILTER
+        else:
+            query = {"$or": [
+                {"stats.updated_at": {"$gt": since}},
+                {"created_at": {"$gt": since}},
+                {"restored_at": {"$gt": since}},
+                {"deleted_at": {"$gt": since}},
+            ]}
+        result = {}
+        for doc in self.memes.find(query, {"stats": 1, "deleted": 1}):
+            stats = doc.get("stats", {})
+            result[doc["_id"]] = None if doc.get("deleted") else (stats.get("sends", 0), stats.get("likes", 0))
+        if since is not None:
+            for tombstone in self.get_tombstones_since(since):
+                result.setdefault(tombstone["_id"], None)
+        return result
+
+    def get_tombstones_since(self, since=None):
+        """Удаления после момента since (все — если None): [{_id, deleted_at, kind}]"""
+        query = {"deleted_at": {"$gt": since}} if since else {}
+        return list(self.meme_tombstones.find(query, sort=[("_id", 1)]))
+
+    def insert_into_meme_order(self, meme_ids):
+        """
+        Вставляет новые ID в случайные позиции непросмотренного хвоста MEME_ORDER
+        и увеличивает LAST_MEMES_COUNT — без перезаписи массива: ID дописывается
+        в конец и меняется местами со случайной позицией не левее курсора, так что
+        остальные позиции не сдвигаются. Условие записи — курсор не дошёл до
+        выбранных позиций; обычная выдача мемов (сдвиг MEME_INDEX) ему не мешает.
+        """
+        meme_ids = [int(meme_id) for meme_id in dict.fromkeys(meme_ids)]
+
+        def build(state, order):
+            # ID мог уже попасть в порядок (перемешивание прочитало его раньше)
+            present = np.isin(np.asarray(meme_ids, dtype=ORDER_DTYPE), order)
+            fresh = [meme_id for meme_id, seen in zip(meme_ids, present) if not seen]
+            if not fresh:
+                # Набор мемов всё равно изменился — снимок ID seeded-ротаций устарел
+                return {}, {}, {"MEMES_SEQ": 1}
+            cursor = min(state.get("MEME_INDEX", 0), len(order))
+            changes = {}
+            end = len(order)
+            for meme_id in fresh:
+                position = random.randint(cursor, end)
+                if position != end:
+                    changes[end] = changes.get(position, order[position] if position < len(order) else ORDER_HOLE)
+                changes[position] = meme_id
+                end += 1
+            condition = {"MEME_INDEX": {"$lte": min(changes)}}
+            return condition, changes, {"ORDER_SIZE": len(fresh), "LAST_MEMES_COUNT": len(fresh), "MEMES_SEQ": 1}
+
+        return self._patch_order(build)
+
+    def remove_from_meme_order(self, meme_ids):
+        """
+        Убирает ID из MEME_ORDER: на их местах остаются дыры (ORDER_HOLE), так что
+        позиции и курсор не сдвигаются, а пишется только правка. Дыры пропускаются
+        при выдаче и выбрасываются новым циклом. LAST_MEMES_COUNT уменьшается на
+        число убранных, поэтому сверка количества не запускает перемешивание.
+        """
+        meme_ids = np.asarray(list(meme_ids), dtype=ORDER_DTYPE)
+
+        def build(state, order):
+            positions = np.flatnonzero(np.isin(order, meme_ids))
+            if not len(positions):
+                return {}, {}, {"MEMES_SEQ": 1}
+            changes = {int(position): ORDER_HOLE for position in positions}
+            return {}, changes, {"ORDER_HOLES": len(positions), "LAST_MEMES_COUNT": -len(positions), "MEMES_SEQ": 1}
+
+        return self._patch_order(build)
+
+    def delete_memes(self, meme_ids):
+        """Удаляет мемы пачкой, возвращает число удалённых"""
+        meme_ids = list(meme_ids)
+        if not meme_ids:
+            return 0
+        existing = list(self.memes.find({"_id": {"$in": meme_ids}}, {"deleted": 1, "tags": 1}))
+        active = [doc for doc in existing if not doc.get("deleted")]
+        result = self.memes.delete_many({"_id": {"$in": meme_ids}})
+        self._record_tombstones([doc["_id"] for doc in existing], "delete")
+        self.update_tag_pools(remove=group_by_tag(active))
+        cache = get_image_cache()
+        for meme_id in meme_ids:
+            cache.invalidate(meme_id)
+        if result.deleted_count:
+            self.remove_from_meme_order(meme_ids)
+        logger.info(f"Deleted {result.deleted_count} memes")
+        return result.deleted_count
+
+    def soft_delete_memes(self, meme_ids):
+        """Переносит мемы в корзину (убирает из ротации, но не из БД)"""
+        meme_ids = list(meme_ids)
+        if not meme_ids:
+            return 0
+        active = list(self.memes.find({"_id": {"$in": meme_ids}, **ACTIVE_FILTER}, {"_id": 1, "tags": 1}))
+        active_ids = [doc["_id"] for doc in active]
+        if not active_ids:
+            return 0
+        result = self.memes.update_many(
+            {"_id": {"$in": active_ids}, **ACTIVE_FILTER},
+            {"$set": {"deleted": True, "deleted_at": datetime.datetime.utcnow()}},
+        )
+        self._record_tombstones(active_ids, "soft_delete")
+        self.update_tag_pools(remove=group_by_tag(active))
+        if result.modified_count:
+            self.remove_from_meme_order(active_ids)
+        logger.info(f"Soft-deleted {result.modified_count} memes")
+        return result.modified_count
+
+    def restore_memes(self, meme_ids):
+        """Возвращает мемы из корзины в ротацию"""
+        meme_ids = list(meme_ids)
+        if not meme_ids:
+            return 0
+        restored_docs = list(self.memes.find({"_id": {"$in": meme_ids}, "deleted": True}, {"_id": 1, "tags": 1}))
+        restored = [doc["_id"] for doc in restored_docs]
+        if not restored:
+            return 0
+        self.memes.update_many(
+            {"_id": {"$in": restored}},
+            {"$unset": {"deleted": "", "deleted_at": "", "quarantine_reason": ""},
+             "$set": {"restored_at": datetime.datetime.utcnow()}},
+        )
+        self.meme_tombstones.delete_many({"_id": {"$in": restored}})
+        self.insert_into_meme_order(restored)
+        self.update_tag_pools(add=group_by_tag(restored_docs))
+        logger.info(f"Restored {len(restored)} memes")
+        return len(restored)
+
+    # -------------------- проверка картинок --------------------
+    def quarantine_memes(self, reasons):
+        """
+        Убирает повреждённые мемы {ID: причина} из ротации в корзину с причиной
+        (мем можно посмотреть и восстановить или удалить из панели).
+        """
+        if not reasons:
+            return 0
+        quarantined = self.soft_delete_memes(reasons)
+        self.memes.bulk_write([
+            UpdateOne({"_id": meme_id}, {"$set": {"quarantine_reason": reason}})
+            for meme_id, reason in reasons.items()
+        ], ordered=False)
+        return quarantined
+
+    def replace_meme_images(self, images):
+        """
+        Перезаписывает картинки мемов {ID: base64} (починенный base64 той же картинки):
+        метаданные пересчитываются, ревизия растёт, чтобы кеши не отдали старое.
+        """
+        if not images:
+            return
+        requests = []
+        for meme_id, base64_str in images.items():
+            image_format, size = base64_info(base64_str)
+            requests.append(UpdateOne({"_id": meme_id}, {
+                "$set": {
+                    "image": base64_str,
+                    "size": size,
+                    "format": image_format,
+                    "hash": content_hash(base64.b64decode(base64_str)),
+                },
+                "$inc": {"rev": 1},
+            }))
+        self.memes.bulk_write(requests, ordered=False)
+        cache = get_image_cache()
+        for meme_id in images:
+            cache.invalidate(meme_id)
+        logger.info(f"Replaced images of {len(images)} memes")
+
+    def add_tags(self, meme_ids, tags):
+        """Добавляет теги мемам пачкой (активные мемы попадают в пулы тегов)"""
+        meme_ids = list(meme_ids)
+        tags = normalize_tags(tags)
+        if not meme_ids or not tags:
+            return 0
+        result = self.memes.update_many(
+            {"_id": {"$in": meme_ids}},
+            {"$addToSet": {"tags": {"$each": tags}}},
+        )
+        active_ids = self.get_active_meme_ids(meme_ids)
+        if active_ids:
+            self.update_tag_pools(add={tag: sorted(active_ids) for tag in tags})
+        return result.modified_count
+
+    def remove_tags(self, meme_ids, tags):
+        """Снимает теги с мемов пачкой и убирает мемы из пулов этих тегов"""
+        meme_ids = list(meme_ids)
+        tags = normalize_tags(tags)
+        if not meme_ids or not tags:
+            return 0
+        result = self.memes.update_many(
+            {"_id": {"$in": meme_ids}},
+            {"$pull": {"tags": {"$in": tags}}},
+        )
+        self.update_tag_pools(remove={tag: meme_ids for tag in tags})
+        return result.modified_count
+
+    # -------------------- tag_pools (пулы мемов по тегам) --------------------
+    # Документ на тег: {"_id": тег, "ids": Binary(int32), "count", "version",
+    # "seed", "pos", "domain", "updated_at"}. ids — активные мемы с тегом в том же
+    # упакованном формате, что и MEME_ORDER; ротация тега — перестановка Фейстеля
+    # над позициями [0, domain) массива ids, как у chat_rotations. Выбор мема —
+    # один find_one_and_update, массив ids читается только при смене version.
+    # Позиции не сдвигаются посреди цикла: убранный ID заменяется дырой
+    # (TAG_POOL_HOLE), дыры выбрасываются при старте следующего цикла.
+    def get_tag_pool_ids(self, tag, version=None):
+        """ID пула тега как np.ndarray[int32] (только для чтения) через кеш процесса"""
+        cached = self._tag_pool_cache.get(tag)
+        if cached is not None and version is not None and cached[0] == version:
+            return cached[1]
+        doc = self.tag_pools.find_one({"_id": tag}, {"ids": 1, "version": 1})
+        if doc is None:
+            return np.empty(0, dtype=ORDER_DTYPE)
+        ids = decode_order(doc.get("ids"))
+        if len(self._tag_pool_cache) >= TAG_POOL_CACHE_SIZE:
+            self._tag_pool_cache.clear()
+        self._tag_pool_cache[tag] = (doc.get("version"), ids)
+        return ids
+
+    def _update_tag_pool(self, tag, add=(), remove=(), replace=None):
+        """
+        Добавляет/убирает ID из пула тега compare-and-set по version (повтор при гонке).
+        Новые ID дописываются в конец, убранные заменяются дырой, поэтому позиции
+        текущего цикла ротации не сдвигаются;
+        replace — полный набор ID пула (сверка): лишние становятся дырами,
+        недостающие дописываются, остальные остаются на своих местах.
+        """
+        for _ in range(ORDER_CAS_RETRIES):
+            doc = self.tag_pools.find_one({"_id": tag}, {"ids": 1, "version": 1})
+            ids = decode_order(doc.get("ids") if doc else None)
+            add_ids, remove_ids = add, remove
+            if replace is not None:
+                members = np.asarray(replace, dtype=ORDER_DTYPE)
+                live = ids[ids != TAG_POOL_HOLE]
+                remove_ids = live[~np.isin(live, members)]
+                add_ids = members[~np.isin(members, live)].tolist()
+            new_ids = ids
+            if len(remove_ids):
+                removed = np.isin(new_ids, np.asarray(remove_ids, dtype=ORDER_DTYPE))
+                new_ids = np.where(removed, TAG_POOL_HOLE, new_ids).astype(ORDER_DTYPE)
+            if len(add_ids):
+                added = np.asarray(list(dict.fromkeys(add_ids)), dtype=ORDER_DTYPE)
+                new_ids = np.concatenate([new_ids, added[~np.isin(added, new_ids)]])
+            if np.array_equal(new_ids, ids):
+                return False
+            update = {
+                "ids": encode_order(new_ids),
+                "count": int(np.count_nonzero(new_ids != TAG_POOL_HOLE)),
+                "version": ObjectId(),
+                "updated_at": datetime.datetime.utcnow(),
+            }
+            if doc is None:
+                try:
+                    self.tag_pools.insert_one({"_id": tag, "seed": 0, "pos": 0, "domain": 0, **update})
+                    return True
+                except DuplicateKeyError:
+                    continue
+            result = self.tag_pools.update_one({"_id": tag, "version": doc.get("version")}, {"$set": update})
+            if result.matched_count:
+                return True
+        logger.warning(f"Tag pool '{tag}' update lost after retries, left for consistency check")
+        return False
+
+    def update_tag_pools(self, add=None, remove=None):
+        """Инкрементальное обновление пулов: add/remove — {тег: [ID]}"""
+        for tag, meme_ids in (remove or {}).items():
+            self._update_tag_pool(tag, remove=meme_ids)
+        for tag, meme_ids in (add or {}).items():
+            self._update_tag_pool(tag, add=meme_ids)
+
+    def rebuild_tag_pools(self):
+        """
+        Сверка пулов с коллекцией мемов (и первое построение для тегов, заданных
+        до появления пулов). Пул правится, только если набор ID отличается, и без
+        сдвига позиций (дыры + дописывание), уплотняется он лишь в начале цикла;
+        пулы тегов без активных мемов удаляются. Возвращает число исправленных пулов.
+        """
+        members = {
+            doc["_id"]: doc["ids"] for doc in self.memes.aggregate([
+                {"$match": {"tags.0": {"$exists": True}, **ACTIVE_FILTER}},
+                {"$project": {"tags": 1}},
+                {"$unwind": "$tags"},
+                {"$sort": {"_id": 1}},
+                {"$group": {"_id": "$tags", "ids": {"$push": "$_id"}}},
+            ], allowDiskUse=True)
+        }
+        fixed = sum(1 for tag, meme_ids in members.items() if self._update_tag_pool(tag, replace=meme_ids))
+        stale = self.tag_pools.delete_many({"_id": {"$nin": list(members)}}).deleted_count
+        if fixed or stale:
+            logger.info(f"Tag pools rebuilt: {fixed} updated, {stale} removed")
+        return fixed + stale
+
+    def list_tag_pools(self):
+        """[(тег, число мемов)] по убыванию размера"""
+        cursor = self.tag_pools.find({"count": {"$gt": 0}}, {"count": 1}, sort=[("count", -1), ("_id", 1)])
+        return [(doc["_id"], doc["count"]) for doc in cursor]
+
+    def advance_tag_position(self, tag):
+        """Атомарно вернуть {seed, pos, domain, version} ротации тега и сдвинуть pos. None — цикл исчерпан"""
+        return self.tag_pools.find_one_and_update(
+            {"_id": tag, "$expr": {"$lt": ["$pos", "$domain"]}},
+            {"$inc": {"pos": 1}},
+            projection={"seed": 1, "pos": 1, "domain": 1, "version": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+
+    def start_tag_cycle(self, tag, seed):
+        """
+        Начать новый цикл ротации тега над текущим пулом (без дыр), если его ещё
+        никто не перезапустил. False — пула нет или он пуст.
+        """
+        doc = self.tag_pools.find_one(
+            {"_id": tag, "count": {"$gt": 0}}, {"ids": 1, "version": 1, "pos": 1, "domain": 1}
+        )
+        if doc is None:
+            return False
+        if doc.get("pos", 0) < doc.get("domain", 0):
+            return True
+        ids = decode_order(doc.get("ids"))
+        update = {"seed": seed, "pos": 0, "domain": int(len(ids))}
+        if np.any(ids == TAG_POOL_HOLE):
+            ids = ids[ids != TAG_POOL_HOLE]
+            update.update({"ids": encode_order(ids), "version": ObjectId(), "domain": int(len(ids))})
+        # Условие по version: пул не меняли с момента чтения (иначе цикл начнёт следующий вызов)
+        self.tag_pools.update_one(
+            {"_id": tag, "version": doc.get("version"), "$expr": {"$gte": ["$pos", "$domain"]}},
+            {"$set": update},
+        )
+        return True
+
+    # -------------------- распознанный текст --------------------
+    def set_meme_ocr_texts(self, texts):
+        """Сохраняет распознанный текст {ID: текст} одним bulk_write (пустой текст — распознано, текста нет)"""
+        if not texts:
+            return
+        now = datetime.datetime.utcnow()
+        self.memes.bulk_write([
+            UpdateOne({"_id": meme_id}, {"$set": {"ocr_text": text, "ocr_at": now}})
+            for meme_id, text in texts.items()
+        ], ordered=False)
+
+    def search_memes(self, text, limit=20, skip=0, deleted=False):
+        """
+        Мемы, в подписи которых есть слова text, по релевантности — только метаданные,
+        по текстовому индексу. Возвращает (мемы, есть ли ещё).
+        """
+        query = {"$text": {"$search": text}}
+        query.update({"deleted": True} if deleted else ACTIVE_FILTER)
+        docs = list(self.memes.find(
+            query,
+            {
+                "_id": 1, "created_at": 1, "uploader": 1, "size": 1, "format": 1, "tags": 1,
+                "file_id": 1, "ocr_text": 1, "score": {"$meta": "textScore"},
+            },
+            sort=[("score", {"$meta": "textScore"}), ("_id", -1)],
+            skip=skip,
+            limit=limit + 1,
+        ))
+        return docs[:limit], len(docs) > limit
+
+    # -------------------- сборка альбомов --------------------
+    # Каждое сообщение альбома сохраняет свою картинку там, куда пришло, и отмечается
+    # здесь; сводку (и теги подписи на весь альбом) делает тот обработчик, который
+    # застал альбом без изменений quiet секунд и без картинок в процессе загрузки.
+    def start_album_photo(self, media_group_id, chat_id):
+        """Картинка альбома начала загружаться"""
+        now = datetime.datetime.utcnow()
+        self.pending_albums.update_one(
+            {"_id": media_group_id},
+            {"$inc": {"pending": 1}, "$set": {"updated_at": now},
+             "$setOnInsert": {"chat_id": chat_id, "created_at": now}},
+            upsert=True,
+        )
+
+    def finish_album_photo(self, media_group_id, meme_id=None, tags=()):
+        """Картинка альбома сохранена (meme_id) или не сохранилась (None); tags — теги её подписи"""
+        update = {
+            "$inc": {"pending": -1} if meme_id is not None else {"pending": -1, "failed": 1},
+            "$set": {"updated_at": datetime.datetime.utcnow()},
+        }
+        if meme_id is not None:
+            update["$push"] = {"meme_ids": meme_id}
+        tags = normalize_tags(tags)
+        if tags:
+            update["$addToSet"] = {"tags": {"$each": tags}}
+        self.pending_albums.update_one({"_id": media_group_id}, update)
+
+    def claim_album(self, media_group_id, quiet_seconds):
+        """
+        Забрать собранный альбом для сводки (ровно один обработчик получит документ).
+        None — альбом ещё собирается или его уже забрали.
+        """
+        quiet_since = datetime.datetime.utcnow() - datetime.timedelta(seconds=quiet_seconds)
+        return self.pending_albums.find_one_and_update(
+            {"_id": media_group_id, "pending": {"$lte": 0}, "claimed": {"$ne": True},
+             "updated_at": {"$lte": quiet_since}},
+            {"$set": {"claimed": True}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    # -------------------- подписки и рассылки --------------------
+    def subscribe_chat(self, chat_id, chat_type=None):
+        self.subscriptions.update_one(
+            {"_id": chat_id},
+            {"$set": {"active": True, "chat_type": chat_type, "subscribed_at": datetime.datetime.utcnow()}},
+            upsert=True,
+        )
+
+    def unsubscribe_chats(self, chat_ids, reason=None):
+        """Отключить подписки (команда /unsubscribe или бот заблокирован/удалён из чата)"""
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return 0
+        result = self.subscriptions.update_many(
+            {"_id": {"$in": chat_ids}, "active": True},
+            {"$set": {"active": False, "unsubscribed_at": datetime.datetime.utcnow(), "reason": reason}},
+        )
+        return result.modified_count
+
+    def is_subscribed(self, chat_id):
+        return self.subscriptions.count_documents({"_id": chat_id, "active": True}, limit=1) > 0
+
+    def count_subscriptions(self):
+        return self.subscriptions.count_documents({"active": True})
+
+    def iter_subscriber_ids(self):
+        return (doc["_id"] for doc in self.subscriptions.find({"active": True}, {"_id": 1}, sort=[("_id", 1)]))
+
+    def get_broadcast(self, day):
+        return self.broadcasts.find_one({"_id": day})
+
+    def create_broadcast(self, day):
+        """Создаёт запись рассылки дня (если её ещё нет) и возвращает её"""
+        return self.broadcasts.find_one_and_update(
+            {"_id": day},
+            {"$setOnInsert": {
+                "status": "resolving", "created_at": datetime.datetime.utcnow(),
+                "total": 0, "sent": 0, "failed": 0,
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def update_broadcast(self, day, set_fields=None, inc_fields=None):
+        update = {}
+        if set_fields:
+            update["$set"] = set_fields
+        if inc_fields:
+            update["$inc"] = inc_fields
+        if update:
+            self.broadcasts.update_one({"_id": day}, update)
+
+    def add_broadcast_items(self, day, assignments):
+        """assignments: {chat_id: meme_id}. Повторная вставка (после перезапуска) не дублирует элементы"""
+        if not assignments:
+            return 0
+        now = datetime.datetime.utcnow()
+        docs = [
+            {"_id": f"{day}:{chat_id}", "day": day, "chat_id": chat_id, "meme_id": meme_id,
+             "status": "pending", "created_at": now}
+            for chat_id, meme_id in assignments.items()
+        ]
+        try:
+            return len(self.broadcast_items.insert_many(docs, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            return e.details.get("nInserted", 0)
+
+    def get_pending_broadcast_items(self, day, limit):
+        return list(self.broadcast_items.find(
+            {"day": day, "status": "pending"}, {"chat_id": 1, "meme_id": 1},
+            sort=[("_id", 1)], limit=limit,
+        ))
+
+    def finish_broadcast_items(self, statuses):
+        """statuses: {_id элемента: "sent" | "failed" | "blocked"} — одним bulk_write"""
+        if not statuses:
+            return
+        now = datetime.datetime.utcnow()
+        self.broadcast_items.bulk_write([
+            UpdateOne({"_id": item_id}, {"$set": {"status": status, "finished_at": now}})
+            for item_id, status in statuses.items()
+        ], ordered=False)
+
+    def get_meme_file_ids(self, meme_ids):
+        """{ID: file_id} для мемов, уже известных Telegram"""
+        cursor = self.memes.find({"_id": {"$in": list(meme_ids)}, "file_id": {"$exists": True}}, {"file_id": 1})
+        return {doc["_id"]: doc["file_id"] for doc in cursor}
+
+    def get_active_meme_ids(self, meme_ids):
+        """Какие из meme_ids существуют и не в корзине"""
+        return {doc["_id"] for doc in self.memes.find({"_id": {"$in": list(meme_ids)}, **ACTIVE_FILTER}, {"_id": 1})}
 
     # -------------------- user_memes (UPDATED) --------------------
     def get_user_meme(self, user_id):
             """Получить мем дня по user_id"""
             return self.user_memes.find_one({"_id": user_id})
 
-    def set_user_meme(self, user_id, meme_id, date):
+    def set_user_meme(self, user_id, meme_id, date, expires_at=None):
         """
         Теперь храним ссылку на ID мема (int), а не файл или base64.
+        expires_at — момент, когда TTL-индекс удалит запись (по умолчанию конец суток date по UTC).
         """
+        if expires_at is None:
+            expires_at = day_end(date)
         self.user_memes.update_one(
             {"_id": user_id},
-            {"$set": {"meme_id": meme_id, "date": date}},
+            {"$set": {"meme_id": meme_id, "date": date, "expires_at": expires_at}},
             upsert=True
         )
 
+    def set_user_memes_bulk(self, assignments, date, expires_at=None):
+        """assignments: {user_id: meme_id} — мем дня для многих пользователей одним bulk_write"""
+        if not assignments:
+            return
+        if expires_at is None:
+            expires_at = day_end(date)
+        self.user_memes.bulk_write([
+            UpdateOne(
+                {"_id": user_id},
+                {"$set": {"meme_id": meme_id, "date": date, "expires_at": expires_at}},
+                upsert=True,
+            )
+            for user_id, meme_id in assignments.items()
+        ], ordered=False)
+
+    def get_user_memes_for_day(self, user_ids, date):
+        """{user_id: meme_id} тех из user_ids, у кого мем дня date уже выбран"""
+        cursor = self.user_memes.find({"_id": {"$in": list(user_ids)}, "date": date}, {"meme_id": 1})
+        return {doc["_id"]: doc["meme_id"] for doc in cursor}
+
     def delete_user_meme(self, user_id):
         self.user_memes.delete_one({"_id": user_id})
 
-    def cleanup_old_user_memes(self, today_date):
-        result = self.user_memes.delete_many({"date": {"$ne": today_date}})
+    def cleanup_legacy_user_memes(self, today_date):
+        """Удаляет устаревшие записи без expires_at (созданные до TTL-индекса)"""
+        result = self.user_memes.delete_many(
+            {"expires_at": {"$exists": False}, "date": {"$ne": today_date}}
+        )
         return result.deleted_count
 
-    def get_memes_cursor(self):
+    def get_memes_cursor(self, since_id=None, since=None, max_id=None, missing=None, fields=None):
             """
             Возвращает курсор для всех мемов, отсортированных по _id.
             Используется для потоковой обработки без загрузки всех документов в память.
+            since_id — только мемы с _id больше since_id (проход пачками);
+            since — только добавленные (created_at) или восстановленные из корзины после since;
+            max_id — верхняя граница _id;
+            missing — только мемы без этого поля (дозаполнение);
+            fields — проекция (например, только _id), по умолчанию документ целиком.
             """
-            return self.memes.find({}, sort=[("_id", 1)])
\ No newline at end of file
+            query = dict(ACTIVE_FILTER)
+            if since_id is not None or max_id is not None:
+                query["_id"] = {}
+                if since_id is not None:
+                    query["_id"]["$gt"] = since_id
+                if max_id is not None:
+                    query["_id"]["$lte"] = max_id
+            if since is not None:
+                query["$or"] = [{"created_at": {"$gt": since}}, {"restored_at": {"$gt": since}}]
+            if missing is not None:
+                query[missing] = {"$exists": False}
+            return self.memes.find(query, fields, sort=[("_id", 1)])
\ No newline at end of file
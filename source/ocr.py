@@ -0,0 +1,147 @@
+# Распознавание подписей на мемах (OCR) для поиска
+#
+# Текст извлекает локальный tesseract (через pytesseract) в отдельном пуле
+# потоков: каждый вызов — свой процесс tesseract, поэтому потоки загружают
+# ядра параллельно, а event loop и хендлеры распознавания не ждут.
+# * мем, загруженный через бота, распознаётся сразу после добавления;
+# * мемы из панели, импорта и добавленные до OCR дозаполняет фоновая задача;
+# * текст хранится в поле ocr_text под текстовым индексом Mongo, поэтому
+#   /search и поиск панели отвечают по индексу, не трогая картинки.
+# pytesseract и Pillow необязательны: без них (или без бинарника tesseract)
+# поиск работает по уже распознанному тексту, а новые мемы не распознаются.
+
+import os
+import io
+import base64
+import re
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = None
+
+from source import meme_manager
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "enabled": True,
+    "workers": max(1, (os.cpu_count() or 2) // 2),
+    "languages": "rus+eng",
+    "backfill_batch": 50,
+}
+# Картинки меньше этой ширины увеличиваются перед распознаванием: мелкий текст tesseract теряет
+MIN_WIDTH = 1000
+# Слово — от двух букв/цифр; одиночные символы на картинках почти всегда шум
+WORD_RE = re.compile(r"\w{2,}")
+
+_config = dict(DEFAULTS)
+_pool = None
+_pool_lock = threading.Lock()
+_available = None
+
+# Каждый tesseract — один поток: параллелизм даёт пул, а не OpenMP внутри процесса
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+
+def configure(config=None):
+    """Настройки из секции ocr конфига (до первого распознавания)"""
+    global _config
+    _config = {**DEFAULTS, **{k: v for k, v in (config or {}).items() if v is not None}}
+
+
+def available():
+    """Есть ли pytesseract/Pillow и бинарник tesseract (проверяется один раз)"""
+    global _available
+    if _available is None:
+        if not _config["enabled"] or pytesseract is None:
+            _available = False
+        else:
+            try:
+                version = pytesseract.get_tesseract_version()
+                logger.info(f"OCR: tesseract {version}, {_config['workers']} workers")
+                _available = True
+            except Exception as e:
+                logger.warning(f"OCR disabled: {e}")
+                _available = False
+    return _available
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=int(_config["workers"]), thread_name_prefix="ocr")
+        return _pool
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def normalize_text(text):
+    """Слова распознанного текста в нижнем регистре через пробел"""
+    return " ".join(WORD_RE.findall(text.lower()))
+
+
+def extract_text(data):
+    """Текст картинки (bytes); пустая строка, если текста нет или картинка не читается"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.seek(0)  # у GIF — первый кадр
+        image = image.convert("L")
+        if image.width < MIN_WIDTH:
+            scale = MIN_WIDTH / image.width
+            image = image.resize((MIN_WIDTH, round(image.height * scale)))
+        return normalize_text(pytesseract.image_to_string(image, lang=_config["languages"]))
+    except Exception as e:
+        logger.warning(f"OCR failed: {e}")
+        return ""
+
+
+def _recognize(meme_id, data):
+    text = extract_text(data)
+    meme_manager.mongo.set_meme_ocr_texts({meme_id: text})
+    return text
+
+
+def submit(meme_id, data):
+    """Распознать мем в фоне (при загрузке); None — OCR недоступен"""
+    if not available():
+        return None
+    return get_pool().submit(_recognize, meme_id, data)
+
+
+def backfill(batch_size=None, limit=None):
+    """
+    Распознаёт мемы без ocr_text пачками по _id (синхронно, из фоновой задачи).
+    Пачка распознаётся параллельно в пуле и записывается одним bulk_write.
+    limit — не больше стольких мемов за вызов; возвращает число распознанных.
+    """
+    if not available():
+        return 0
+    batch_size = int(batch_size or _config["backfill_batch"])
+    mongo = meme_manager.mongo
+    pool = get_pool()
+    last_id = -1
+    done = 0
+    while limit is None or done < limit:
+        docs = list(mongo.get_memes_cursor(since_id=last_id, missing="ocr_text").limit(batch_size))
+        if not docs:
+            break
+        last_id = docs[-1]["_id"]
+        images = {doc["_id"]: base64.b64decode(doc["image"]) for doc in docs}
+        texts = dict(zip(images, pool.map(extract_text, images.values())))
+        mongo.set_meme_ocr_texts(texts)
+        done += len(texts)
+    if done:
+        logger.info(f"OCR backfill: {done} memes recognized")
+    return done
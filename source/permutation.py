@@ -0,0 +1,64 @@
+# Псевдослучайная перестановка без хранения массива порядка
+#
+# Сеть Фейстеля — биекция на [0, 2^bits). Чтобы получить биекцию на [0, size),
+# используется cycle-walking: если результат >= size, шифруем его ещё раз,
+# пока не попадём в диапазон. Домен выбирается не больше 4*size, поэтому в
+# среднем хватает 1-4 шагов. Позиция -> индекс считается за O(1) по времени
+# и памяти, хранить нужно только (seed, position).
+
+import functools
+import hashlib
+
+FEISTEL_ROUNDS = 4
+
+
+def _round_keys(seed, rounds):
+    digest = hashlib.blake2b(str(seed).encode("utf-8"), digest_size=8 * rounds).digest()
+    return [int.from_bytes(digest[i * 8:(i + 1) * 8], "little") for i in range(rounds)]
+
+
+class FeistelPermutation:
+    """Биекция [0, size) -> [0, size), заданная seed"""
+
+    def __init__(self, size, seed, rounds=FEISTEL_ROUNDS):
+        if size <= 0:
+            raise ValueError("size must be positive")
+        self.size = size
+        self.seed = seed
+        bits = max(2, (size - 1).bit_length())
+        bits += bits % 2  # сеть сбалансированная: две равные половины
+        self.half_bits = bits // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.keys = _round_keys(seed, rounds)
+
+    def _round(self, value, key):
+        # Перемешивающая функция раунда (multiply-xorshift), результат обрезается до половины
+        h = ((value ^ key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h ^= h >> 29
+        h = (h * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        h ^= h >> 32
+        return h & self.half_mask
+
+    def _encrypt(self, value):
+        left = value >> self.half_bits
+        right = value & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.size:
+            raise IndexError(position)
+        value = self._encrypt(position)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+    def __len__(self):
+        return self.size
+
+
+@functools.lru_cache(maxsize=64)
+def get_permutation(size, seed):
+    """Кеш объектов перестановки (ключи раундов считаются один раз на цикл)"""
+    return FeistelPermutation(size, seed)
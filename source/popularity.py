@@ -0,0 +1,172 @@
+# Популярность мемов: буферизованные счётчики и взвешенный выбор за O(1)
+#
+# * PopularityCounters — отправки и лайки копятся в памяти процесса и
+#   сбрасываются в Mongo одним bulk_write раз в несколько секунд, а не $inc
+#   на каждую отправку.
+# * AliasTable — таблица Уолкера/Воуза: выбор индекса с вероятностью,
+#   пропорциональной весу, за O(1).
+# * WeightedSampler — веса разбиты на блоки по BUCKET_SIZE, у каждого блока
+#   своя таблица, а верхняя таблица выбирает блок по сумме его весов.
+#   Изменение веса пересобирает только свой блок и верхнюю таблицу
+#   (O(BUCKET_SIZE + n / BUCKET_SIZE) вместо O(n)), выбор — два шага по O(1).
+
+import random
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+BUCKET_SIZE = 1024
+# Во сколько раз мем, который лайкают при каждой отправке, вероятнее мема без лайков
+DEFAULT_LIKE_WEIGHT = 9
+# Сколько последних лайков (сообщение, пользователь) помнит процесс: повторные нажатия
+# отсекаются без запроса к Mongo (общая для процессов отметка — коллекция meme_likes)
+LIKE_DEDUP_SIZE = 100_000
+
+
+def meme_weight(sends, likes, like_weight=DEFAULT_LIKE_WEIGHT):
+    """
+    Вес мема: 1 + like_weight * доля лайков (со сглаживанием Лапласа).
+    Зависит от доли, а не от числа отправок, поэтому часто показываемый мем
+    не становится ещё чаще показываемым сам по себе.
+    """
+    return 1.0 + like_weight * (likes + 1) / (sends + 2)
+
+
+class AliasTable:
+    """Метод Воуза: O(n) построение, O(1) выбор"""
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        self.size = n
+        self.total = float(weights.sum())
+        self.prob = np.ones(n, dtype=np.float64)
+        self.alias = np.arange(n, dtype=np.int64)
+        if n == 0 or self.total <= 0:
+            return
+        scaled = weights * (n / self.total)
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Остатки — погрешность округления, их вероятность 1
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self, rng=random):
+        i = rng.randrange(self.size)
+        return i if rng.random() < self.prob[i] else int(self.alias[i])
+
+
+class WeightedSampler:
+    """Взвешенный выбор ID мема с инкрементальным обновлением весов"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = []            # блоки ID
+        self._weights = []        # блоки весов (np.ndarray)
+        self._slots = {}          # ID -> (блок, позиция)
+        self._tables = []         # AliasTable блоков
+        self._top = None
+        self._dirty = set()
+
+    def __len__(self):
+        return sum(int(np.count_nonzero(bucket)) for bucket in self._weights)
+
+    def update(self, weights):
+        """weights: {ID: вес}; вес 0 убирает мем из выбора"""
+        with self._lock:
+            for meme_id, weight in weights.items():
+                slot = self._slots.get(meme_id)
+                if slot is None:
+                    if weight <= 0:
+                        continue
+                    if not self._ids or len(self._ids[-1]) >= BUCKET_SIZE:
+                        self._ids.append([])
+                        self._weights.append(np.zeros(BUCKET_SIZE, dtype=np.float64))
+                        self._tables.append(None)
+                    bucket = len(self._ids) - 1
+                    slot = (bucket, len(self._ids[bucket]))
+                    self._ids[bucket].append(meme_id)
+                    self._slots[meme_id] = slot
+                bucket, pos = slot
+                self._weights[bucket][pos] = max(0.0, weight)
+                self._dirty.add(bucket)
+
+    def replace(self, weights):
+        """Полная пересборка (выкидывает слоты удалённых мемов)"""
+        with self._lock:
+            self._ids, self._weights, self._slots, self._tables = [], [], {}, []
+            self._top, self._dirty = None, set()
+        self.update(weights)
+
+    def _rebuild(self):
+        for bucket in self._dirty:
+            count = len(self._ids[bucket])
+            self._tables[bucket] = AliasTable(self._weights[bucket][:count])
+        self._dirty.clear()
+        self._top = AliasTable([table.total for table in self._tables])
+
+    def sample(self, rng=random):
+        """Случайный ID с вероятностью, пропорциональной весу (None — выбирать не из чего)"""
+        with self._lock:
+            if self._dirty or self._top is None:
+                self._rebuild()
+            top = self._top
+            if top.size == 0 or top.total <= 0:
+                return None
+            bucket = top.sample(rng)
+            return self._ids[bucket][self._tables[bucket].sample(rng)]
+
+
+class PopularityCounters:
+    """Буфер счётчиков отправок и лайков процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}        # ID -> [отправки, лайки]
+        self._liked = OrderedDict()
+
+    def record_send(self, meme_id):
+        with self._lock:
+            self._pending.setdefault(meme_id, [0, 0])[0] += 1
+
+    def is_liked(self, key):
+        with self._lock:
+            return key in self._liked
+
+    def record_like(self, meme_id, key, counted=True):
+        """
+        Лайк мема; key — (сообщение, пользователь). Повторный лайк того же
+        ключа (пока он помнится процессом) не считается. counted=False — только
+        запомнить ключ (лайк уже засчитан другим процессом). Возвращает True, если засчитан.
+        """
+        with self._lock:
+            if key in self._liked:
+                return False
+            self._liked[key] = None
+            if len(self._liked) > LIKE_DEDUP_SIZE:
+                self._liked.popitem(last=False)
+            if not counted:
+                return False
+            self._pending.setdefault(meme_id, [0, 0])[1] += 1
+            return True
+
+    def drain(self):
+        """Забрать накопленное: {ID: (отправки, лайки)}"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return {meme_id: tuple(counts) for meme_id, counts in pending.items()}
+
+    def restore(self, pending):
+        """Вернуть в буфер то, что не удалось записать"""
+        with self._lock:
+            for meme_id, (sends, likes) in pending.items():
+                counts = self._pending.setdefault(meme_id, [0, 0])
+                counts[0] += sends
+                counts[1] += likes
@@ -0,0 +1,156 @@
+# Профилирование по запросу для бота и панели
+#
+# * timed_handler — замер времени хендлера и числа запросов к MongoDB,
+#   медленные вызовы пишутся в лог. Пока профилирование выключено,
+#   обёртка сводится к одной проверке флага, а счётчик команд не
+#   подключается к MongoClient вовсе.
+# * ContextExecutor — пул потоков по умолчанию процесса бота: переносит
+#   контекст хендлера в поток (run_in_executor сам этого не делает), иначе
+#   запросы к MongoDB, вынесенные из event loop, не попадали бы в счётчик.
+# * sample_stacks — сэмплирующий профайлер: раз в interval снимает стеки всех
+#   потоков процесса и возвращает их в «свёрнутом» формате (collapsed stacks),
+#   который понимают flamegraph.pl, speedscope и inferno.
+
+import sys
+import time
+import logging
+import threading
+import functools
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+ENABLED = False
+SLOW_CALL_MS = 500
+# Верхняя граница длительности одного сеанса сэмплирования, секунды
+MAX_PROFILE_SECONDS = 60
+SAMPLE_INTERVAL = 0.005
+
+# Счётчик запросов к MongoDB текущего хендлера (список — чтобы его видели и копии контекста)
+_mongo_calls = contextvars.ContextVar("mongo_calls", default=None)
+# Вызываются при включении/выключении: клиенты MongoDB пересоздаются с нужными слушателями
+_toggle_hooks = []
+
+
+def configure(enabled=False, slow_call_ms=SLOW_CALL_MS):
+    global ENABLED, SLOW_CALL_MS
+    changed = ENABLED != bool(enabled)
+    ENABLED = bool(enabled)
+    SLOW_CALL_MS = int(slow_call_ms)
+    if changed:
+        for hook in _toggle_hooks:
+            hook()
+    logger.info(f"Profiling hooks {'enabled' if ENABLED else 'disabled'} (slow call >= {SLOW_CALL_MS} ms)")
+
+
+def on_toggle(hook):
+    """hook() вызывается, когда профилирование включают или выключают"""
+    _toggle_hooks.append(hook)
+
+
+class MongoCommandCounter(monitoring.CommandListener):
+    """Считает команды MongoDB в контексте текущего хендлера"""
+
+    def started(self, event):
+        if ENABLED:
+            counter = _mongo_calls.get()
+            if counter is not None:
+                counter[0] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+mongo_command_counter = MongoCommandCounter()
+
+
+def command_listeners():
+    """Слушатели команд для нового MongoClient (пусто — профилирование выключено)"""
+    return [mongo_command_counter] if ENABLED else []
+
+
+class ContextExecutor(ThreadPoolExecutor):
+    """Пул потоков, задачи которого видят contextvars отправившего их хендлера (как asyncio.to_thread)"""
+
+    def submit(self, fn, /, *args, **kwargs):
+        if ENABLED:
+            return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        return super().submit(fn, *args, **kwargs)
+
+
+def start_call():
+    """Начать замер; возвращает состояние для finish_call() (None — профилирование выключено)"""
+    if not ENABLED:
+        return None
+    counter = [0]
+    return time.perf_counter(), counter, _mongo_calls.set(counter)
+
+
+def finish_call(name, started):
+    if started is None:
+        return
+    t0, counter, token = started
+    _mongo_calls.reset(token)
+    elapsed_ms = (time.perf_counter() - t0) * 1000
+    if elapsed_ms >= SLOW_CALL_MS:
+        logger.warning(f"Slow call {name}: {elapsed_ms:.0f} ms, MongoDB round trips: {counter[0]}")
+
+
+def timed_handler(func):
+    """Декоратор асинхронного хендлера: лог медленных вызовов с числом запросов к MongoDB"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return await func(*args, **kwargs)
+        started = start_call()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            finish_call(func.__name__, started)
+    return wrapper
+
+
+# -------------------- сэмплирующий профайлер --------------------
+def _frame_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return ";".join(stack)
+
+
+_profile_lock = threading.Lock()
+
+
+def sample_stacks(seconds, interval=SAMPLE_INTERVAL):
+    """
+    Снимает стеки всех потоков (кроме своего) в течение seconds секунд.
+    Возвращает текст в формате collapsed stacks: "f1;f2;f3 <число сэмплов>".
+    Одновременно допускается один сеанс.
+    """
+    seconds = max(1, min(int(seconds), MAX_PROFILE_SECONDS))
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("Profiling session already running")
+    try:
+        own_id = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        samples = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                samples[f"{names.get(thread_id, thread_id)};{_frame_stack(frame)}"] += 1
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+    return "\n".join(f"{stack} {count}" for stack, count in samples.most_common())
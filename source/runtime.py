@@ -0,0 +1,92 @@
+# Запуск event loop бота
+#
+# Процесс бота — один asyncio.Runner без nest_asyncio: цикл событий не
+# патчится, переключение задач идёт штатным кодом asyncio (или uvloop).
+# * event_loop: asyncio | uvloop — uvloop включается явно и только если
+#   установлен, иначе остаётся стандартный цикл;
+# * executor_workers — размер пула потоков по умолчанию, куда уходит
+#   блокирующая работа (Mongo, ZIP, профилирование) через run_in_executor(None, ...);
+# * SIGINT/SIGTERM не обрывают процесс, а будят main(), и она корректно
+#   останавливает приём апдейтов, очередь отправки и пул потоков.
+
+import asyncio
+import logging
+import signal
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from source import profiling
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "event_loop": "asyncio",
+    "executor_workers": 32,
+}
+
+SHUTDOWN_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+_stop_event = None
+
+
+def loop_factory(name="asyncio"):
+    """Фабрика event loop по имени из конфига (None — стандартный цикл asyncio)"""
+    if name == "uvloop":
+        if uvloop is not None:
+            return uvloop.new_event_loop
+        logger.warning("uvloop is not installed, using the default asyncio event loop")
+    elif name != "asyncio":
+        logger.warning(f"Unknown event loop '{name}', using the default asyncio event loop")
+    return None
+
+
+def install_signal_handlers(loop):
+    """SIGINT/SIGTERM -> событие остановки (без KeyboardInterrupt посреди хендлера)"""
+    global _stop_event
+    _stop_event = asyncio.Event()
+
+    def on_signal(signum):
+        logger.info(f"Received {signal.Signals(signum).name}, shutting down")
+        _stop_event.set()
+
+    for signum in SHUTDOWN_SIGNALS:
+        try:
+            loop.add_signal_handler(signum, on_signal, signum)
+        except (NotImplementedError, RuntimeError):
+            # Windows / не главный поток: остаётся KeyboardInterrupt по Ctrl+C
+            pass
+
+
+async def wait_for_stop():
+    """Ждать сигнала остановки процесса"""
+    if _stop_event is None:
+        install_signal_handlers(asyncio.get_running_loop())
+    await _stop_event.wait()
+
+
+def request_stop():
+    """Остановить процесс изнутри (как по сигналу)"""
+    if _stop_event is not None:
+        _stop_event.set()
+
+
+def run(main, runtime_config=None):
+    """
+    Выполнить корутину main в новом event loop с настройками runtime_config
+    и закрыть его (с пулом потоков) по завершении.
+    """
+    config = {**DEFAULTS, **{k: v for k, v in (runtime_config or {}).items() if v is not None}}
+    with asyncio.Runner(loop_factory=loop_factory(config["event_loop"])) as runner:
+        loop = runner.get_loop()
+        # Задачи пула видят контекст хендлера: счётчик запросов профилирования работает и в потоках
+        executor = profiling.ContextExecutor(
+            max_workers=int(config["executor_workers"]), thread_name_prefix="offload"
+        )
+        loop.set_default_executor(executor)
+        install_signal_handlers(loop)
+        logger.info(f"Event loop: {type(loop).__module__}.{type(loop).__name__}, "
+                    f"executor workers: {config['executor_workers']}")
+        return runner.run(main)
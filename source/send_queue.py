@@ -0,0 +1,143 @@
+# Очередь исходящих сообщений с учётом лимитов Telegram
+#
+# Хендлеры не вызывают reply_photo/reply_text напрямую, а ставят отправку
+# в очередь и ждут её результата:
+# * общий лимит бота (по умолчанию 30 сообщений/с) и интервал на чат
+#   (личка — 1 с, группы — 3 с, т.е. 20 в минуту) соблюдаются заранее,
+#   слоты времени раздаются в порядке очереди;
+# * RetryAfter (429) не теряет отправку: запрос повторяется через указанное
+#   время, а вся очередь на это время приостанавливается;
+# * очередь ограничена — при всплеске хендлеры ждут места в ней, и бот
+#   перестаёт брать новые апдейты быстрее, чем может ответить.
+
+import asyncio
+import logging
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "global_rate": 30,              # сообщений в секунду на бота
+    "private_chat_interval": 1.0,   # секунд между сообщениями в личный чат
+    "group_chat_interval": 3.0,     # секунд между сообщениями в группу
+    "max_queue": 1000,
+    "workers": 32,
+    "max_retries": 5,
+}
+
+
+class SendQueue:
+    def __init__(self, **config):
+        self.configure(**config)
+        self._queue = None
+        self._tasks = []
+        self._next_global = 0.0
+        self._next_chat = {}
+        self._paused_until = 0.0
+        self.stats = {"sent": 0, "retried": 0, "failed": 0}
+
+    def configure(self, **config):
+        cfg = {**DEFAULTS, **{k: v for k, v in config.items() if v is not None}}
+        self.global_interval = 1.0 / float(cfg["global_rate"])
+        self.private_interval = float(cfg["private_chat_interval"])
+        self.group_interval = float(cfg["group_chat_interval"])
+        self.max_queue = int(cfg["max_queue"])
+        self.workers = int(cfg["workers"])
+        self.max_retries = int(cfg["max_retries"])
+
+    @property
+    def running(self):
+        return bool(self._tasks)
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker(), name=f"send-queue-{i}") for i in range(self.workers)]
+        logger.info(f"Send queue started: {self.workers} workers, "
+                    f"{1 / self.global_interval:.1f} msg/s, queue {self.max_queue}")
+
+    async def stop(self):
+        """Дождаться отправки поставленного и остановить воркеров"""
+        if not self._tasks:
+            return
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(f"Send queue stopped: {self.stats}")
+
+    async def send(self, chat_id, method, *args, **kwargs):
+        """
+        Поставить вызов method(*args, **kwargs) (например, message.reply_photo)
+        в очередь чата chat_id и дождаться результата.
+        Пока очередь полна, вызывающий ждёт — это и есть обратное давление.
+        Без запущенной очереди вызов выполняется сразу.
+        """
+        if not self._tasks:
+            return await method(*args, **kwargs)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((chat_id, method, args, kwargs, future))
+        return await future
+
+    def _reserve_chat(self, chat_id):
+        """Зарезервировать ближайший момент отправки в чат; возвращает, сколько ждать"""
+        now = asyncio.get_running_loop().time()
+        interval = self.group_interval if isinstance(chat_id, int) and chat_id < 0 else self.private_interval
+        at = max(now, self._paused_until, self._next_chat.get(chat_id, 0.0))
+        self._next_chat[chat_id] = at + interval
+        # Старые записи о чатах больше ничего не ограничивают
+        if len(self._next_chat) > 10 * self.max_queue:
+            self._next_chat = {c: t for c, t in self._next_chat.items() if t > now}
+        return at - now
+
+    def _reserve_global(self):
+        """
+        Слот общего лимита берётся только когда чат уже готов к отправке:
+        иначе сообщение в «медленный» чат заняло бы слот в будущем и задержало остальных.
+        """
+        now = asyncio.get_running_loop().time()
+        at = max(now, self._paused_until, self._next_global)
+        self._next_global = at + self.global_interval
+        return at - now
+
+    async def _worker(self):
+        while True:
+            chat_id, method, args, kwargs, future = await self._queue.get()
+            try:
+                if not future.cancelled():
+                    future.set_result(await self._deliver(chat_id, method, args, kwargs))
+            except Exception as e:
+                self.stats["failed"] += 1
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, chat_id, method, args, kwargs):
+        attempt = 0
+        while True:
+            for reserve in (lambda: self._reserve_chat(chat_id), self._reserve_global):
+                delay = reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # Файл (BytesIO) читается заново при каждой попытке
+            for value in (*args, *kwargs.values()):
+                if hasattr(value, "seek"):
+                    value.seek(0)
+            try:
+                result = await method(*args, **kwargs)
+                self.stats["sent"] += 1
+                return result
+            except RetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.stats["retried"] += 1
+                retry_after = float(e.retry_after)
+                # Флуд-контроль касается всего бота: притормаживаем всю очередь
+                self._paused_until = max(self._paused_until, asyncio.get_running_loop().time() + retry_after)
+                logger.warning(f"RetryAfter {retry_after}s for chat {chat_id} (attempt {attempt})")
+
+
+outbox = SendQueue()
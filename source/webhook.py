@@ -0,0 +1,113 @@
+# Приём обновлений Telegram через webhook (альтернатива long polling)
+#
+# В отличие от встроенного updater.start_webhook() PTB, сервер здесь
+# поднимается на сокете с SO_REUSEPORT, поэтому несколько процессов бота
+# могут слушать один и тот же порт — ядро само распределит соединения.
+#
+# Проверить локально можно без Telegram, отправив синтетический апдейт:
+#   curl -X POST http://127.0.0.1:8443/telegram \
+#        -H "X-Telegram-Bot-Api-Secret-Token: <secret_token>" \
+#        -H "Content-Type: application/json" \
+#        -d '{"update_id": 1, "message": {"message_id": 1, "date": 0,
+#             "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": false,
+#             "first_name": "test"}, "text": "/meme_count",
+#             "entities": [{"type": "bot_command", "offset": 0, "length": 11}]}}'
+
+import hmac
+import json
+import logging
+
+from telegram import Update
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class TelegramUpdateHandler(RequestHandler):
+    """POST с JSON апдейтом -> очередь обновлений PTB Application"""
+
+    def initialize(self, ptb_app, secret_token):
+        self.ptb_app = ptb_app
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token:
+            received = self.request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(received, self.secret_token):
+                logger.warning(f"Webhook request with invalid secret token from {self.request.remote_ip}")
+                self.set_status(403)
+                return
+
+        try:
+            data = json.loads(self.request.body)
+            update = Update.de_json(data, self.ptb_app.bot)
+        except Exception as e:
+            logger.error(f"Failed to parse webhook update: {e}")
+            self.set_status(400)
+            return
+
+        # Обработка идёт асинхронно в Application, Telegram сразу получает 200
+        await self.ptb_app.update_queue.put(update)
+        self.set_status(200)
+
+    def get(self):
+        # Простая проверка живости для балансировщика / docker healthcheck
+        self.write({"ok": True})
+
+    def log_exception(self, typ, value, tb):
+        logger.error(f"Webhook handler error: {value}")
+
+
+def bind_webhook_sockets(webhook_config):
+    """
+    Создаёт слушающие сокеты.
+    Вызывается в каждом процессе отдельно: с reuse_port несколько процессов
+    делят один порт.
+    """
+    listen = webhook_config.get("listen", "0.0.0.0")
+    port = int(webhook_config.get("port", 8443))
+    reuse_port = int(webhook_config.get("workers", 1)) > 1
+    return bind_sockets(port, address=listen, reuse_port=reuse_port)
+
+
+async def start_webhook_server(ptb_app, webhook_config, set_webhook=True):
+    """
+    Запускает HTTP сервер webhook в текущем event loop.
+    set_webhook=True — зарегистрировать URL в Telegram (делает только один процесс).
+    Возвращает HTTPServer, который нужно остановить через stop_webhook_server().
+    """
+    path = "/" + webhook_config.get("path", "telegram").strip("/")
+    secret_token = webhook_config.get("secret_token") or None
+
+    app = Application([
+        (path, TelegramUpdateHandler, {"ptb_app": ptb_app, "secret_token": secret_token}),
+    ])
+    server = HTTPServer(app)
+    server.add_sockets(bind_webhook_sockets(webhook_config))
+
+    url = webhook_config.get("url", "")
+    if set_webhook:
+        if url:
+            await ptb_app.bot.set_webhook(
+                url=url.rstrip("/") + path,
+                secret_token=secret_token,
+                max_connections=int(webhook_config.get("max_connections", 40)),
+            )
+            logger.info(f"Webhook registered: {url.rstrip('/')}{path}")
+        else:
+            logger.warning("webhook.url is empty — Telegram webhook is not registered (local mode)")
+
+    logger.info(
+        f"Webhook server listening on {webhook_config.get('listen', '0.0.0.0')}:"
+        f"{webhook_config.get('port', 8443)}{path}"
+    )
+    return server
+
+
+async def stop_webhook_server(server):
+    server.stop()
+    await server.close_all_connections()
@@ -0,0 +1,81 @@
+# Общие фикстуры тестов: MongoDB подменяется на mongomock, у каждого теста
+# своя пустая база. Зависимости тестов — requirements-dev.txt:
+#   pip install -r requirements-dev.txt
+#   python -m pytest -q   (из корня репозитория)
+
+import base64
+
+import mongomock
+import pytest
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.results import BulkWriteResult
+
+from source import image_cache
+from source import mongo_manager
+
+# Клиент создаётся в get_client: до импорта meme_manager (он подключается при импорте)
+mongo_manager.MongoClient = mongomock.MongoClient
+
+
+def _bulk_write(self, requests, ordered=True, **kwargs):
+    """
+    bulk_write для mongomock: его собственный не понимает запросы pymongo 4.x
+    (аргумент sort у UpdateOne). Запросы выполняются по одному.
+    """
+    for request in requests:
+        if isinstance(request, InsertOne):
+            self.insert_one(request._doc)
+        elif isinstance(request, UpdateOne):
+            self.update_one(request._filter, request._doc, upsert=bool(request._upsert))
+        elif isinstance(request, UpdateMany):
+            self.update_many(request._filter, request._doc, upsert=bool(request._upsert))
+        elif isinstance(request, ReplaceOne):
+            self.replace_one(request._filter, request._doc, upsert=bool(request._upsert))
+        elif isinstance(request, DeleteOne):
+            self.delete_one(request._filter)
+        elif isinstance(request, DeleteMany):
+            self.delete_many(request._filter)
+        else:
+            raise TypeError(f"Unsupported bulk request: {request!r}")
+    return BulkWriteResult({}, True)
+
+
+mongomock.collection.Collection.bulk_write = _bulk_write
+
+from source import meme_manager  # noqa: E402
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """MongoManager meme_manager над пустой базой mongomock"""
+    mongo_manager.close_clients()
+    mongo_manager._INDEXES_READY.clear()
+    manager = meme_manager.mongo
+    manager._base_cache = None
+    manager._order_cache = None
+    manager._tag_pool_cache = {}
+    manager._id_snapshot_cache = {}
+    manager.ensure_indexes()
+    monkeypatch.setattr(image_cache, "_CACHE", None)
+    monkeypatch.setattr(meme_manager, "DEGRADED_MODE", False)
+    monkeypatch.setattr(meme_manager, "ORDER_MODE", "array")
+    monkeypatch.setattr(meme_manager, "PER_CHAT_ROTATION", False)
+    monkeypatch.setattr(meme_manager, "SELECTION_STRATEGY", "shuffle")
+    yield manager
+
+
+@pytest.fixture
+def add_memes(mongo):
+    """add_memes(n, tags=None) -> ID новых мемов (картинки с сигнатурой PNG, все разные)"""
+    counter = iter(range(10 ** 9))
+
+    def add(count, tags=None):
+        return [
+            mongo.add_meme_base64(
+                base64.b64encode(b"\x89PNG\r\n\x1a\n" + str(next(counter)).encode() + b"IEND").decode(),
+                uploader="test", tags=tags,
+            )
+            for _ in range(count)
+        ]
+
+    return add
@@ -0,0 +1,81 @@
+# add_memes_batch: дедупликация по sha256 (библиотека, сама пачка, гонка с другим импортом)
+
+import mongomock
+import pytest
+from pymongo.errors import BulkWriteError
+
+from source.mongo_manager import content_hash
+
+
+def png(marker):
+    return b"\x89PNG\r\n\x1a\n" + marker + b"IEND"
+
+
+def test_new_images_are_added_with_metadata(mongo):
+    new_ids, duplicates = mongo.add_memes_batch([png(b"a"), png(b"b")], uploader="import")
+
+    assert duplicates == 0
+    assert len(new_ids) == 2
+    doc = mongo.memes.find_one({"_id": new_ids[0]})
+    assert (doc["hash"], doc["format"], doc["uploader"], doc["unique_hash"]) == (
+        content_hash(png(b"a")), "png", "import", True,
+    )
+    assert sorted(mongo.get_meme_order()) == sorted(new_ids)
+
+
+def test_duplicates_inside_one_batch(mongo):
+    new_ids, duplicates = mongo.add_memes_batch([png(b"a"), png(b"b"), png(b"a"), png(b"a")])
+
+    assert (len(new_ids), duplicates) == (2, 2)
+    assert mongo.memes.count_documents({}) == 2
+
+
+def test_duplicates_of_library(mongo):
+    first, _ = mongo.add_memes_batch([png(b"a"), png(b"b")])
+
+    new_ids, duplicates = mongo.add_memes_batch([png(b"b"), png(b"c"), png(b"a")])
+
+    assert duplicates == 2
+    assert len(new_ids) == 1 and new_ids[0] not in first
+    assert mongo.memes.count_documents({}) == 3
+
+
+def test_all_duplicates_allocate_nothing(mongo):
+    mongo.add_memes_batch([png(b"a")])
+    state = mongo.get_bot_state()
+
+    assert mongo.add_memes_batch([png(b"a"), png(b"a")]) == ([], 2)
+    assert mongo.get_bot_state().get("ORDER_SIZE") == state.get("ORDER_SIZE")
+
+
+def test_race_with_other_import_counts_as_duplicate(mongo, monkeypatch):
+    allocate = mongo.allocate_meme_ids
+
+    def allocate_after_rival(count):
+        # Другой импорт вставил ту же картинку после предварительной проверки
+        rival = allocate(1)
+        mongo.memes.insert_one({"_id": rival, "hash": content_hash(png(b"b")), "unique_hash": True})
+        return allocate(count)
+
+    monkeypatch.setattr(mongo, "allocate_meme_ids", allocate_after_rival)
+
+    new_ids, duplicates = mongo.add_memes_batch([png(b"a"), png(b"b"), png(b"c")])
+
+    assert duplicates == 1
+    assert len(new_ids) == 2
+    assert mongo.memes.count_documents({"hash": content_hash(png(b"b"))}) == 1
+    # В порядок попали только реально вставленные
+    assert sorted(mongo.get_meme_order()) == sorted(new_ids)
+
+
+def test_other_write_errors_are_raised(mongo, monkeypatch):
+    def insert_many(self, documents, ordered=True, **kwargs):
+        raise BulkWriteError({"writeErrors": [
+            {"index": 0, "code": 11000, "errmsg": "duplicate key"},
+            {"index": 1, "code": 121, "errmsg": "Document failed validation"},
+        ]})
+
+    monkeypatch.setattr(mongomock.collection.Collection, "insert_many", insert_many)
+
+    with pytest.raises(BulkWriteError):
+        mongo.add_memes_batch([png(b"a"), png(b"b")])
@@ -0,0 +1,84 @@
+# Ротация на каждый чат: без повторов внутри цикла, чаты не мешают друг другу
+
+import pytest
+
+from source import meme_manager
+
+
+@pytest.fixture
+def per_chat(monkeypatch):
+    monkeypatch.setattr(meme_manager, "PER_CHAT_ROTATION", True)
+
+
+def serve(chat_id, count):
+    return [meme_manager.next_meme(chat_id)[1] for _ in range(count)]
+
+
+def test_each_chat_sees_every_meme_once(mongo, add_memes, per_chat):
+    ids = add_memes(15)
+
+    first = serve(101, 15)
+    second = serve(-202, 15)
+
+    assert sorted(first) == sorted(ids)
+    assert sorted(second) == sorted(ids)
+
+
+def test_chats_advance_independently(mongo, add_memes, per_chat):
+    ids = add_memes(10)
+
+    head = serve(1, 4)
+    serve(2, 10)
+    tail = serve(1, 6)
+
+    assert sorted(head + tail) == sorted(ids)
+
+
+def test_new_cycle_after_exhaustion(mongo, add_memes, per_chat):
+    ids = add_memes(6)
+    serve(7, 6)
+    added = add_memes(2)
+
+    # Новый цикл начинается над текущим диапазоном _id
+    assert sorted(serve(7, 8)) == sorted(ids + added)
+
+
+def test_deleted_memes_are_skipped(mongo, add_memes, per_chat):
+    ids = add_memes(10)
+    head = serve(5, 3)
+    gone = [meme_id for meme_id in ids if meme_id not in head][:2]
+    mongo.delete_memes(gone)
+
+    tail = serve(5, 5)
+
+    assert len(set(head + tail)) == 8
+    assert not set(tail) & set(gone)
+
+
+def test_sparse_ids_do_not_exhaust_skips(mongo, add_memes, per_chat):
+    # Дыры в _id больше SEEDED_MAX_SKIPS: перестановка идёт по рангам снимка, а не по _id
+    ids = add_memes(120)
+    mongo.delete_memes(ids[:100])
+
+    assert sorted(serve(3, 20)) == sorted(ids[100:])
+
+
+def test_mass_delete_mid_cycle(mongo, add_memes, per_chat):
+    ids = add_memes(100)
+    head = serve(4, 10)
+    alive = [meme_id for meme_id in ids if meme_id not in head][:5]
+    mongo.soft_delete_memes([meme_id for meme_id in ids if meme_id not in head + alive])
+
+    # Больше SEEDED_MAX_SKIPS промахов подряд не обрывают выдачу
+    assert sorted(serve(4, 5)) == sorted(alive)
+    assert None not in serve(4, 15)
+
+
+def test_chats_share_the_id_snapshot(mongo, add_memes, per_chat):
+    add_memes(5)
+    serve(1, 1)
+    serve(2, 1)
+    assert mongo.id_snapshots.count_documents({}) == 1
+    add_memes(1)
+    serve(3, 1)
+    assert mongo.id_snapshots.count_documents({}) == 2
@@ -0,0 +1,139 @@
+# API галереи панели: keyset-пагинация по всем сортировкам (включая мемы без поля),
+# поиск по распознанному тексту со смещением и потоковая отдача картинок
+
+import base64
+import datetime
+
+import pytest
+
+import control_panel_ui
+from source.image_cache import get_image_cache
+
+BASE = datetime.datetime(2026, 1, 10, 12, 0)
+
+
+@pytest.fixture
+def client(mongo, monkeypatch):
+    monkeypatch.setattr(control_panel_ui, "THUMBNAILS_PER_PAGE", 3)
+    return control_panel_ui.app.test_client()
+
+
+@pytest.fixture
+def memes(mongo):
+    # Совпадающие created_at/size (граница страницы внутри группы) и мемы без полей
+    docs = [
+        {"_id": 1, "created_at": BASE, "size": 300, "uploader": "a"},
+        {"_id": 2, "created_at": BASE, "size": 100, "uploader": "b"},
+        {"_id": 3, "created_at": BASE + datetime.timedelta(hours=1), "size": 100, "uploader": "a"},
+        {"_id": 4, "uploader": "a"},
+        {"_id": 5, "created_at": BASE, "size": 300, "uploader": "a"},
+        {"_id": 6, "uploader": "b"},
+        {"_id": 7, "created_at": BASE - datetime.timedelta(hours=1), "size": 50, "uploader": "a"},
+        {"_id": 8, "created_at": BASE, "size": 300, "deleted": True},
+    ]
+    mongo.memes.insert_many(docs)
+    return docs
+
+
+def pages(client, **params):
+    """Все страницы подряд: [[ID страницы]], проверяя, что next есть у всех, кроме последней"""
+    result, after = [], None
+    while True:
+        query = dict(params, **({"after": after} if after else {}))
+        response = client.get("/api/images", query_string=query)
+        assert response.status_code == 200
+        body = response.get_json()
+        result.append([image["id"] for image in body["images"]])
+        assert body["has_more"] == (body["next"] is not None)
+        after = body["next"]
+        if after is None:
+            return result
+        assert len(result) < 10
+
+
+@pytest.mark.parametrize("sort, expected", [
+    ("id", [1, 2, 3, 4, 5, 6, 7]),
+    # по убыванию мемы без created_at идут последними
+    ("new", [3, 5, 2, 1, 7, 6, 4]),
+    # по возрастанию — первыми
+    ("old", [4, 6, 7, 1, 2, 5, 3]),
+    ("size", [5, 1, 3, 2, 7, 6, 4]),
+])
+def test_keyset_pages_cover_everything_once(client, memes, sort, expected):
+    result = pages(client, sort=sort)
+
+    assert [len(page) for page in result] == [3, 3, 1]
+    assert sum(result, []) == expected
+
+
+def test_exact_page_boundary(client, memes, mongo):
+    mongo.memes.delete_one({"_id": 7})
+
+    # Ровно две полные страницы: у второй next уже нет, пустой третьей не бывает
+    assert pages(client, sort="id") == [[1, 2, 3], [4, 5, 6]]
+    assert pages(client, sort="new") == [[3, 5, 2], [1, 6, 4]]
+
+
+def test_filters_and_trash(client, memes):
+    assert sum(pages(client, sort="new", uploader="a"), []) == [3, 5, 1, 7, 4]
+    assert sum(pages(client, sort="size", min_size=100), []) == [5, 1, 3, 2]
+    assert pages(client, sort="id", deleted="1") == [[8]]
+
+
+def test_bad_requests(client, memes):
+    assert client.get("/api/images", query_string={"sort": "random"}).status_code == 400
+    assert client.get("/api/images", query_string={"sort": "new", "after": "yesterday|x"}).status_code == 400
+    assert client.get("/api/images", query_string={"q": "кот", "after": "x"}).status_code == 400
+
+
+def test_search_pages_by_offset(client, mongo, monkeypatch):
+    found = [{"_id": meme_id, "ocr_text": "кот"} for meme_id in (9, 4, 7, 1)]
+    calls = []
+
+    def search_memes(text, limit=20, skip=0, deleted=False):
+        # mongomock не поддерживает $text: поиск подменён, проверяется разбор ответа
+        calls.append((text, skip, deleted))
+        return found[skip:skip + limit], skip + limit < len(found)
+
+    monkeypatch.setattr(control_panel_ui.mongo, "search_memes", search_memes)
+
+    result = pages(client, q=" кот ", sort="old", uploader="ignored")
+
+    assert result == [[9, 4, 7], [1]]
+    assert calls == [("кот", 0, False), ("кот", 3, False)]
+
+
+def test_image_is_streamed_in_aligned_chunks(client, mongo, monkeypatch):
+    image = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 3 + b"IEND"
+    mongo.memes.insert_one({"_id": 1, "image": base64.b64encode(image).decode(), "rev": 2})
+    monkeypatch.setattr(control_panel_ui, "IMAGE_STREAM_CHUNK", 100)
+    decoded = []
+    decode = control_panel_ui.base64.b64decode
+    monkeypatch.setattr(control_panel_ui.base64, "b64decode", lambda s: decoded.append(len(s)) or decode(s))
+
+    response = client.get("/memes/1")
+
+    assert response.status_code == 200
+    assert response.data == image
+    assert response.headers["Content-Length"] == str(len(image))
+    assert response.mimetype == "image/png"
+    # Заголовок (16 символов) и куски по 132 символа — ни одного декодирования целиком
+    assert max(decoded) == 132 and len(decoded) > 5
+    assert get_image_cache().get(1, rev=2) == image
+
+    # Повтор — из кеша, по ETag — 304 без картинки
+    assert client.get("/memes/1").data == image
+    assert client.get("/memes/1", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+
+def test_image_with_newlines_in_base64(client, mongo, monkeypatch):
+    image = b"\xff\xd8\xff\xe0" + bytes(range(200)) + b"\xff\xd9"
+    encoded = base64.encodebytes(image).decode()
+    mongo.memes.insert_one({"_id": 1, "image": encoded})
+    monkeypatch.setattr(control_panel_ui, "IMAGE_STREAM_CHUNK", 30)
+
+    response = client.get("/memes/1")
+
+    assert response.data == image
+    assert response.headers["Content-Length"] == str(len(image))
+    assert client.get("/memes/2").status_code == 404
@@ -0,0 +1,111 @@
+# CircuitBreaker: размыкание, пробный вызов, вложенные блоки
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+from source import degraded
+from source.degraded import CircuitBreaker, DataLayerUnavailable
+
+
+def fail(breaker):
+    with pytest.raises(DataLayerUnavailable):
+        with breaker.guard():
+            raise AutoReconnect("down")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(degraded.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_opens_after_threshold_and_rejects(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    fail(breaker)
+    assert breaker.closed
+    fail(breaker)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(DataLayerUnavailable):
+        breaker.call(lambda: "never")
+    assert breaker.stats == {"failures": 2, "rejected": 1, "opened": 1}
+
+
+def test_half_open_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    fail(breaker)
+    clock[0] += 10
+
+    # Неудачный пробный вызов снова размыкает цепь
+    fail(breaker)
+    assert breaker.state == CircuitBreaker.OPEN
+    clock[0] += 10
+
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.closed
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker(failure_threshold=2)
+    fail(breaker)
+    breaker.call(lambda: None)
+    fail(breaker)
+
+    assert breaker.closed
+
+
+def test_non_data_error_does_not_close_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    fail(breaker)
+    clock[0] += 10
+
+    with pytest.raises(ValueError):
+        with breaker.guard():
+            raise ValueError("handler bug")
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Пробный вызов освобождён: следующий блок может проверить Mongo
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.closed
+
+
+def test_nested_failure_does_not_close_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    fail(breaker)
+    clock[0] += 10
+
+    with pytest.raises(DataLayerUnavailable):
+        with breaker.guard():
+            with breaker.guard():
+                raise AutoReconnect("still down")
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.stats["failures"] == 2
+
+
+def test_swallowed_nested_failure_does_not_close_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    fail(breaker)
+
+    with breaker.guard():
+        with pytest.raises(DataLayerUnavailable):
+            with breaker.guard():
+                raise AutoReconnect("flaky")
+
+    # Внешний блок завершился, но ошибки не обнулены: цепь не «выздоровела»
+    assert breaker._failures == 2
+    fail(breaker)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_nested_block_does_not_take_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    fail(breaker)
+    clock[0] += 10
+
+    with breaker.guard():
+        with breaker.guard():
+            pass
+
+    assert breaker.closed
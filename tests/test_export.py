@@ -0,0 +1,81 @@
+# Инкрементальный экспорт: отметка по времени, а не по наибольшему _id
+
+import base64
+import datetime
+import io
+import json
+import zipfile
+
+import pytest
+
+from source import meme_manager
+from source.mongo_manager import content_hash
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def insert_meme(mongo, meme_id, created_at, marker):
+    data = b"\x89PNG\r\n\x1a\n" + marker + b"IEND"
+    mongo.memes.insert_one({
+        "_id": meme_id, "image": base64.b64encode(data).decode(), "created_at": created_at,
+        "hash": content_hash(data),
+    })
+
+
+def export(watermark=None):
+    zip_path, new_watermark, manifest = meme_manager.create_memes_zip_from_db_stream(watermark)
+    with zipfile.ZipFile(zip_path) as archive:
+        names = sorted(name for name in archive.namelist() if name != "manifest.json")
+        assert json.loads(archive.read("manifest.json")) == json.loads(json.dumps(manifest))
+    return names, new_watermark, manifest
+
+
+def test_late_commit_of_lower_id_is_exported_next_time(mongo, workdir):
+    now = datetime.datetime.utcnow()
+    insert_meme(mongo, 1, now - datetime.timedelta(hours=1), b"old")
+    _, watermark, _ = export()
+
+    # _id 2 и 3 выданы одновременно; 3 записан до следующего экспорта, 2 — после
+    insert_meme(mongo, 3, datetime.datetime.utcnow(), b"three")
+    names, watermark, manifest = export(watermark)
+    assert names == ["0003.jpg"]
+    insert_meme(mongo, 2, watermark["at"] - datetime.timedelta(seconds=1), b"two")
+
+    names, _, manifest = export(watermark)
+
+    assert "0002.jpg" in names
+    assert "0001.jpg" not in names
+    assert manifest["type"] == "incremental"
+
+
+def test_incremental_lists_restored_and_deleted(mongo, add_memes, workdir):
+    ids = add_memes(3)
+    mongo.soft_delete_memes([ids[0]])
+    hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    mongo.memes.update_many({}, {"$set": {"created_at": hour_ago}})
+    mongo.meme_tombstones.update_many({}, {"$set": {"deleted_at": hour_ago}})
+    watermark = {"at": hour_ago + datetime.timedelta(minutes=1) + meme_manager.EXPORT_OVERLAP}
+
+    mongo.restore_memes([ids[0]])
+    mongo.delete_memes([ids[1]])
+    names, _, manifest = export(watermark)
+
+    assert names == [f"{ids[0]:04d}.jpg"]
+    assert manifest["restored"] == [ids[0]]
+    assert [item["id"] for item in manifest["deleted"]] == [ids[1]]
+
+
+def test_overlap_duplicates_are_skipped_on_import(mongo, add_memes, workdir):
+    add_memes(2)
+    zip_path, _, _ = meme_manager.create_memes_zip_from_db_stream()
+    with open(zip_path, "rb") as f:
+        archive = io.BytesIO(f.read())
+
+    stats = list(meme_manager.import_memes_zip(archive))[-1]
+
+    assert stats["added"] == 0 and stats["duplicates"] == 2
+    assert mongo.count_memes() == 2
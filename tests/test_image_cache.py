@@ -0,0 +1,136 @@
+# Кеш картинок: LRU в памяти с бюджетом в байтах и общий для процессов дисковый уровень
+
+import os
+
+from source import image_cache
+from source.image_cache import ImageCache
+
+
+def blob(size, fill=b"x"):
+    return fill * size
+
+
+def test_lru_evicts_least_recently_used():
+    cache = ImageCache(max_bytes=30)
+    cache.put(1, 0, blob(10))
+    cache.put(2, 0, blob(10))
+    cache.put(3, 0, blob(10))
+    # 1 использован недавно — вытесняется 2
+    assert cache.get(1) == blob(10)
+    cache.put(4, 0, blob(10))
+
+    assert cache.get(2) is None
+    assert [cache.get(meme_id) is not None for meme_id in (1, 3, 4)] == [True, True, True]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_byte_budget():
+    cache = ImageCache(max_bytes=100)
+    for meme_id in range(5):
+        cache.put(meme_id, 0, blob(30))
+
+    stats = cache.stats()
+    assert stats["bytes"] == 90 and stats["entries"] == 3
+    # Одна большая картинка вытесняет несколько мелких
+    cache.put(9, 0, blob(80))
+    assert cache.stats()["bytes"] == 80
+    assert cache.get(9) is not None and cache.get(4) is None
+
+
+def test_oversized_image_is_not_kept_in_memory():
+    cache = ImageCache(max_bytes=10)
+    cache.put(1, 0, blob(5))
+    cache.put(2, 0, blob(11))
+
+    assert cache.get(2) is None
+    assert cache.get(1) == blob(5)
+
+
+def test_overwrite_and_revisions():
+    cache = ImageCache(max_bytes=100)
+    cache.put(1, 0, blob(40))
+    cache.put(1, 1, blob(20, b"y"))
+
+    assert cache.stats()["bytes"] == 20
+    # Старая ревизия не отдаётся
+    assert cache.get(1, rev=0) is None
+    assert cache.get(1, rev=1) == blob(20, b"y")
+
+
+def test_stats_hit_ratio():
+    cache = ImageCache(max_bytes=100)
+    cache.put(1, 0, blob(1))
+    cache.get(1)
+    cache.get(1)
+    cache.get(2)
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_ratio"]) == (2, 1, 0.667)
+
+
+def test_disk_tier_is_shared_between_processes(tmp_path):
+    writer = ImageCache(max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    writer.put(7, 3, blob(50))
+
+    # Другой процесс (свой кеш в памяти) берёт картинку с диска и поднимает её в память
+    reader = ImageCache(max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    assert reader.get(7, rev=3) == blob(50)
+    assert reader.get(7, rev=3) == blob(50)
+    assert (reader.stats()["disk_hits"], reader.stats()["hits"]) == (1, 1)
+    assert reader.get(7, rev=2) is None
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_disk_tier_keeps_images_evicted_from_memory(tmp_path):
+    cache = ImageCache(max_bytes=20, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    cache.put(1, 0, blob(15))
+    cache.put(2, 0, blob(15))
+
+    assert cache.get(1) == blob(15)
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_invalidate_drops_memory_and_disk(tmp_path):
+    cache = ImageCache(max_bytes=100, disk_dir=str(tmp_path), disk_max_bytes=1000)
+    cache.put(5, 0, blob(10))
+    cache.put(5, 1, blob(10))
+    cache.put(6, 0, blob(10))
+
+    cache.invalidate(5)
+
+    assert cache.get(5, rev=1) is None
+    assert sorted(os.listdir(tmp_path)) == ["6-0.img"]
+
+
+def test_disk_budget_evicts_least_recently_used_files(tmp_path, monkeypatch):
+    cache = ImageCache(max_bytes=1000, disk_dir=str(tmp_path), disk_max_bytes=100)
+    for meme_id in range(4):
+        cache.put(meme_id, 0, blob(25))
+        # Давность использования — по mtime: 0 самый старый
+        os.utime(tmp_path / f"{meme_id}-0.img", (1000 + meme_id, 1000 + meme_id))
+    assert len(os.listdir(tmp_path)) == 4
+
+    # Картинка больше дискового бюджета на диск не пишется
+    cache.put(8, 0, blob(101))
+    assert not (tmp_path / "8-0.img").exists()
+
+    cache.put(9, 0, blob(25))
+
+    # Бюджет превышен: освобождается до 80% — самые давние файлы
+    assert sorted(os.listdir(tmp_path)) == ["2-0.img", "3-0.img", "9-0.img"]
+
+
+def test_disk_is_rescanned_for_files_of_other_processes(tmp_path, monkeypatch):
+    cache = ImageCache(max_bytes=1000, disk_dir=str(tmp_path), disk_max_bytes=100)
+    cache.put(1, 0, blob(10))
+    # Другой процесс заполнил каталог; пока оценка свежая, каталог не сканируется
+    for meme_id in range(2, 12):
+        (tmp_path / f"{meme_id}-0.img").write_bytes(blob(10))
+        os.utime(tmp_path / f"{meme_id}-0.img", (1000 + meme_id, 1000 + meme_id))
+    cache.put(20, 0, blob(1))
+    assert len(os.listdir(tmp_path)) == 12
+
+    monkeypatch.setattr(image_cache, "DISK_RESCAN_SECONDS", 0)
+    cache.put(21, 0, blob(1))
+
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 80
@@ -0,0 +1,114 @@
+# Проверка целостности картинок: разбор одной картинки и проход по библиотеке
+
+import base64
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from source import image_integrity
+from source.image_integrity import check_trailer, repair_base64, split_ranges, verify_image
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32 + b"IEND\xaeB`\x82"
+JPEG = b"\xff\xd8\xff\xe0" + b"\x10" * 32 + b"\xff\xd9"
+GIF = b"GIF89a" + b"\x01" * 32 + b"\x3b"
+WEBP = b"RIFF" + (24).to_bytes(4, "little") + b"WEBP" + b"\x02" * 20
+
+
+def b64(data):
+    return base64.b64encode(data).decode()
+
+
+@pytest.mark.parametrize("image_format, data", [("png", PNG), ("jpeg", JPEG), ("gif", GIF), ("webp", WEBP)])
+def test_check_trailer_accepts_whole_files(image_format, data):
+    assert check_trailer(image_format, data)
+    # Нули после конца файла не считаются обрезкой
+    assert check_trailer(image_format, data + b"\x00" * 8)
+
+
+@pytest.mark.parametrize("image_format, data", [("png", PNG), ("jpeg", JPEG), ("gif", GIF), ("webp", WEBP)])
+def test_check_trailer_rejects_truncated_files(image_format, data):
+    assert not check_trailer(image_format, data[:-6])
+
+
+def test_check_trailer_unknown_format():
+    assert not check_trailer(None, PNG)
+
+
+@pytest.mark.parametrize("broken", [
+    # переводы строк, как в MIME
+    "\n".join(b64(PNG)[i:i + 16] for i in range(0, len(b64(PNG)), 16)),
+    # потерянный паддинг
+    b64(PNG).rstrip("="),
+    # urlsafe алфавит
+    base64.urlsafe_b64encode(PNG).decode(),
+])
+def test_repair_base64(broken):
+    assert repair_base64(broken) == PNG
+
+
+def test_repair_base64_gives_up_on_garbage():
+    with pytest.raises(ValueError):
+        repair_base64("not*base64!")
+
+
+def test_verify_image_statuses():
+    assert verify_image(b64(JPEG)) == ("ok", None, None)
+    assert verify_image(" " + b64(JPEG)) == ("repaired", "base64 normalized", b64(JPEG))
+    assert verify_image("") == ("corrupt", "empty image", None)
+    assert verify_image(None)[0] == "corrupt"
+    assert verify_image(b64(b"plain text, not an image"))[1] == "unknown image signature"
+    assert verify_image(b64(JPEG[:-2]))[1] == "truncated jpeg"
+    assert verify_image("$$$$")[1].startswith("base64")
+
+
+def test_split_ranges():
+    assert split_ranges(-1, [0, 1, 5, 7, 9], 2) == [(-1, 1), (1, 7), (7, 9)]
+    assert split_ranges(3, [4], 200) == [(3, 4)]
+
+
+def insert_memes(mongo, images):
+    for meme_id, image in enumerate(images):
+        mongo.memes.insert_one({"_id": meme_id, "image": image})
+
+
+@pytest.fixture
+def workers(monkeypatch, request):
+    """Пул процессов подменяется потоками: mongomock живёт только в этом процессе"""
+    count = getattr(request, "param", 2)
+    image_integrity.configure({"workers": count})
+    pool = ThreadPoolExecutor(count)
+    monkeypatch.setattr(image_integrity, "get_pool", lambda: pool)
+    yield count
+    pool.shutdown()
+    image_integrity.configure()
+
+
+@pytest.mark.parametrize("workers", [1, 3], indirect=True)
+def test_verify_library_repairs_and_quarantines(mongo, workers):
+    images = [b64(PNG)] * 10
+    images[2] = b64(PNG) + "\n"
+    images[5] = b64(PNG[:-8])
+    images[8] = b64(b"GIF89a")
+    insert_memes(mongo, images)
+
+    report = image_integrity.verify_library(batch_size=2)
+
+    assert (report["checked"], report["ok"], report["repaired"], report["quarantined"]) == (10, 7, 1, 2)
+    assert mongo.memes.find_one({"_id": 2})["image"] == b64(PNG)
+    assert {doc["_id"]: doc["quarantine_reason"] for doc in mongo.memes.find({"deleted": True})} == {
+        5: "truncated png", 8: "truncated gif",
+    }
+    assert mongo.get_verify_state()["last_id"] == 9
+
+
+def test_verify_library_resumes_from_saved_position(mongo, workers):
+    insert_memes(mongo, [b64(PNG)] * 7)
+
+    first = image_integrity.verify_library(batch_size=2, limit=3)
+    assert first["checked"] == 3 and mongo.get_verify_state()["last_id"] == 2
+
+    rest = image_integrity.verify_library(batch_size=2)
+    assert rest["checked"] == 4
+    # Библиотека пройдена: следующий проход видит только новые мемы
+    assert image_integrity.verify_library()["checked"] == 0
+    assert image_integrity.verify_library(restart=True)["checked"] == 7
@@ -0,0 +1,59 @@
+# Мем дня: сутки и срок записи user_memes — в UTC или в заданном часовом поясе
+
+import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+from source import meme_manager
+from source.mongo_manager import day_end
+
+UTC = datetime.timezone.utc
+
+
+@pytest.mark.parametrize("date, tz, expected", [
+    ("2026-03-10", UTC, datetime.datetime(2026, 3, 11, 0, 0, tzinfo=UTC)),
+    ("2026-03-10", ZoneInfo("Europe/Moscow"), datetime.datetime(2026, 3, 10, 21, 0, tzinfo=UTC)),
+    # Переход на летнее время: сутки короче, полночь — уже по EDT
+    ("2026-03-08", ZoneInfo("America/New_York"), datetime.datetime(2026, 3, 9, 4, 0, tzinfo=UTC)),
+    ("2026-12-31", ZoneInfo("America/New_York"), datetime.datetime(2027, 1, 1, 5, 0, tzinfo=UTC)),
+])
+def test_day_end_is_aware_utc(date, tz, expected):
+    end = day_end(date, tz)
+
+    assert end == expected
+    assert end.utcoffset() == datetime.timedelta(0)
+
+
+def test_today_follows_configured_timezone(monkeypatch):
+    monkeypatch.setattr(meme_manager, "DAY_TIMEZONE", UTC)
+    meme_manager.set_day_timezone("Pacific/Kiritimati")
+    try:
+        assert meme_manager.today() == datetime.datetime.now(ZoneInfo("Pacific/Kiritimati")).date().isoformat()
+    finally:
+        meme_manager.set_day_timezone("UTC")
+    assert meme_manager.DAY_TIMEZONE is UTC
+
+
+def test_user_meme_expires_at_local_midnight(mongo, add_memes, monkeypatch):
+    add_memes(3)
+    monkeypatch.setattr(meme_manager, "DAY_TIMEZONE", ZoneInfo("Asia/Tokyo"))
+
+    first = meme_manager.get_user_meme_of_the_day(42)
+    doc = mongo.get_user_meme(42)
+
+    assert doc["date"] == datetime.datetime.now(ZoneInfo("Asia/Tokyo")).date().isoformat()
+    # Mongo хранит UTC: полночь по Токио — 15:00 UTC накануне
+    expires_at = doc["expires_at"].replace(tzinfo=doc["expires_at"].tzinfo or UTC)
+    assert expires_at == day_end(doc["date"], ZoneInfo("Asia/Tokyo"))
+    assert expires_at.astimezone(UTC).hour == 15
+    # В те же сутки — тот же мем
+    assert meme_manager.get_user_meme_of_the_day(42).getvalue() == first.getvalue()
+
+
+def test_bulk_default_is_utc_midnight(mongo):
+    # Дата в будущем: прошедшие записи сразу удаляет TTL-индекс
+    mongo.set_user_memes_bulk({1: 10, 2: 11}, "2099-05-01")
+
+    expires_at = mongo.get_user_meme(2)["expires_at"]
+    assert expires_at.replace(tzinfo=expires_at.tzinfo or UTC) == datetime.datetime(2099, 5, 2, tzinfo=UTC)
@@ -0,0 +1,174 @@
+# MEME_ORDER: точечные правки при добавлении/удалении мемов (без пересборки)
+
+from source import meme_manager
+from source import mongo_manager
+
+
+def draw_cycle(mongo, limit=10_000):
+    """ID до конца текущего цикла (advance_meme_index без перемешивания)"""
+    served = []
+    for _ in range(limit):
+        meme_id = mongo.advance_meme_index()
+        if meme_id is None:
+            return served
+        served.append(meme_id)
+    raise AssertionError("cycle did not end")
+
+
+def test_full_cycle_serves_each_meme_once(mongo, add_memes):
+    ids = add_memes(25)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+
+    served = draw_cycle(mongo)
+
+    assert sorted(served) == sorted(ids)
+
+
+def test_no_repeat_across_insert_and_delete(mongo, add_memes):
+    ids = add_memes(20)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+    before = [mongo.advance_meme_index() for _ in range(8)]
+
+    added = add_memes(6)
+    unseen = [meme_id for meme_id in ids if meme_id not in before]
+    deleted = [before[0], before[1], unseen[0], unseen[1]]
+    mongo.delete_memes(deleted)
+    after = draw_cycle(mongo)
+
+    served = before + after
+    assert len(served) == len(set(served)), "meme repeated within a cycle"
+    assert not set(after) & set(deleted)
+    assert set(served) == (set(ids) | set(added)) - {unseen[0], unseen[1]}
+    # Курсор сдвинут на число удалённых слева: сверка не видит расхождения
+    assert meme_manager.check_meme_order_consistency() is False
+
+
+def test_soft_delete_keeps_counts_in_sync(mongo, add_memes):
+    ids = add_memes(10)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+
+    mongo.soft_delete_memes(ids[:3])
+    assert meme_manager.check_meme_order_consistency() is False
+    assert not set(draw_cycle(mongo)) & set(ids[:3])
+
+
+def test_next_cycle_reshuffles(mongo, add_memes):
+    ids = add_memes(5)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+    draw_cycle(mongo)
+
+    second = [meme_manager.next_meme_id_from_order() for _ in range(len(ids))]
+
+    assert sorted(second) == sorted(ids)
+
+
+def test_insert_writes_patch_not_whole_order(mongo, add_memes):
+    ids = add_memes(10)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+    version = mongo.get_bot_state()["ORDER_VERSION"]
+
+    added = add_memes(3)
+
+    state = mongo.get_bot_state()
+    assert state["ORDER_VERSION"] == version
+    assert state["ORDER_PATCH_SEQ"] == 3
+    assert sorted(draw_cycle(mongo)) == sorted(ids + added)
+
+
+def test_serving_does_not_invalidate_concurrent_insert(mongo, add_memes, monkeypatch):
+    add_memes(10)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+    stale = mongo.get_bot_state()
+    served = [mongo.advance_meme_index() for _ in range(3)]
+    writes = []
+    update_one = type(mongo.bot_state).update_one
+
+    def counting_update(collection, *args, **kwargs):
+        writes.append(args[0])
+        return update_one(collection, *args, **kwargs)
+
+    # Вставка прочитала состояние до того, как выдача сдвинула курсор
+    monkeypatch.setattr(mongo, "get_bot_state", lambda: stale)
+    monkeypatch.setattr(type(mongo.bot_state), "update_one", counting_update)
+    # Позиция правее курсора: выдача до неё не дошла, условие записи выполняется
+    monkeypatch.setattr(mongo_manager.random, "randint", lambda low, high: high - 1)
+    new_id = mongo.allocate_meme_ids(1)
+    assert mongo.insert_into_meme_order([new_id])
+    monkeypatch.undo()
+
+    assert len(writes) == 1
+    rest = draw_cycle(mongo)
+    assert new_id in rest
+    assert len(set(served + rest)) == len(served + rest) == 11
+
+
+def test_delete_leaves_holes_in_place(mongo, add_memes):
+    ids = add_memes(10)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+    head = [mongo.advance_meme_index() for _ in range(4)]
+    order_before = mongo.get_meme_order().tolist()
+
+    mongo.delete_memes([head[0], order_before[6], order_before[7]])
+
+    state = mongo.get_bot_state()
+    order = mongo.get_meme_order(state).tolist()
+    assert state["MEME_INDEX"] == 4
+    assert [meme_id for meme_id in order if meme_id >= 0] == \
+        [meme_id for meme_id in order_before if meme_id not in (head[0], order_before[6], order_before[7])]
+    assert order[6] == order[7] == order[0] == -1
+    assert mongo.get_meme_order_summary()["order_size"] == 7
+    assert draw_cycle(mongo) == [order_before[4], order_before[5], order_before[8], order_before[9]]
+    assert mongo.get_bot_state()["MEME_INDEX"] == 10
+
+
+def test_patches_are_compacted(mongo, add_memes, monkeypatch):
+    monkeypatch.setattr(mongo_manager, "ORDER_PATCH_MAX_OPS", 3)
+    ids = add_memes(6)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+    head = [mongo.advance_meme_index() for _ in range(2)]
+    version = mongo.get_bot_state()["ORDER_VERSION"]
+
+    added = add_memes(2)
+    mongo.delete_memes([ids[0]])
+
+    state = mongo.bot_state.find_one({"_id": 0})
+    assert state["ORDER_VERSION"] != version
+    assert "ORDER_PATCH" not in state and state["ORDER_PATCH_SEQ"] == 0
+    assert state["MEME_INDEX"] == 2 and state["ORDER_HOLES"] == 1
+    served = head + draw_cycle(mongo)
+    assert len(served) == len(set(served))
+    assert set(served) == (set(ids) | set(added)) - ({ids[0]} - set(head))
+
+
+def test_other_process_sees_patches(mongo, add_memes):
+    other = mongo_manager.MongoManager()
+    ids = add_memes(5)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+    assert other.advance_meme_index() is not None
+
+    added = add_memes(2)
+
+    served = [other.advance_meme_index() for _ in range(6)]
+    assert set(added) <= set(served)
+    assert other.advance_meme_index() is None
+
+
+def test_end_of_cycle_reshuffles_once(mongo, add_memes):
+    add_memes(6)
+    meme_manager.shuffle_meme_order(admin_shuffle=True)
+    draw_cycle(mongo)
+    exhausted = mongo.get_bot_state()
+
+    # Первый процесс начал новый цикл и уже выдал два мема
+    assert meme_manager.start_order_cycle()
+    head = [mongo.advance_meme_index() for _ in range(2)]
+    version = mongo.get_bot_state()["ORDER_VERSION"]
+
+    # Второй видел исчерпанный цикл раньше: его перемешивание не проходит
+    assert meme_manager.shuffle_meme_order(admin_shuffle=True, observed=exhausted) is None
+    assert meme_manager.start_order_cycle()
+
+    state = mongo.get_bot_state()
+    assert state["ORDER_VERSION"] == version and state["MEME_INDEX"] == 2
+    served = head + draw_cycle(mongo)
+    assert len(served) == len(set(served)) == 6
@@ -0,0 +1,101 @@
+# Упакованный MEME_ORDER: int32 в Binary, куски, compare-and-set
+
+import numpy as np
+import pytest
+
+from source import mongo_manager
+from source.mongo_manager import decode_order, encode_order
+
+
+def test_encode_decode_roundtrip():
+    order = np.array([5, 0, 2 ** 31 - 1, 17], dtype=np.int32)
+
+    assert np.array_equal(decode_order(encode_order(order)), order)
+
+
+def test_decode_legacy_list_and_empty():
+    assert decode_order([3, 1, 2]).tolist() == [3, 1, 2]
+    assert len(decode_order(None)) == 0
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(mongo_manager, "ORDER_CHUNK_ENTRIES", 4)
+
+
+def test_chunked_order_roundtrip(mongo, small_chunks):
+    order = np.arange(10, dtype=np.int32)[::-1]
+    mongo.set_meme_order(order, meme_index=0, last_count=10)
+    mongo._base_cache = mongo._order_cache = None
+
+    assert mongo.get_meme_order().tolist() == order.tolist()
+    assert mongo.bot_state_chunks.count_documents({}) == 3
+
+
+def test_rewrite_drops_only_replaced_chunks(mongo, small_chunks):
+    mongo.set_meme_order(np.arange(10), meme_index=0)
+    first = mongo.get_bot_state()["ORDER_VERSION"]
+    mongo.set_meme_order(np.arange(9), meme_index=0)
+    second = mongo.get_bot_state()["ORDER_VERSION"]
+
+    assert mongo.bot_state_chunks.count_documents({"_id.v": first}) == 0
+    assert mongo.bot_state_chunks.count_documents({"_id.v": second}) == 3
+
+
+def test_cas_loser_keeps_winner_chunks(mongo, small_chunks):
+    mongo.set_meme_order(np.arange(10), meme_index=0)
+    stale = {"ORDER_VERSION": mongo.get_bot_state()["ORDER_VERSION"]}
+    assert mongo._write_order(np.arange(12), expected=stale)
+    winner = mongo.get_bot_state()["ORDER_VERSION"]
+
+    assert not mongo._write_order(np.arange(11), expected=stale)
+
+    assert mongo.bot_state_chunks.count_documents({}) == 3
+    assert mongo.bot_state_chunks.count_documents({"_id.v": winner}) == 3
+    mongo._base_cache = mongo._order_cache = None
+    assert mongo.get_meme_order().tolist() == list(range(12))
+
+
+def test_migrate_legacy_array(mongo):
+    mongo.bot_state.update_one({"_id": 0}, {"$set": {"MEME_ORDER": [4, 2, 9]}}, upsert=True)
+
+    mongo.migrate_meme_order()
+
+    doc = mongo.bot_state.find_one({"_id": 0})
+    assert not isinstance(doc["MEME_ORDER"], list)
+    mongo._base_cache = mongo._order_cache = None
+    assert mongo.get_meme_order().tolist() == [4, 2, 9]
+
+
+def test_patches_apply_over_chunked_order(mongo, small_chunks):
+    mongo.set_meme_order(np.arange(10), meme_index=8, last_count=10)
+    version = mongo.get_bot_state()["ORDER_VERSION"]
+
+    mongo.insert_into_meme_order([100])
+    mongo.remove_from_meme_order([9])
+
+    mongo._base_cache = mongo._order_cache = None
+    order = mongo.get_meme_order().tolist()
+    assert mongo.get_bot_state()["ORDER_VERSION"] == version
+    assert mongo.bot_state_chunks.count_documents({}) == 3
+    assert len(order) == 11 and 100 in order[8:] and -1 in order[8:]
+    assert order[:8] == list(range(8))
+
+
+def test_read_retries_when_chunks_are_replaced(mongo, small_chunks, monkeypatch):
+    mongo.set_meme_order(np.arange(10), meme_index=0)
+    mongo._base_cache = mongo._order_cache = None
+    read_chunks = mongo._read_order_chunks
+    calls = []
+
+    def replaced_once(version, chunks):
+        # Первое чтение попадает между записью новой версии и удалением кусков старой
+        if not calls:
+            calls.append(version)
+            mongo.set_meme_order(np.arange(9), meme_index=0)
+            mongo._base_cache = mongo._order_cache = None
+        return read_chunks(version, chunks)
+
+    monkeypatch.setattr(mongo, "_read_order_chunks", replaced_once)
+
+    assert mongo.get_meme_order().tolist() == list(range(9))
@@ -0,0 +1,47 @@
+# Перестановка Фейстеля с cycle-walking: биекция на [0, size)
+
+import pytest
+
+from source import meme_manager
+from source.permutation import FeistelPermutation, get_permutation
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 10, 16, 17, 100, 1000, 1023, 1025, 4097])
+def test_bijection(size):
+    perm = FeistelPermutation(size, seed=12345)
+
+    assert sorted(perm[i] for i in range(size)) == list(range(size))
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2 ** 62, -7, "text"])
+def test_bijection_for_any_seed(seed):
+    perm = FeistelPermutation(37, seed)
+
+    assert sorted(perm[i] for i in range(37)) == list(range(37))
+
+
+def test_seed_determines_order():
+    assert [get_permutation(50, 1)[i] for i in range(50)] == [FeistelPermutation(50, 1)[i] for i in range(50)]
+    assert [FeistelPermutation(50, 1)[i] for i in range(50)] != [FeistelPermutation(50, 2)[i] for i in range(50)]
+
+
+def test_bounds():
+    perm = FeistelPermutation(10, seed=3)
+
+    assert len(perm) == 10
+    with pytest.raises(IndexError):
+        perm[10]
+    with pytest.raises(IndexError):
+        perm[-1]
+    with pytest.raises(ValueError):
+        FeistelPermutation(0, seed=3)
+
+
+def test_seeded_cycle_skips_holes(mongo, add_memes, monkeypatch):
+    monkeypatch.setattr(meme_manager, "ORDER_MODE", "seeded")
+    ids = add_memes(12)
+    mongo.delete_memes(ids[3:6])
+
+    served = [meme_manager.next_meme()[1] for _ in range(9)]
+
+    assert sorted(served) == sorted(ids[:3] + ids[6:])
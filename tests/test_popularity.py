@@ -0,0 +1,137 @@
+# Популярность: таблицы Уолкера, блочный взвешенный выбор, буфер счётчиков
+
+import random
+from collections import Counter
+
+import pytest
+
+from source import meme_manager
+from source import popularity
+from source.popularity import AliasTable, PopularityCounters, WeightedSampler
+
+
+def frequencies(sample, draws=200_000):
+    counts = Counter(sample() for _ in range(draws))
+    return {key: count / draws for key, count in counts.items()}
+
+
+def test_alias_table_distribution():
+    weights = [1, 2, 3, 4, 0, 10]
+    table = AliasTable(weights)
+    rng = random.Random(1)
+
+    freq = frequencies(lambda: table.sample(rng))
+
+    assert 4 not in freq
+    for i, weight in enumerate(weights):
+        assert freq.get(i, 0.0) == pytest.approx(weight / sum(weights), abs=0.01)
+
+
+def test_alias_table_empty_and_uniform():
+    assert AliasTable([]).size == 0
+    assert AliasTable([0, 0]).total == 0
+    table = AliasTable([5] * 8)
+    assert table.prob.tolist() == [1.0] * 8
+
+
+@pytest.fixture
+def small_buckets(monkeypatch):
+    monkeypatch.setattr(popularity, "BUCKET_SIZE", 4)
+
+
+def test_sampler_distribution_across_buckets(small_buckets):
+    weights = {meme_id: 1.0 + meme_id % 5 for meme_id in range(1, 11)}
+    sampler = WeightedSampler()
+    sampler.update(weights)
+    rng = random.Random(2)
+
+    freq = frequencies(lambda: sampler.sample(rng))
+
+    total = sum(weights.values())
+    assert len(sampler._tables) == 3
+    for meme_id, weight in weights.items():
+        assert freq.get(meme_id, 0.0) == pytest.approx(weight / total, abs=0.01)
+
+
+def test_update_rebuilds_only_its_bucket(small_buckets):
+    sampler = WeightedSampler()
+    sampler.update({meme_id: 1.0 for meme_id in range(12)})
+    sampler.sample()
+    tables = list(sampler._tables)
+
+    sampler.update({5: 50.0})
+    sampler.sample()
+
+    assert sampler._tables[0] is tables[0]
+    assert sampler._tables[1] is not tables[1]
+    assert sampler._tables[2] is tables[2]
+    assert sampler._top.total == pytest.approx(61.0)
+
+
+def test_zero_weight_removes_meme(small_buckets):
+    sampler = WeightedSampler()
+    sampler.update({1: 1.0, 2: 1.0, 3: 1.0})
+    sampler.update({2: 0})
+    rng = random.Random(3)
+
+    assert {sampler.sample(rng) for _ in range(500)} == {1, 3}
+    assert len(sampler) == 2
+    sampler.update({1: 0, 3: 0})
+    assert sampler.sample() is None
+
+
+def test_replace_drops_old_slots(small_buckets):
+    sampler = WeightedSampler()
+    sampler.update({meme_id: 1.0 for meme_id in range(10)})
+
+    sampler.replace({42: 1.0})
+
+    assert sampler.sample() == 42
+    assert len(sampler._tables) == 1
+
+
+def test_meme_weight_depends_on_like_share():
+    assert popularity.meme_weight(2, 0) == popularity.meme_weight(6, 1)
+    assert popularity.meme_weight(10, 10) > popularity.meme_weight(10, 0)
+
+
+def test_counters_drain_restore_and_like_dedup():
+    counters = PopularityCounters()
+    counters.record_send(1)
+    counters.record_send(1)
+    assert counters.record_like(1, ("msg", 7))
+    assert not counters.record_like(1, ("msg", 7))
+    assert not counters.record_like(2, ("msg2", 7), counted=False)
+
+    pending = counters.drain()
+    assert pending == {1: (2, 1)}
+    assert counters.drain() == {}
+    counters.restore(pending)
+    assert counters.drain() == {1: (2, 1)}
+
+
+def test_like_counted_once_across_processes(mongo, add_memes, monkeypatch):
+    meme_id = add_memes(1)[0]
+    assert meme_manager.record_like(meme_id, "chat:1", 7)
+
+    # Другой процесс: своя память лайков, общая отметка в Mongo
+    monkeypatch.setattr(meme_manager, "popularity_counters", PopularityCounters())
+    assert not meme_manager.record_like(meme_id, "chat:1", 7)
+    assert meme_manager.record_like(meme_id, "chat:1", 8)
+
+
+def test_refresh_builds_weights_from_flushed_stats(mongo, add_memes, monkeypatch):
+    monkeypatch.setattr(meme_manager, "popularity_counters", PopularityCounters())
+    monkeypatch.setattr(meme_manager, "popularity_sampler", WeightedSampler())
+    monkeypatch.setattr(meme_manager, "_popularity_synced_at", None)
+    ids = add_memes(3)
+    meme_manager.popularity_counters.record_send(ids[0])
+    meme_manager.record_like(ids[0], "chat:1", 1)
+
+    assert meme_manager.flush_popularity() == 1
+    assert meme_manager.refresh_popularity() == 3
+    mongo.delete_memes([ids[2]])
+    meme_manager.refresh_popularity()
+
+    served = {meme_manager.popularity_sampler.sample() for _ in range(300)}
+    assert served == {ids[0], ids[1]}
@@ -0,0 +1,52 @@
+# Seeded-ротация: перестановка Фейстеля над снимком активных ID
+
+import pytest
+
+from source import meme_manager
+
+
+@pytest.fixture
+def seeded(monkeypatch):
+    monkeypatch.setattr(meme_manager, "ORDER_MODE", "seeded")
+
+
+def serve(count):
+    return [meme_manager.next_meme()[1] for _ in range(count)]
+
+
+def test_cycle_covers_library(mongo, add_memes, seeded):
+    ids = add_memes(12)
+
+    assert sorted(serve(12)) == sorted(ids)
+    assert sorted(serve(12)) == sorted(ids)
+
+
+def test_sparse_ids(mongo, add_memes, seeded):
+    ids = add_memes(150)
+    mongo.delete_memes(ids[:140])
+
+    assert sorted(serve(10)) == sorted(ids[140:])
+    assert mongo.get_bot_state()["SEEDED"]["domain"] == 10
+
+
+def test_expired_snapshot_starts_new_cycle(mongo, add_memes, seeded):
+    ids = add_memes(8)
+    serve(3)
+    # Снимок удалён TTL-индексом посреди цикла
+    mongo.id_snapshots.delete_many({})
+    mongo._id_snapshot_cache.clear()
+
+    assert sorted(serve(8)) == sorted(ids)
+
+
+def test_cycle_started_before_snapshots(mongo, add_memes, seeded):
+    ids = add_memes(10)
+    mongo.delete_memes(ids[:4])
+    # Старое состояние: перестановка прямо над диапазоном _id
+    mongo.update_bot_state({"SEEDED": {"seed": 7, "pos": 0, "domain": max(ids) + 1}})
+
+    assert sorted(serve(6)) == sorted(ids[4:])
+    # Следующий цикл — уже по снимку
+    serve(1)
+    assert mongo.get_bot_state()["SEEDED"]["domain"] == 6
+    assert "snapshot" in mongo.get_bot_state()["SEEDED"]
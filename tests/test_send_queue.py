@@ -0,0 +1,96 @@
+# Очередь отправки: пауза всей очереди на RetryAfter, повтор с перемотанным файлом
+
+import asyncio
+from io import BytesIO
+
+import pytest
+from telegram.error import RetryAfter
+
+from source.send_queue import SendQueue
+
+
+def run_queue(scenario, **config):
+    """Запустить очередь, выполнить scenario(queue, loop) и дождаться остановки"""
+    async def main():
+        queue = SendQueue(**{"global_rate": 1000, "private_chat_interval": 0, "group_chat_interval": 0, **config})
+        await queue.start()
+        try:
+            return await scenario(queue, asyncio.get_running_loop())
+        finally:
+            await queue.stop()
+    return asyncio.run(main())
+
+
+def test_retry_after_pauses_whole_queue_and_rewinds_file():
+    calls = []
+
+    async def scenario(queue, loop):
+        photo = BytesIO(b"image bytes")
+        attempts = []
+
+        async def send_photo(file):
+            attempts.append(file.read())
+            calls.append(("photo", loop.time()))
+            if len(attempts) == 1:
+                raise RetryAfter(0.3)
+            return "sent"
+
+        async def send_text(text):
+            calls.append((text, loop.time()))
+            return text
+
+        started = loop.time()
+        photo_task = asyncio.create_task(queue.send(1, send_photo, photo))
+        await asyncio.sleep(0.05)
+        text = await queue.send(2, send_text, "other chat")
+        return started, await photo_task, text, attempts, queue.stats
+
+    started, photo_result, text, attempts, stats = run_queue(scenario)
+
+    assert photo_result == "sent" and text == "other chat"
+    # Повтор прочитал файл с начала
+    assert attempts == [b"image bytes", b"image bytes"]
+    # Пока действует RetryAfter, не уходит ничего — и в другие чаты тоже
+    assert [at for name, at in calls if name == "other chat"][0] - started >= 0.3 - 0.01
+    assert stats == {"sent": 2, "retried": 1, "failed": 0}
+
+
+def test_retry_limit_propagates_error():
+    async def scenario(queue, loop):
+        async def always_flooded():
+            raise RetryAfter(0.01)
+
+        with pytest.raises(RetryAfter):
+            await queue.send(1, always_flooded)
+        return queue.stats
+
+    stats = run_queue(scenario, max_retries=2)
+
+    assert stats == {"sent": 0, "retried": 2, "failed": 1}
+
+
+def test_chat_interval_is_respected():
+    async def scenario(queue, loop):
+        sent = []
+
+        async def send(chat_id):
+            sent.append((chat_id, loop.time()))
+
+        await asyncio.gather(*(queue.send(chat_id, send, chat_id) for chat_id in (5, 5, -10, -10)))
+        return sent
+
+    sent = run_queue(scenario, private_chat_interval=0.1, group_chat_interval=0.2)
+
+    private = [at for chat_id, at in sent if chat_id == 5]
+    group = [at for chat_id, at in sent if chat_id == -10]
+    assert private[1] - private[0] >= 0.1 - 0.01
+    assert group[1] - group[0] >= 0.2 - 0.01
+
+
+def test_send_without_workers_calls_directly():
+    async def main():
+        async def echo(value):
+            return value
+        return await SendQueue().send(1, echo, "now")
+
+    assert asyncio.run(main()) == "now"
@@ -0,0 +1,94 @@
+# Пулы тегов: ротация по пулу без повторов, инкрементальные правки и сверка
+
+from source import meme_manager
+from source.mongo_manager import normalize_tags
+
+
+def serve(tag, count):
+    return [meme_manager.next_meme(tag=tag)[1] for _ in range(count)]
+
+
+def test_normalize_tags():
+    assert normalize_tags([" Cats", "#dogs", "cats", "", "  "]) == ["cats", "dogs"]
+
+
+def test_rotation_serves_pool_once_per_cycle(mongo, add_memes):
+    cats = add_memes(9, tags=["cats"])
+    add_memes(5, tags=["dogs"])
+
+    first = serve("cats", 9)
+    second = serve("cats", 9)
+
+    assert sorted(first) == sorted(cats)
+    assert sorted(second) == sorted(cats)
+
+
+def test_memes_added_mid_cycle_join_next_cycle(mongo, add_memes):
+    cats = add_memes(5, tags=["cats"])
+    head = serve("cats", 2)
+    added = add_memes(3, tags=["cats"])
+
+    tail = serve("cats", 3)
+    next_cycle = serve("cats", 8)
+
+    assert sorted(head + tail) == sorted(cats)
+    assert sorted(next_cycle) == sorted(cats + added)
+
+
+def test_removed_memes_leave_rotation(mongo, add_memes):
+    cats = add_memes(8, tags=["cats"])
+    head = serve("cats", 3)
+    gone = [meme_id for meme_id in cats if meme_id not in head][:2]
+    mongo.delete_memes(gone[:1])
+    mongo.remove_tags(gone[1:], ["cats"])
+
+    rest = [meme_id for meme_id in serve("cats", 3) if meme_id is not None]
+
+    served = head + rest
+    assert len(served) == len(set(served))
+    assert not set(served) & set(gone)
+    assert set(serve("cats", 6)) == set(cats) - set(gone)
+    # Дыры убраны при старте нового цикла
+    assert sorted(mongo.get_tag_pool_ids("cats").tolist()) == sorted(set(cats) - set(gone))
+
+
+def test_unknown_or_empty_tag(mongo, add_memes):
+    cats = add_memes(2, tags=["cats"])
+    assert meme_manager.next_meme(tag="nope") == (None, None)
+
+    mongo.delete_memes(cats)
+
+    assert meme_manager.next_meme(tag="cats") == (None, None)
+
+
+def test_rebuild_repairs_pools(mongo, add_memes):
+    cats = add_memes(4, tags=["cats"])
+    mongo.tag_pools.delete_many({})
+    mongo.memes.update_one({"_id": cats[0]}, {"$set": {"tags": ["dogs"]}})
+
+    assert mongo.rebuild_tag_pools() == 2
+
+    assert dict(mongo.list_tag_pools()) == {"cats": 3, "dogs": 1}
+    assert sorted(serve("cats", 3)) == sorted(cats[1:])
+    assert mongo.rebuild_tag_pools() == 0
+
+
+def test_rebuild_mid_cycle_keeps_positions(mongo, add_memes):
+    cats = add_memes(8, tags=["cats"])
+    head = serve("cats", 3)
+    ids_before = mongo.get_tag_pool_ids("cats").tolist()
+    # Пул разошёлся с коллекцией: один мем потерял тег мимо пулов, другой его получил
+    gone = [meme_id for meme_id in cats if meme_id not in head][0]
+    extra = add_memes(1)[0]
+    mongo.memes.update_one({"_id": gone}, {"$set": {"tags": []}})
+    mongo.memes.update_one({"_id": extra}, {"$set": {"tags": ["cats"]}})
+
+    assert mongo.rebuild_tag_pools() == 1
+
+    ids = mongo.get_tag_pool_ids("cats").tolist()
+    assert ids[:len(ids_before)] == [-1 if meme_id == gone else meme_id for meme_id in ids_before]
+    assert ids[len(ids_before):] == [extra]
+    # Текущий цикл доходит без повторов; новый мем — со следующего цикла
+    tail = [meme_id for meme_id in serve("cats", 4) if meme_id is not None]
+    assert sorted(head + tail) == sorted(set(cats) - {gone})
+    assert sorted(serve("cats", 8)) == sorted(set(cats) - {gone} | {extra})